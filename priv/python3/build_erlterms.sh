@@ -0,0 +1,38 @@
+#! /bin/sh
+#
+# Build the optional erlport._erlterms extension in place. erlport.erlterms
+# falls back to the pure Python codec when the extension can't be imported,
+# so a missing Python, C compiler or Python headers only prints a warning.
+#
+# Usage: build_erlterms.sh [clean]
+#
+# PYTHON and CC select the Python interpreter and the C compiler.
+
+cd "$(dirname "$0")/erlport" || exit 0
+
+if [ "$1" = "clean" ]; then
+    rm -f _erlterms*.so _erlterms*.pyd
+    exit 0
+fi
+
+PYTHON="${PYTHON:-python3}"
+CC="${CC:-cc}"
+
+skip()
+{
+    echo "erlport: $1, using the pure Python term codec" >&2
+    exit 0
+}
+
+command -v "$PYTHON" >/dev/null 2>&1 || skip "$PYTHON not found"
+INCLUDE="$("$PYTHON" -c \
+    'import sysconfig; print(sysconfig.get_paths()["include"])')" \
+    || skip "can't get Python include directory"
+SUFFIX="$("$PYTHON" -c \
+    'import sysconfig; print(sysconfig.get_config_var("EXT_SUFFIX"))')" \
+    || skip "can't get Python extension suffix"
+[ -f "$INCLUDE/Python.h" ] || skip "Python.h not found in $INCLUDE"
+command -v "$CC" >/dev/null 2>&1 || skip "C compiler $CC not found"
+
+"$CC" -O2 -shared -fPIC -I"$INCLUDE" -o "_erlterms$SUFFIX" _erlterms.c \
+    || { rm -f "_erlterms$SUFFIX"; skip "_erlterms.c failed to compile"; }
@@ -0,0 +1,1877 @@
+/*
+ * Copyright (c) 2009-2015, Dmitry Vasiliev <dima@hlabs.org>
+ * All rights reserved.
+ *
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions are met:
+ *
+ *  * Redistributions of source code must retain the above copyright notice,
+ *    this list of conditions and the following disclaimer.
+ *  * Redistributions in binary form must reproduce the above copyright notice,
+ *    this list of conditions and the following disclaimer in the documentation
+ *    and/or other materials provided with the distribution.
+ *  * Neither the name of the copyright holders nor the names of its
+ *    contributors may be used to endorse or promote products derived from this
+ *    software without specific prior written permission.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ */
+
+/*
+ * Optional accelerated Erlang external term codec.
+ *
+ * The extension implements the hot paths of erlport.erlterms in C and is
+ * picked up automatically by erlport.erlterms when it can be imported. All
+ * data types (Atom, List, Map, ImproperList, OpaqueObject, RawTerm) are the
+ * ones defined in erlport.erlterms, which hands them over with setup().
+ *
+ * It's built in place by priv/python3/build_erlterms.sh, which rebar3 runs
+ * before compiling, and skipped with a warning if it can't be built.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <string.h>
+
+static PyObject *Atom = NULL;
+static PyObject *List = NULL;
+static PyObject *Map = NULL;
+static PyObject *ImproperList = NULL;
+static PyObject *OpaqueObject = NULL;
+static PyObject *RawTerm = NULL;
+static PyObject *IncompleteData = NULL;
+static PyObject *opaque_marker = NULL;
+static PyObject *decode_opaque = NULL;
+static PyObject *encode_fallback = NULL;
+/* Registered codecs: type -> (encode, tag) or (encode, tag, attribute
+   names, atom keys or None), tag -> decode and record tag -> (tuple size,
+   decode) */
+static PyObject *type_codecs = NULL;
+static PyObject *tag_decoders = NULL;
+static PyObject *record_decoders = NULL;
+static PyObject *ArrayType = NULL;
+static PyObject *empty_args = NULL;
+static PyObject *tail_name = NULL;
+
+static int
+check_setup(void)
+{
+    if (Atom == NULL) {
+        PyErr_SetString(PyExc_RuntimeError,
+            "erlport._erlterms is not initialized");
+        return -1;
+    }
+    return 0;
+}
+
+/* Decoder */
+
+static void
+incomplete_data(PyObject *string)
+{
+    PyObject *exc = PyObject_CallOneArg(IncompleteData, string);
+    if (exc != NULL) {
+        PyErr_SetObject(IncompleteData, exc);
+        Py_DECREF(exc);
+    }
+}
+
+static uint16_t
+get_uint16(const unsigned char *p)
+{
+    return (uint16_t)((p[0] << 8) | p[1]);
+}
+
+static uint32_t
+get_uint32(const unsigned char *p)
+{
+    return ((uint32_t)p[0] << 24) | ((uint32_t)p[1] << 16)
+        | ((uint32_t)p[2] << 8) | (uint32_t)p[3];
+}
+
+static double
+get_double(const unsigned char *p)
+{
+    uint64_t i = 0;
+    double d;
+    int n;
+    for (n = 0; n < 8; n++)
+        i = (i << 8) | p[n];
+    memcpy(&d, &i, sizeof(d));
+    return d;
+}
+
+/* Decoder flags set from the decode options */
+#define DECODE_PLAIN 1
+#define DECODE_STR 2
+#define DECODE_ARRAYS 4
+
+/* String policies */
+#define STRINGS_CHARLIST 0
+#define STRINGS_BINARY 1
+#define STRINGS_AUTO 2
+
+/*
+ * Return the string policy set by the strings attribute of options or -1
+ * on error.
+ */
+static int
+string_policy(PyObject *options)
+{
+    PyObject *value;
+    int policy;
+
+    if (options == NULL || options == Py_None)
+        return STRINGS_CHARLIST;
+    value = PyObject_GetAttrString(options, "strings");
+    if (value == NULL)
+        return -1;
+    if (!PyUnicode_Check(value)) {
+        PyErr_Format(PyExc_ValueError, "invalid string policy: %R", value);
+        Py_DECREF(value);
+        return -1;
+    }
+    if (PyUnicode_CompareWithASCIIString(value, "charlist") == 0)
+        policy = STRINGS_CHARLIST;
+    else if (PyUnicode_CompareWithASCIIString(value, "binary") == 0)
+        policy = STRINGS_BINARY;
+    else if (PyUnicode_CompareWithASCIIString(value, "auto") == 0)
+        policy = STRINGS_AUTO;
+    else {
+        PyErr_Format(PyExc_ValueError, "invalid string policy: %R", value);
+        policy = -1;
+    }
+    Py_DECREF(value);
+    return policy;
+}
+
+/*
+ * Trusted constructors for the containers built by the decoder. Their items
+ * are decoded here and are already immutable, so List.__new__() and
+ * friends which copy and wrap every item are bypassed.
+ */
+
+static PyObject *
+new_list(PyObject *items)
+{
+    PyObject *result = PyList_Type.tp_new((PyTypeObject *)List, empty_args,
+        NULL);
+
+    if (result == NULL)
+        return NULL;
+    if (PyList_SetSlice(result, 0, 0, items) < 0) {
+        Py_DECREF(result);
+        return NULL;
+    }
+    return result;
+}
+
+static PyObject *
+new_improper_list(PyObject *items, PyObject *tail)
+{
+    PyObject *result = PyList_Type.tp_new((PyTypeObject *)ImproperList,
+        empty_args, NULL);
+
+    if (result == NULL)
+        return NULL;
+    if (PyList_SetSlice(result, 0, 0, items) < 0
+            || PyObject_GenericSetAttr(result, tail_name, tail) < 0) {
+        Py_DECREF(result);
+        return NULL;
+    }
+    return result;
+}
+
+#define NEED(n) \
+    if (len - offset < (Py_ssize_t)(n)) { \
+        incomplete_data(string); \
+        return NULL; \
+    }
+
+/*
+ * Decode length elements of the proper list which start at *poffset as
+ * array.array("d") if all of them are floats or array.array("q") if all of
+ * them are integers which fit into 64 bits. Return NULL without an exception
+ * set if the list is something else.
+ */
+
+/* Get the value of SMALL_BIG_EXT at data if it fits into 64 bits and
+   return its size or 0 otherwise */
+static Py_ssize_t
+get_int64_big(const unsigned char *data, Py_ssize_t available, long long *v)
+{
+    unsigned long long magnitude = 0;
+    int n, i;
+
+    if (available < 3)
+        return 0;
+    n = data[1];
+    if (n > 8 || available < 3 + n)
+        return 0;
+    for (i = n - 1; i >= 0; i--)
+        magnitude = (magnitude << 8) | data[3 + i];
+    if (data[2] == 0) {
+        if (magnitude > 0x7fffffffffffffffULL)
+            return 0;
+        *v = (long long)magnitude;
+    }
+    else {
+        if (magnitude > 0x8000000000000000ULL)
+            return 0;
+        *v = (long long)(0 - magnitude);
+    }
+    return 3 + n;
+}
+
+static PyObject *
+decode_array(const unsigned char *data, Py_ssize_t len, Py_ssize_t *poffset,
+        Py_ssize_t length)
+{
+    Py_ssize_t offset = *poffset, i, n;
+    PyObject *bytes, *result;
+    char *p;
+    int floats;
+    long long v;
+
+    if (offset >= len)
+        return NULL;
+    floats = data[offset] == 'F';
+    for (i = 0; i < length; i++) {
+        if (floats && len - offset >= 9 && data[offset] == 'F')
+            offset += 9;
+        else if (!floats && len - offset >= 2 && data[offset] == 'a')
+            offset += 2;
+        else if (!floats && len - offset >= 5 && data[offset] == 'b')
+            offset += 5;
+        else if (!floats && data[offset] == 'n' && (n = get_int64_big(
+                data + offset, len - offset, &v)) > 0)
+            offset += n;
+        else
+            return NULL;
+    }
+    if (offset >= len || data[offset] != 'j')
+        return NULL;
+    bytes = PyBytes_FromStringAndSize(NULL, length * 8);
+    if (bytes == NULL)
+        return NULL;
+    p = PyBytes_AS_STRING(bytes);
+    offset = *poffset;
+    for (i = 0; i < length; i++, p += 8) {
+        if (floats) {
+            double d = get_double(data + offset + 1);
+            memcpy(p, &d, 8);
+            offset += 9;
+        }
+        else {
+            if (data[offset] == 'a') {
+                v = data[offset + 1];
+                offset += 2;
+            }
+            else if (data[offset] == 'b') {
+                v = (int32_t)get_uint32(data + offset + 1);
+                offset += 5;
+            }
+            else
+                offset += get_int64_big(data + offset, len - offset, &v);
+            memcpy(p, &v, 8);
+        }
+    }
+    result = PyObject_CallFunction(ArrayType, "sO", floats ? "d" : "q",
+        bytes);
+    Py_DECREF(bytes);
+    if (result != NULL)
+        *poffset = offset + 1;
+    return result;
+}
+
+static PyObject *
+decode_at(PyObject *string, const unsigned char *data, Py_ssize_t len,
+        Py_ssize_t *poffset, int flags)
+{
+    Py_ssize_t offset = *poffset;
+    Py_ssize_t length, i;
+    unsigned char tag;
+    PyObject *result = NULL;
+
+    NEED(1);
+    tag = data[offset];
+    switch (tag) {
+    case 100: { /* ATOM_EXT */
+        PyObject *name;
+        NEED(3);
+        length = get_uint16(data + offset + 1);
+        offset += 3;
+        NEED(length);
+        *poffset = offset + length;
+        if (length == 4 && memcmp(data + offset, "true", 4) == 0)
+            Py_RETURN_TRUE;
+        if (length == 5 && memcmp(data + offset, "false", 5) == 0)
+            Py_RETURN_FALSE;
+        if (length == 9 && memcmp(data + offset, "undefined", 9) == 0)
+            Py_RETURN_NONE;
+        name = PyBytes_FromStringAndSize((const char *)data + offset, length);
+        if (name == NULL)
+            return NULL;
+        result = PyObject_CallOneArg(Atom, name);
+        Py_DECREF(name);
+        return result;
+    }
+    case 106: /* NIL_EXT */
+        *poffset = offset + 1;
+        if (flags & DECODE_PLAIN)
+            return PyList_New(0);
+        return PyList_Type.tp_new((PyTypeObject *)List, empty_args, NULL);
+    case 107: { /* STRING_EXT */
+        PyObject *lst, *n;
+        NEED(3);
+        length = get_uint16(data + offset + 1);
+        offset += 3;
+        NEED(length);
+        if (flags & DECODE_STR) {
+            *poffset = offset + length;
+            return PyUnicode_DecodeLatin1((const char *)data + offset, length,
+                NULL);
+        }
+        if ((flags & DECODE_ARRAYS) && length > 0) {
+            /* Erlang sends short lists of small integers this way */
+            PyObject *bytes = PyBytes_FromStringAndSize(NULL, length * 8);
+            long long *p;
+            if (bytes == NULL)
+                return NULL;
+            p = (long long *)PyBytes_AS_STRING(bytes);
+            for (i = 0; i < length; i++)
+                p[i] = data[offset + i];
+            result = PyObject_CallFunction(ArrayType, "sO", "q", bytes);
+            Py_DECREF(bytes);
+            if (result != NULL)
+                *poffset = offset + length;
+            return result;
+        }
+        lst = PyList_New(length);
+        if (lst == NULL)
+            return NULL;
+        for (i = 0; i < length; i++) {
+            n = PyLong_FromLong(data[offset + i]);
+            if (n == NULL) {
+                Py_DECREF(lst);
+                return NULL;
+            }
+            PyList_SET_ITEM(lst, i, n);
+        }
+        *poffset = offset + length;
+        if (flags & DECODE_PLAIN)
+            return lst;
+        result = new_list(lst);
+        Py_DECREF(lst);
+        return result;
+    }
+    case 104: /* SMALL_TUPLE_EXT */
+    case 105: /* LARGE_TUPLE_EXT */
+    case 108: { /* LIST_EXT */
+        PyObject *lst, *term;
+        if (tag == 104) {
+            NEED(2);
+            length = data[offset + 1];
+            offset += 2;
+        }
+        else {
+            NEED(5);
+            length = get_uint32(data + offset + 1);
+            offset += 5;
+            if (tag == 108 && (flags & DECODE_ARRAYS)) {
+                result = decode_array(data, len, &offset, length);
+                if (result != NULL || PyErr_Occurred()) {
+                    *poffset = offset;
+                    return result;
+                }
+            }
+        }
+        /* Every element takes at least one byte */
+        NEED(length);
+        lst = PyList_New(length);
+        if (lst == NULL)
+            return NULL;
+        if (Py_EnterRecursiveCall(" while decoding an Erlang term")) {
+            Py_DECREF(lst);
+            return NULL;
+        }
+        for (i = 0; i < length; i++) {
+            term = decode_at(string, data, len, &offset, flags);
+            if (term == NULL) {
+                Py_LeaveRecursiveCall();
+                Py_DECREF(lst);
+                return NULL;
+            }
+            PyList_SET_ITEM(lst, i, term);
+        }
+        if (tag != 108) {
+            Py_LeaveRecursiveCall();
+            if (length == 3) {
+                int r = PyObject_RichCompareBool(PyList_GET_ITEM(lst, 0),
+                    opaque_marker, Py_EQ);
+                if (r < 0) {
+                    Py_DECREF(lst);
+                    return NULL;
+                }
+                if (r) {
+                    result = PyObject_CallFunctionObjArgs(decode_opaque,
+                        PyList_GET_ITEM(lst, 2), PyList_GET_ITEM(lst, 1),
+                        NULL);
+                    Py_DECREF(lst);
+                    *poffset = offset;
+                    return result;
+                }
+            }
+            else if (length == 2 && Py_IS_TYPE(PyList_GET_ITEM(lst, 0),
+                        (PyTypeObject *)Atom)
+                    && PyBytes_GET_SIZE(PyList_GET_ITEM(lst, 0)) == 13
+                    && memcmp(PyBytes_AS_STRING(PyList_GET_ITEM(lst, 0)),
+                        "$erlport.text", 13) == 0
+                    && PyBytes_CheckExact(PyList_GET_ITEM(lst, 1))) {
+                /* Text sent by Erlang with the binary or auto policy */
+                result = PyUnicode_FromEncodedObject(PyList_GET_ITEM(lst, 1),
+                    "utf-8", NULL);
+                Py_DECREF(lst);
+                *poffset = offset;
+                return result;
+            }
+            else if (length == 2 && PyDict_GET_SIZE(tag_decoders)
+                    && Py_IS_TYPE(PyList_GET_ITEM(lst, 0),
+                        (PyTypeObject *)Atom)) {
+                /* Tagged tuple of a registered type */
+                PyObject *decode = PyDict_GetItemWithError(tag_decoders,
+                    PyList_GET_ITEM(lst, 0));
+                if (decode != NULL) {
+                    result = PyObject_CallOneArg(decode,
+                        PyList_GET_ITEM(lst, 1));
+                    Py_DECREF(lst);
+                    *poffset = offset;
+                    return result;
+                }
+                if (PyErr_Occurred()) {
+                    Py_DECREF(lst);
+                    return NULL;
+                }
+            }
+            if (length > 0 && PyDict_GET_SIZE(record_decoders)
+                    && Py_IS_TYPE(PyList_GET_ITEM(lst, 0),
+                        (PyTypeObject *)Atom)) {
+                /* Record of a type registered with record_codec() */
+                PyObject *record = PyDict_GetItemWithError(record_decoders,
+                    PyList_GET_ITEM(lst, 0));
+                if (record != NULL) {
+                    Py_ssize_t size = PyLong_AsSsize_t(
+                        PyTuple_GET_ITEM(record, 0));
+                    if (size == length) {
+                        result = PyObject_Vectorcall(
+                            PyTuple_GET_ITEM(record, 1),
+                            ((PyListObject *)lst)->ob_item + 1,
+                            length - 1, NULL);
+                        Py_DECREF(lst);
+                        *poffset = offset;
+                        return result;
+                    }
+                }
+                if (PyErr_Occurred()) {
+                    Py_DECREF(lst);
+                    return NULL;
+                }
+            }
+            result = PyList_AsTuple(lst);
+            Py_DECREF(lst);
+            *poffset = offset;
+            return result;
+        }
+        if (len - offset < 1) {
+            Py_LeaveRecursiveCall();
+            Py_DECREF(lst);
+            incomplete_data(string);
+            return NULL;
+        }
+        if (data[offset] != 106) {
+            PyObject *tail = decode_at(string, data, len, &offset, flags);
+            Py_LeaveRecursiveCall();
+            if (tail == NULL) {
+                Py_DECREF(lst);
+                return NULL;
+            }
+            result = new_improper_list(lst, tail);
+            Py_DECREF(lst);
+            Py_DECREF(tail);
+            *poffset = offset;
+            return result;
+        }
+        Py_LeaveRecursiveCall();
+        *poffset = offset + 1;
+        if (flags & DECODE_PLAIN)
+            return lst;
+        result = new_list(lst);
+        Py_DECREF(lst);
+        return result;
+    }
+    case 116: { /* MAP_EXT */
+        PyObject *d, *k, *v;
+        NEED(5);
+        length = get_uint32(data + offset + 1);
+        offset += 5;
+        if (flags & DECODE_PLAIN)
+            d = PyDict_New();
+        else
+            d = PyDict_Type.tp_new((PyTypeObject *)Map, empty_args, NULL);
+        if (d == NULL)
+            return NULL;
+        if (Py_EnterRecursiveCall(" while decoding an Erlang term")) {
+            Py_DECREF(d);
+            return NULL;
+        }
+        for (i = 0; i < length; i++) {
+            /* Plain lists and dicts and arrays can't be keys, so keys are
+               decoded with the default containers at any depth */
+            k = decode_at(string, data, len, &offset,
+                flags & ~(DECODE_PLAIN | DECODE_ARRAYS));
+            if (k == NULL)
+                goto map_error;
+            v = decode_at(string, data, len, &offset, flags);
+            if (v == NULL) {
+                Py_DECREF(k);
+                goto map_error;
+            }
+            if (PyDict_SetItem(d, k, v) < 0) {
+                Py_DECREF(k);
+                Py_DECREF(v);
+                goto map_error;
+            }
+            Py_DECREF(k);
+            Py_DECREF(v);
+        }
+        Py_LeaveRecursiveCall();
+        *poffset = offset;
+        return d;
+    map_error:
+        Py_LeaveRecursiveCall();
+        Py_DECREF(d);
+        return NULL;
+    }
+    case 97: /* SMALL_INTEGER_EXT */
+        NEED(2);
+        *poffset = offset + 2;
+        return PyLong_FromLong(data[offset + 1]);
+    case 98: /* INTEGER_EXT */
+        NEED(5);
+        *poffset = offset + 5;
+        return PyLong_FromLong((int32_t)get_uint32(data + offset + 1));
+    case 109: /* BINARY_EXT */
+        NEED(5);
+        length = get_uint32(data + offset + 1);
+        offset += 5;
+        NEED(length);
+        *poffset = offset + length;
+        return PyBytes_FromStringAndSize((const char *)data + offset, length);
+    case 70: /* NEW_FLOAT_EXT */
+        NEED(9);
+        *poffset = offset + 9;
+        return PyFloat_FromDouble(get_double(data + offset + 1));
+    case 110: /* SMALL_BIG_EXT */
+    case 111: { /* LARGE_BIG_EXT */
+        int sign;
+        PyObject *n;
+        if (tag == 110) {
+            NEED(3);
+            length = data[offset + 1];
+            sign = data[offset + 2];
+            offset += 3;
+        }
+        else {
+            NEED(6);
+            length = get_uint32(data + offset + 1);
+            sign = data[offset + 5];
+            offset += 6;
+        }
+        NEED(length);
+        n = PyObject_CallMethod((PyObject *)&PyLong_Type, "from_bytes",
+            "(y#s)", data + offset, length, "little");
+        if (n == NULL)
+            return NULL;
+        *poffset = offset + length;
+        if (sign) {
+            result = PyNumber_Negative(n);
+            Py_DECREF(n);
+            return result;
+        }
+        return n;
+    }
+    }
+
+    {
+        PyObject *rest = PySequence_GetSlice(string, offset, len);
+        if (rest != NULL) {
+            PyErr_Format(PyExc_ValueError, "unsupported data: %R", rest);
+            Py_DECREF(rest);
+        }
+    }
+    return NULL;
+}
+
+/*
+ * Decode the list of tuples or maps of the same shape which starts at
+ * *poffset into a list of column lists or a dict mapping the map keys to
+ * column lists.
+ */
+static PyObject *
+decode_columns(PyObject *string, const unsigned char *data, Py_ssize_t len,
+        Py_ssize_t *poffset, int flags)
+{
+    Py_ssize_t offset = *poffset, count, size, width = 0, i, j;
+    PyObject *columns = NULL;
+    unsigned char tag;
+    int is_map = 0;
+
+    NEED(1);
+    tag = data[offset];
+    if (tag == 106) {
+        *poffset = offset + 1;
+        return PyList_New(0);
+    }
+    if (tag != 108) {
+        PyErr_Format(PyExc_ValueError, "list expected at offset %zd", offset);
+        return NULL;
+    }
+    NEED(5);
+    count = get_uint32(data + offset + 1);
+    offset += 5;
+    for (i = 0; i < count; i++) {
+        if (len - offset < 1)
+            goto incomplete;
+        tag = data[offset];
+        if (tag == 104) {
+            if (len - offset < 2)
+                goto incomplete;
+            size = data[offset + 1];
+            offset += 2;
+        }
+        else if (tag == 105 || tag == 116) {
+            if (len - offset < 5)
+                goto incomplete;
+            size = get_uint32(data + offset + 1);
+            offset += 5;
+        }
+        else {
+            PyErr_Format(PyExc_ValueError,
+                "tuple or map expected at offset %zd", offset);
+            goto error;
+        }
+        if (columns == NULL) {
+            /* The first row defines the shape */
+            is_map = tag == 116;
+            width = size;
+            columns = is_map ? PyDict_New() : PyList_New(0);
+            if (columns == NULL)
+                goto error;
+            for (j = 0; j < size && !is_map; j++) {
+                PyObject *column = PyList_New(0);
+                int r = column == NULL ? -1 : PyList_Append(columns, column);
+                Py_XDECREF(column);
+                if (r < 0)
+                    goto error;
+            }
+        }
+        else if ((tag == 116) != is_map || size != width) {
+            PyErr_Format(PyExc_ValueError,
+                "row of different shape at offset %zd", offset);
+            goto error;
+        }
+        for (j = 0; j < size; j++) {
+            PyObject *column, *term;
+            int r;
+            if (is_map) {
+                PyObject *key = decode_at(string, data, len, &offset, flags);
+                if (key == NULL)
+                    goto error;
+                if (i == 0) {
+                    column = PyList_New(0);
+                    r = column == NULL ? -1
+                        : PyDict_SetItem(columns, key, column);
+                    Py_XDECREF(column);
+                    if (r == 0 && PyDict_GET_SIZE(columns) != j + 1) {
+                        PyErr_SetString(PyExc_ValueError,
+                            "duplicate map key");
+                        r = -1;
+                    }
+                }
+                else {
+                    column = PyDict_GetItemWithError(columns, key);
+                    r = 0;
+                    if (column == NULL) {
+                        if (!PyErr_Occurred())
+                            PyErr_Format(PyExc_ValueError,
+                                "unexpected map key: %R", key);
+                        r = -1;
+                    }
+                }
+                Py_DECREF(key);
+                if (r < 0)
+                    goto error;
+            }
+            else
+                column = PyList_GET_ITEM(columns, j);
+            term = decode_at(string, data, len, &offset, flags);
+            if (term == NULL)
+                goto error;
+            r = PyList_Append(column, term);
+            Py_DECREF(term);
+            if (r < 0)
+                goto error;
+        }
+    }
+    if (len - offset < 1)
+        goto incomplete;
+    if (data[offset] != 106) {
+        PyErr_Format(PyExc_ValueError, "improper list at offset %zd", offset);
+        goto error;
+    }
+    if (columns == NULL)
+        columns = PyList_New(0);
+    *poffset = offset + 1;
+    return columns;
+
+incomplete:
+    incomplete_data(string);
+error:
+    Py_XDECREF(columns);
+    return NULL;
+}
+
+#undef NEED
+
+/*
+ * Return the offset just past the term which starts at offset without
+ * decoding it, or -1 on error.
+ */
+static Py_ssize_t
+skip_at(PyObject *string, const unsigned char *data, Py_ssize_t len,
+        Py_ssize_t offset)
+{
+    Py_ssize_t remaining = 1, length;
+    unsigned char tag;
+
+    while (remaining) {
+        if (offset >= len)
+            goto incomplete;
+        tag = data[offset];
+        remaining--;
+        switch (tag) {
+        case 97: /* SMALL_INTEGER_EXT */
+            offset += 2;
+            break;
+        case 98: /* INTEGER_EXT */
+            offset += 5;
+            break;
+        case 70: /* NEW_FLOAT_EXT */
+            offset += 9;
+            break;
+        case 106: /* NIL_EXT */
+            offset += 1;
+            break;
+        case 100: /* ATOM_EXT */
+        case 107: /* STRING_EXT */
+            if (len - offset < 3)
+                goto incomplete;
+            offset += get_uint16(data + offset + 1) + 3;
+            break;
+        case 104: /* SMALL_TUPLE_EXT */
+            if (len - offset < 2)
+                goto incomplete;
+            remaining += data[offset + 1];
+            offset += 2;
+            break;
+        case 110: /* SMALL_BIG_EXT */
+            if (len - offset < 2)
+                goto incomplete;
+            offset += data[offset + 1] + 3;
+            break;
+        case 109: /* BINARY_EXT */
+        case 105: /* LARGE_TUPLE_EXT */
+        case 108: /* LIST_EXT */
+        case 116: /* MAP_EXT */
+        case 111: /* LARGE_BIG_EXT */
+            if (len - offset < 5)
+                goto incomplete;
+            length = get_uint32(data + offset + 1);
+            offset += 5;
+            if (tag == 109)
+                offset += length;
+            else if (tag == 105)
+                remaining += length;
+            else if (tag == 108)
+                /* Elements and tail */
+                remaining += length + 1;
+            else if (tag == 116)
+                remaining += length * 2;
+            else
+                offset += length + 1;
+            break;
+        default: {
+            PyObject *rest = PySequence_GetSlice(string, offset, len);
+            if (rest != NULL) {
+                PyErr_Format(PyExc_ValueError, "unsupported data: %R", rest);
+                Py_DECREF(rest);
+            }
+            return -1;
+        }
+        }
+    }
+    if (offset > len)
+        goto incomplete;
+    return offset;
+
+incomplete:
+    incomplete_data(string);
+    return -1;
+}
+
+typedef PyObject *(*decode_func)(PyObject *, const unsigned char *,
+    Py_ssize_t, Py_ssize_t *, int);
+
+static PyObject *
+decode_buffer(PyObject *string, Py_ssize_t *offset, int flags,
+        decode_func decode)
+{
+    Py_buffer view;
+    PyObject *term;
+
+    if (check_setup() < 0)
+        return NULL;
+    if (PyObject_GetBuffer(string, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    if (*offset < 0 || *offset > view.len) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, "invalid offset");
+        return NULL;
+    }
+    term = decode(string, (const unsigned char *)view.buf, view.len,
+        offset, flags);
+    PyBuffer_Release(&view);
+    return term;
+}
+
+/* Return the decoder flags set by options or -1 on error */
+static int
+decode_flags(PyObject *options)
+{
+    PyObject *value;
+    int flags = 0, r, policy;
+
+    if (options == Py_None)
+        return 0;
+    value = PyObject_GetAttrString(options, "plain");
+    if (value == NULL)
+        return -1;
+    r = PyObject_IsTrue(value);
+    Py_DECREF(value);
+    if (r < 0)
+        return -1;
+    if (r)
+        flags |= DECODE_PLAIN;
+    policy = string_policy(options);
+    if (policy < 0)
+        return -1;
+    if (policy == STRINGS_AUTO)
+        flags |= DECODE_STR;
+    value = PyObject_GetAttrString(options, "arrays");
+    if (value == NULL)
+        return -1;
+    r = PyObject_IsTrue(value);
+    Py_DECREF(value);
+    if (r < 0)
+        return -1;
+    if (r)
+        flags |= DECODE_ARRAYS;
+    return flags;
+}
+
+PyDoc_STRVAR(decode_term_at_doc,
+"decode_term_at(string, offset, options=None) -> (term, offset)\n\
+\n\
+Decode Erlang external term starting at offset. Only the plain, strings\n\
+and arrays attributes of options are taken into account.");
+
+static PyObject *
+erlterms_decode_term_at(PyObject *self, PyObject *args)
+{
+    PyObject *string, *term, *result, *options = Py_None;
+    Py_ssize_t offset;
+    int flags;
+
+    if (!PyArg_ParseTuple(args, "On|O:decode_term_at", &string, &offset,
+            &options))
+        return NULL;
+    flags = decode_flags(options);
+    if (flags < 0)
+        return NULL;
+    term = decode_buffer(string, &offset, flags, decode_at);
+    if (term == NULL)
+        return NULL;
+    result = Py_BuildValue("(Nn)", term, offset);
+    return result;
+}
+
+PyDoc_STRVAR(decode_columns_at_doc,
+"decode_columns_at(string, offset, options=None) -> (columns, offset)\n\
+\n\
+Decode Erlang list of tuples or maps of the same shape starting at offset\n\
+into a list of column lists or a dict mapping the keys to column lists.");
+
+static PyObject *
+erlterms_decode_columns_at(PyObject *self, PyObject *args)
+{
+    PyObject *string, *columns, *options = Py_None;
+    Py_ssize_t offset;
+    int flags;
+
+    if (!PyArg_ParseTuple(args, "On|O:decode_columns_at", &string, &offset,
+            &options))
+        return NULL;
+    flags = decode_flags(options);
+    if (flags < 0)
+        return NULL;
+    columns = decode_buffer(string, &offset, flags, decode_columns);
+    if (columns == NULL)
+        return NULL;
+    return Py_BuildValue("(Nn)", columns, offset);
+}
+
+PyDoc_STRVAR(skip_term_at_doc,
+"skip_term_at(string, offset) -> offset\n\
+\n\
+Return the offset just past the Erlang external term which starts at\n\
+offset without decoding it.");
+
+static PyObject *
+erlterms_skip_term_at(PyObject *self, PyObject *args)
+{
+    PyObject *string;
+    Py_buffer view;
+    Py_ssize_t offset;
+
+    if (!PyArg_ParseTuple(args, "On:skip_term_at", &string, &offset))
+        return NULL;
+    if (check_setup() < 0)
+        return NULL;
+    if (PyObject_GetBuffer(string, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    if (offset < 0 || offset > view.len) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, "invalid offset");
+        return NULL;
+    }
+    offset = skip_at(string, (const unsigned char *)view.buf, view.len,
+        offset);
+    PyBuffer_Release(&view);
+    if (offset < 0)
+        return NULL;
+    return PyLong_FromSsize_t(offset);
+}
+
+PyDoc_STRVAR(decode_term_doc,
+"decode_term(string) -> (term, tail)\n\
+\n\
+Decode Erlang external term without the version byte.");
+
+static PyObject *
+erlterms_decode_term(PyObject *self, PyObject *string)
+{
+    Py_ssize_t offset = 0;
+    PyObject *term, *tail;
+
+    term = decode_buffer(string, &offset, 0, decode_at);
+    if (term == NULL)
+        return NULL;
+    tail = PySequence_GetSlice(string, offset, PY_SSIZE_T_MAX);
+    if (tail == NULL) {
+        Py_DECREF(term);
+        return NULL;
+    }
+    return Py_BuildValue("(NN)", term, tail);
+}
+
+/* Encoder */
+
+/*
+ * The writer appends either to a private memory block or, when target is
+ * set, straight into a bytearray which is grown geometrically and trimmed
+ * to the written length by writer_finish().
+ */
+typedef struct {
+    char *data;
+    Py_ssize_t len;
+    Py_ssize_t size;
+    PyObject *target;
+    /* Encode options passed to encode_fallback and their string policy */
+    PyObject *options;
+    int strings;
+} Writer;
+
+static int
+writer_reserve(Writer *w, Py_ssize_t n)
+{
+    if (w->len + n > w->size) {
+        Py_ssize_t size = w->size * 2;
+        if (size < w->len + n)
+            size = w->len + n;
+        if (w->target != NULL) {
+            /* Most terms encoded into buffers are small messages, so the
+               first growth is kept small too */
+            if (size < w->len + n + 64)
+                size = w->len + n + 64;
+            if (PyByteArray_GET_SIZE(w->target) != w->size) {
+                PyErr_SetString(PyExc_RuntimeError,
+                    "buffer changed size during encoding");
+                return -1;
+            }
+            if (PyByteArray_Resize(w->target, size) < 0)
+                return -1;
+            w->data = PyByteArray_AS_STRING(w->target);
+        }
+        else {
+            char *data;
+            if (size < 256)
+                size = 256;
+            data = PyMem_Realloc(w->data, size);
+            if (data == NULL) {
+                PyErr_NoMemory();
+                return -1;
+            }
+            w->data = data;
+        }
+        w->size = size;
+    }
+    return 0;
+}
+
+static int
+writer_write(Writer *w, const void *buf, Py_ssize_t n)
+{
+    if (writer_reserve(w, n) < 0)
+        return -1;
+    memcpy(w->data + w->len, buf, n);
+    w->len += n;
+    return 0;
+}
+
+static int
+writer_put_byte(Writer *w, unsigned char c)
+{
+    if (writer_reserve(w, 1) < 0)
+        return -1;
+    w->data[w->len++] = (char)c;
+    return 0;
+}
+
+static int
+writer_put_header(Writer *w, unsigned char tag, uint32_t n, int size)
+{
+    unsigned char buf[5];
+    buf[0] = tag;
+    if (size == 2) {
+        buf[1] = (unsigned char)(n >> 8);
+        buf[2] = (unsigned char)n;
+    }
+    else {
+        buf[1] = (unsigned char)(n >> 24);
+        buf[2] = (unsigned char)(n >> 16);
+        buf[3] = (unsigned char)(n >> 8);
+        buf[4] = (unsigned char)n;
+    }
+    return writer_write(w, buf, size + 1);
+}
+
+static int encode_into(Writer *w, PyObject *term);
+
+static int
+encode_items(Writer *w, PyObject *seq, Py_ssize_t length)
+{
+    Py_ssize_t i;
+    int r = 0;
+
+    if (Py_EnterRecursiveCall(" while encoding an Erlang term"))
+        return -1;
+    for (i = 0; i < length; i++) {
+        PyObject *item;
+        if (i >= PySequence_Fast_GET_SIZE(seq)) {
+            PyErr_SetString(PyExc_RuntimeError,
+                "sequence changed size during encoding");
+            r = -1;
+            break;
+        }
+        item = PySequence_Fast_GET_ITEM(seq, i);
+        Py_INCREF(item);
+        r = encode_into(w, item);
+        Py_DECREF(item);
+        if (r < 0)
+            break;
+    }
+    Py_LeaveRecursiveCall();
+    return r;
+}
+
+static int
+encode_bytes_result(Writer *w, PyObject *data)
+{
+    int r;
+    if (data == NULL)
+        return -1;
+    if (!PyBytes_Check(data)) {
+        PyErr_Format(PyExc_TypeError, "bytes object expected, got %.200s",
+            Py_TYPE(data)->tp_name);
+        Py_DECREF(data);
+        return -1;
+    }
+    r = writer_write(w, PyBytes_AS_STRING(data), PyBytes_GET_SIZE(data));
+    Py_DECREF(data);
+    return r;
+}
+
+static int
+encode_list(Writer *w, PyObject *term)
+{
+    Py_ssize_t length = PyList_GET_SIZE(term);
+
+    if (length == 0)
+        return writer_put_byte(w, 'j');
+    if (!PyList_CheckExact(term) && (PyObject *)Py_TYPE(term) != List) {
+        /* PyBytes_FromObject() would iterate over the subclass with its
+           own __iter__(), copy the items as they are */
+        PyObject *items = PyList_GetSlice(term, 0, length);
+        int r;
+        if (items == NULL)
+            return -1;
+        r = encode_list(w, items);
+        Py_DECREF(items);
+        return r;
+    }
+    if (length <= 65535) {
+        PyObject *b = PyBytes_FromObject(term);
+        if (b != NULL) {
+            int r = writer_put_header(w, 'k', (uint32_t)length, 2);
+            if (r == 0)
+                r = writer_write(w, PyBytes_AS_STRING(b), length);
+            Py_DECREF(b);
+            return r;
+        }
+        if (!PyErr_ExceptionMatches(PyExc_ValueError)
+                && !PyErr_ExceptionMatches(PyExc_TypeError))
+            return -1;
+        PyErr_Clear();
+    }
+    else if ((size_t)length > 4294967295U) {
+        PyErr_Format(PyExc_ValueError, "invalid list length: %zd", length);
+        return -1;
+    }
+    if (writer_put_header(w, 'l', (uint32_t)length, 4) < 0)
+        return -1;
+    if (encode_items(w, term, length) < 0)
+        return -1;
+    return writer_put_byte(w, 'j');
+}
+
+static int
+encode_str(Writer *w, PyObject *term)
+{
+    Py_ssize_t length = PyUnicode_GET_LENGTH(term);
+    int kind = PyUnicode_KIND(term);
+    const void *data = PyUnicode_DATA(term);
+    Py_ssize_t i;
+
+    if (w->strings != STRINGS_BINARY) {
+        if (length == 0)
+            return writer_put_byte(w, 'j');
+        if (length <= 65535 && kind == PyUnicode_1BYTE_KIND) {
+            if (writer_put_header(w, 'k', (uint32_t)length, 2) < 0)
+                return -1;
+            return writer_write(w, data, length);
+        }
+    }
+    if (w->strings != STRINGS_CHARLIST) {
+        /* UTF-8 binary */
+        Py_ssize_t size;
+        const char *utf8 = PyUnicode_AsUTF8AndSize(term, &size);
+        if (utf8 == NULL)
+            return -1;
+        if ((size_t)size > 4294967295U) {
+            PyErr_Format(PyExc_ValueError, "invalid binary length: %zd",
+                size);
+            return -1;
+        }
+        if (writer_put_header(w, 'm', (uint32_t)size, 4) < 0)
+            return -1;
+        return writer_write(w, utf8, size);
+    }
+    if ((size_t)length > 4294967295U) {
+        PyErr_Format(PyExc_ValueError, "invalid list length: %zd", length);
+        return -1;
+    }
+    if (writer_put_header(w, 'l', (uint32_t)length, 4) < 0)
+        return -1;
+    for (i = 0; i < length; i++) {
+        Py_UCS4 c = PyUnicode_READ(kind, data, i);
+        if (c <= 255) {
+            unsigned char buf[2] = {'a', (unsigned char)c};
+            if (writer_write(w, buf, 2) < 0)
+                return -1;
+        }
+        else if (writer_put_header(w, 'b', c, 4) < 0)
+            return -1;
+    }
+    return writer_put_byte(w, 'j');
+}
+
+static int
+encode_int(Writer *w, PyObject *term)
+{
+    int overflow;
+    long long v = PyLong_AsLongLongAndOverflow(term, &overflow);
+    PyObject *n, *bits, *b;
+    Py_ssize_t length;
+    int sign;
+    unsigned char header[6];
+
+    if (v == -1 && PyErr_Occurred())
+        return -1;
+    if (!overflow) {
+        if (0 <= v && v <= 255) {
+            unsigned char buf[2] = {'a', (unsigned char)v};
+            return writer_write(w, buf, 2);
+        }
+        if (-2147483648LL <= v && v <= 2147483647LL)
+            return writer_put_header(w, 'b', (uint32_t)(int32_t)v, 4);
+    }
+
+    sign = overflow ? overflow < 0 : v < 0;
+    n = sign ? PyNumber_Negative(term) : Py_NewRef(term);
+    if (n == NULL)
+        return -1;
+    bits = PyObject_CallMethod(n, "bit_length", NULL);
+    if (bits == NULL) {
+        Py_DECREF(n);
+        return -1;
+    }
+    length = (PyLong_AsSsize_t(bits) + 7) / 8;
+    Py_DECREF(bits);
+    if (length == -1 && PyErr_Occurred()) {
+        Py_DECREF(n);
+        return -1;
+    }
+    if ((size_t)length > 4294967295U) {
+        Py_DECREF(n);
+        PyErr_Format(PyExc_ValueError,
+            "invalid integer value with length: %zd", length);
+        return -1;
+    }
+    b = PyObject_CallMethod(n, "to_bytes", "(ns)", length, "little");
+    Py_DECREF(n);
+    if (b == NULL)
+        return -1;
+    if (length <= 255) {
+        header[0] = 'n';
+        header[1] = (unsigned char)length;
+        header[2] = (unsigned char)sign;
+        if (writer_write(w, header, 3) < 0) {
+            Py_DECREF(b);
+            return -1;
+        }
+    }
+    else {
+        if (writer_put_header(w, 'o', (uint32_t)length, 4) < 0
+                || writer_put_byte(w, (unsigned char)sign) < 0) {
+            Py_DECREF(b);
+            return -1;
+        }
+    }
+    return encode_bytes_result(w, b);
+}
+
+static int
+encode_double(Writer *w, double d)
+{
+    uint64_t i;
+    unsigned char buf[9];
+    int n;
+
+    memcpy(&i, &d, sizeof(i));
+    buf[0] = 'F';
+    for (n = 8; n > 0; n--) {
+        buf[n] = (unsigned char)i;
+        i >>= 8;
+    }
+    return writer_write(w, buf, 9);
+}
+
+static int
+encode_float(Writer *w, PyObject *term)
+{
+    return encode_double(w, PyFloat_AS_DOUBLE(term));
+}
+
+static int
+encode_long_long(Writer *w, long long v)
+{
+    PyObject *n;
+    int r;
+
+    if (0 <= v && v <= 255) {
+        unsigned char buf[2] = {'a', (unsigned char)v};
+        return writer_write(w, buf, 2);
+    }
+    if (-2147483648LL <= v && v <= 2147483647LL)
+        return writer_put_header(w, 'b', (uint32_t)(int32_t)v, 4);
+    n = PyLong_FromLongLong(v);
+    if (n == NULL)
+        return -1;
+    r = encode_int(w, n);
+    Py_DECREF(n);
+    return r;
+}
+
+/*
+ * Encode numeric array.array as list reading the items straight from its
+ * buffer. Return 1 for arrays of characters.
+ */
+static int
+encode_array(Writer *w, PyObject *term)
+{
+    Py_buffer view;
+    Py_ssize_t length, i;
+    char code;
+    int r = 0;
+
+    if (PyObject_GetBuffer(term, &view, PyBUF_FORMAT) < 0)
+        return -1;
+    code = view.format[0];
+    if (code == 'u' || code == 'w') {
+        PyBuffer_Release(&view);
+        return 1;
+    }
+    length = view.len / view.itemsize;
+    if (length == 0) {
+        PyBuffer_Release(&view);
+        return writer_put_byte(w, 'j');
+    }
+    if ((size_t)length > 4294967295U) {
+        PyBuffer_Release(&view);
+        PyErr_Format(PyExc_ValueError, "invalid list length: %zd", length);
+        return -1;
+    }
+    r = writer_put_header(w, 'l', (uint32_t)length, 4);
+    for (i = 0; i < length && r == 0; i++) {
+        const char *p = (const char *)view.buf + i * view.itemsize;
+        switch (code) {
+#define ITEM(type) (*(const type *)p)
+        case 'd': r = encode_double(w, ITEM(double)); break;
+        case 'f': r = encode_double(w, ITEM(float)); break;
+        case 'b': r = encode_long_long(w, ITEM(signed char)); break;
+        case 'B': r = encode_long_long(w, ITEM(unsigned char)); break;
+        case 'h': r = encode_long_long(w, ITEM(short)); break;
+        case 'H': r = encode_long_long(w, ITEM(unsigned short)); break;
+        case 'i': r = encode_long_long(w, ITEM(int)); break;
+        case 'I': r = encode_long_long(w, ITEM(unsigned int)); break;
+        case 'l': r = encode_long_long(w, ITEM(long)); break;
+        case 'q': r = encode_long_long(w, ITEM(long long)); break;
+        case 'L':
+        case 'Q': {
+            unsigned long long v = code == 'L' ? ITEM(unsigned long)
+                : ITEM(unsigned long long);
+            if (v <= (unsigned long long)LLONG_MAX)
+                r = encode_long_long(w, (long long)v);
+            else {
+                PyObject *n = PyLong_FromUnsignedLongLong(v);
+                r = n == NULL ? -1 : encode_int(w, n);
+                Py_XDECREF(n);
+            }
+            break;
+        }
+#undef ITEM
+        default:
+            PyErr_Format(PyExc_ValueError, "unsupported array type: %c",
+                code);
+            r = -1;
+        }
+    }
+    PyBuffer_Release(&view);
+    if (r < 0)
+        return -1;
+    return writer_put_byte(w, 'j');
+}
+
+static int
+encode_map(Writer *w, PyObject *term)
+{
+    Py_ssize_t length = PyDict_GET_SIZE(term);
+    Py_ssize_t pos = 0;
+    PyObject *k, *v;
+    int r = 0;
+
+    if ((size_t)length > 4294967295U) {
+        PyErr_Format(PyExc_ValueError, "invalid Map size: %zd", length);
+        return -1;
+    }
+    if (writer_put_header(w, 't', (uint32_t)length, 4) < 0)
+        return -1;
+    if (Py_EnterRecursiveCall(" while encoding an Erlang term"))
+        return -1;
+    while (PyDict_Next(term, &pos, &k, &v)) {
+        Py_INCREF(k);
+        Py_INCREF(v);
+        r = encode_into(w, k);
+        if (r == 0)
+            r = encode_into(w, v);
+        Py_DECREF(k);
+        Py_DECREF(v);
+        if (r < 0)
+            break;
+    }
+    Py_LeaveRecursiveCall();
+    return r;
+}
+
+static int
+encode_tuple(Writer *w, PyObject *term)
+{
+    Py_ssize_t arity = PyTuple_GET_SIZE(term);
+
+    if (arity <= 255) {
+        unsigned char buf[2] = {'h', (unsigned char)arity};
+        if (writer_write(w, buf, 2) < 0)
+            return -1;
+    }
+    else if ((size_t)arity <= 4294967295U) {
+        if (writer_put_header(w, 'i', (uint32_t)arity, 4) < 0)
+            return -1;
+    }
+    else {
+        PyErr_Format(PyExc_ValueError, "invalid tuple arity: %zd", arity);
+        return -1;
+    }
+    return encode_items(w, term, arity);
+}
+
+/*
+ * Encode subclasses of the native types as their base types and bytes-like
+ * objects as binaries. Return 1 if the term isn't one of them.
+ */
+static int
+encode_other(Writer *w, PyObject *term)
+{
+    Py_buffer view;
+    int r;
+
+    if (PyObject_TypeCheck(term, (PyTypeObject *)ImproperList))
+        return 1;
+    if (PyUnicode_Check(term))
+        return encode_str(w, term);
+    if (PyLong_Check(term)) {
+        /* int.__int__() copies the value, overridden __int__() isn't
+           called */
+        PyObject *n = PyLong_Type.tp_as_number->nb_int(term);
+        if (n == NULL)
+            return -1;
+        r = encode_int(w, n);
+        Py_DECREF(n);
+        return r;
+    }
+    if (PyFloat_Check(term))
+        return encode_float(w, term);
+    if (PyTuple_Check(term))
+        return encode_tuple(w, term);
+    if (PyList_Check(term))
+        return encode_list(w, term);
+    if (PyDict_Check(term))
+        return encode_map(w, term);
+    if (PyObject_TypeCheck(term, (PyTypeObject *)ArrayType))
+        return encode_array(w, term);
+    if (!PyObject_CheckBuffer(term))
+        return 1;
+    if (PyObject_GetBuffer(term, &view, PyBUF_SIMPLE) < 0) {
+        /* Not contiguous, leave it to encode_fallback */
+        if (!PyErr_ExceptionMatches(PyExc_BufferError))
+            return -1;
+        PyErr_Clear();
+        return 1;
+    }
+    if ((size_t)view.len > 4294967295U) {
+        PyErr_Format(PyExc_ValueError, "invalid binary length: %zd",
+            view.len);
+        r = -1;
+    }
+    else {
+        r = writer_put_header(w, 'm', (uint32_t)view.len, 4);
+        if (r == 0)
+            r = writer_write(w, view.buf, view.len);
+    }
+    PyBuffer_Release(&view);
+    return r;
+}
+
+/*
+ * Encode the term with the registered codec which is (encode, tag) tuple.
+ * The result of encode(term) is sent as {tag, result} tuple or as is if
+ * tag is None.
+ */
+static int
+encode_record(Writer *w, PyObject *term, PyObject *codec)
+{
+    PyObject *tag = PyTuple_GET_ITEM(codec, 1);
+    PyObject *names = PyTuple_GET_ITEM(codec, 2);
+    PyObject *keys = PyTuple_GET_ITEM(codec, 3);
+    Py_ssize_t length, i;
+    int r = 0;
+
+    if (!PyTuple_Check(names)
+            || (keys != Py_None && (!PyTuple_Check(keys)
+                || PyTuple_GET_SIZE(keys) != PyTuple_GET_SIZE(names)))) {
+        PyErr_SetString(PyExc_TypeError, "invalid registered codec");
+        return -1;
+    }
+    length = PyTuple_GET_SIZE(names);
+    if (keys == Py_None) {
+        if (length >= 255) {
+            if (writer_put_header(w, 'i', (uint32_t)length + 1, 4) < 0)
+                return -1;
+        }
+        else {
+            unsigned char buf[2] = {'h', (unsigned char)(length + 1)};
+            if (writer_write(w, buf, 2) < 0)
+                return -1;
+        }
+        if (encode_into(w, tag) < 0)
+            return -1;
+    }
+    else {
+        if (tag != Py_None
+                && (writer_write(w, "h\2", 2) < 0 || encode_into(w, tag) < 0))
+            return -1;
+        if (writer_put_header(w, 't', (uint32_t)length, 4) < 0)
+            return -1;
+    }
+    if (Py_EnterRecursiveCall(" while encoding an Erlang term"))
+        return -1;
+    for (i = 0; i < length && r == 0; i++) {
+        PyObject *value;
+        if (keys != Py_None) {
+            r = encode_into(w, PyTuple_GET_ITEM(keys, i));
+            if (r < 0)
+                break;
+        }
+        value = PyObject_GetAttr(term, PyTuple_GET_ITEM(names, i));
+        if (value == NULL) {
+            r = -1;
+            break;
+        }
+        r = encode_into(w, value);
+        Py_DECREF(value);
+    }
+    Py_LeaveRecursiveCall();
+    return r;
+}
+
+static int
+encode_registered(Writer *w, PyObject *term, PyObject *codec)
+{
+    PyObject *encode, *tag, *value;
+    int r;
+
+    if (PyTuple_Check(codec) && PyTuple_GET_SIZE(codec) == 4)
+        return encode_record(w, term, codec);
+    if (!PyTuple_Check(codec) || PyTuple_GET_SIZE(codec) != 2) {
+        PyErr_SetString(PyExc_TypeError, "invalid registered codec");
+        return -1;
+    }
+    encode = PyTuple_GET_ITEM(codec, 0);
+    tag = PyTuple_GET_ITEM(codec, 1);
+    value = PyObject_CallOneArg(encode, term);
+    if (value == NULL)
+        return -1;
+    if (Py_EnterRecursiveCall(" while encoding an Erlang term")) {
+        Py_DECREF(value);
+        return -1;
+    }
+    r = 0;
+    if (tag != Py_None) {
+        r = writer_write(w, "h\2", 2);
+        if (r == 0)
+            r = encode_into(w, tag);
+    }
+    if (r == 0)
+        r = encode_into(w, value);
+    Py_LeaveRecursiveCall();
+    Py_DECREF(value);
+    return r;
+}
+
+/* Copy the data of RawTerm to the output as is */
+static int
+encode_raw(Writer *w, PyObject *term)
+{
+    PyObject *data = PyObject_GetAttrString(term, "data");
+    Py_buffer view;
+    int r;
+
+    if (data == NULL)
+        return -1;
+    r = PyObject_GetBuffer(data, &view, PyBUF_SIMPLE);
+    Py_DECREF(data);
+    if (r < 0)
+        return -1;
+    r = writer_write(w, view.buf, view.len);
+    PyBuffer_Release(&view);
+    return r;
+}
+
+static int
+encode_into(Writer *w, PyObject *term)
+{
+    PyTypeObject *t = Py_TYPE(term);
+    int r;
+
+    if (t == &PyTuple_Type)
+        return encode_tuple(w, term);
+    else if (t == &PyList_Type || (PyObject *)t == List)
+        return encode_list(w, term);
+    else if (t == &PyUnicode_Type)
+        return encode_str(w, term);
+    else if ((PyObject *)t == Atom) {
+        Py_ssize_t length = PyBytes_GET_SIZE(term);
+        if (writer_put_header(w, 'd', (uint32_t)length, 2) < 0)
+            return -1;
+        return writer_write(w, PyBytes_AS_STRING(term), length);
+    }
+    else if (t == &PyBytes_Type) {
+        Py_ssize_t length = PyBytes_GET_SIZE(term);
+        if ((size_t)length > 4294967295U) {
+            PyErr_Format(PyExc_ValueError, "invalid binary length: %zd",
+                length);
+            return -1;
+        }
+        if (writer_put_header(w, 'm', (uint32_t)length, 4) < 0)
+            return -1;
+        return writer_write(w, PyBytes_AS_STRING(term), length);
+    }
+    else if (term == Py_True)
+        return writer_write(w, "d\0\4true", 7);
+    else if (term == Py_False)
+        return writer_write(w, "d\0\5false", 8);
+    else if (t == &PyLong_Type)
+        return encode_int(w, term);
+    else if (t == &PyFloat_Type)
+        return encode_float(w, term);
+    else if (term == Py_None)
+        return writer_write(w, "d\0\11undefined", 12);
+    else if ((PyObject *)t == OpaqueObject)
+        return encode_bytes_result(w, PyObject_CallMethod(term, "encode",
+            NULL));
+    else if ((PyObject *)t == RawTerm)
+        return encode_raw(w, term);
+    else if (t == &PyDict_Type || (PyObject *)t == Map)
+        return encode_map(w, term);
+    else if ((PyObject *)t == ImproperList) {
+        Py_ssize_t length = PyList_GET_SIZE(term);
+        PyObject *tail;
+        if ((size_t)length > 4294967295U) {
+            PyErr_Format(PyExc_ValueError,
+                "invalid improper list length: %zd", length);
+            return -1;
+        }
+        if (writer_put_header(w, 'l', (uint32_t)length, 4) < 0)
+            return -1;
+        if (encode_items(w, term, length) < 0)
+            return -1;
+        tail = PyObject_GetAttrString(term, "tail");
+        if (tail == NULL)
+            return -1;
+        r = encode_into(w, tail);
+        Py_DECREF(tail);
+        return r;
+    }
+
+    if (PyDict_GET_SIZE(type_codecs)) {
+        PyObject *codec = PyDict_GetItemWithError(type_codecs,
+            (PyObject *)t);
+        if (codec != NULL)
+            return encode_registered(w, term, codec);
+        if (PyErr_Occurred())
+            return -1;
+    }
+    r = encode_other(w, term);
+    if (r <= 0)
+        return r;
+    return encode_bytes_result(w, PyObject_CallFunctionObjArgs(encode_fallback,
+        term, w->options, NULL));
+}
+
+PyDoc_STRVAR(encode_term_doc,
+"encode_term(term) -> bytes\n\
+\n\
+Encode Erlang external term without the version byte.");
+
+static PyObject *
+erlterms_encode_term(PyObject *self, PyObject *term)
+{
+    Writer w = {NULL, 0, 0, NULL, Py_None, STRINGS_CHARLIST};
+    PyObject *result;
+
+    if (check_setup() < 0)
+        return NULL;
+    if (encode_into(&w, term) < 0) {
+        PyMem_Free(w.data);
+        return NULL;
+    }
+    result = PyBytes_FromStringAndSize(w.data, w.len);
+    PyMem_Free(w.data);
+    return result;
+}
+
+PyDoc_STRVAR(encode_term_into_doc,
+"encode_term_into(term, buffer, options=None) -> None\n\
+\n\
+Encode Erlang external term without the version byte appending it to\n\
+the bytearray buffer. options are passed to encode_fallback.");
+
+static PyObject *
+erlterms_encode_term_into(PyObject *self, PyObject *args)
+{
+    PyObject *term, *buffer, *options = Py_None;
+    Py_ssize_t start;
+    Writer w;
+    int r;
+
+    if (!PyArg_ParseTuple(args, "OO!|O:encode_term_into", &term,
+            &PyByteArray_Type, &buffer, &options))
+        return NULL;
+    if (check_setup() < 0)
+        return NULL;
+    w.options = options;
+    w.strings = string_policy(options);
+    if (w.strings < 0)
+        return NULL;
+    /* The buffer is grown with PyByteArray_Resize() as needed and cut
+       down to the encoded data at the end */
+    start = PyByteArray_GET_SIZE(buffer);
+    w.data = PyByteArray_AS_STRING(buffer);
+    w.len = start;
+    w.size = start;
+    w.target = buffer;
+    r = encode_into(&w, term);
+    if (PyByteArray_GET_SIZE(buffer) == w.size) {
+        if (PyByteArray_Resize(buffer, r < 0 ? start : w.len) < 0)
+            return NULL;
+    }
+    if (r < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(setup_doc,
+"setup(Atom, List, Map, ImproperList, OpaqueObject, IncompleteData,\n\
+      encode_fallback, type_codecs, tag_decoders, record_decoders,\n\
+      RawTerm)\n\
+\n\
+Bind the codec to the data types defined in erlport.erlterms.\n\
+type_codecs maps types to (encode, tag) tuples, or (encode, tag, names,\n\
+keys) tuples of record_codec(), and tag_decoders maps\n\
+tags to decode functions of the registered types. record_decoders maps\n\
+record tags to (tuple size, decode) tuples.\n\
+encode_fallback(term, options) is called for terms without a native\n\
+encoding and should return the encoded term as bytes.");
+
+static PyObject *
+erlterms_setup(PyObject *self, PyObject *args)
+{
+    PyObject *atom, *list, *map, *improper_list, *opaque_object;
+    PyObject *incomplete_data, *fallback, *marker, *decode;
+    PyObject *codecs, *decoders, *records, *raw_term;
+
+    if (!PyArg_ParseTuple(args, "OOOOOOOO!O!O!O:setup", &atom, &list, &map,
+            &improper_list, &opaque_object, &incomplete_data, &fallback,
+            &PyDict_Type, &codecs, &PyDict_Type, &decoders,
+            &PyDict_Type, &records, &raw_term))
+        return NULL;
+    marker = PyObject_GetAttrString(opaque_object, "marker");
+    if (marker == NULL)
+        return NULL;
+    decode = PyObject_GetAttrString(opaque_object, "decode");
+    if (decode == NULL) {
+        Py_DECREF(marker);
+        return NULL;
+    }
+    Py_XSETREF(Atom, Py_NewRef(atom));
+    Py_XSETREF(List, Py_NewRef(list));
+    Py_XSETREF(Map, Py_NewRef(map));
+    Py_XSETREF(ImproperList, Py_NewRef(improper_list));
+    Py_XSETREF(OpaqueObject, Py_NewRef(opaque_object));
+    Py_XSETREF(RawTerm, Py_NewRef(raw_term));
+    Py_XSETREF(IncompleteData, Py_NewRef(incomplete_data));
+    Py_XSETREF(encode_fallback, Py_NewRef(fallback));
+    Py_XSETREF(opaque_marker, marker);
+    Py_XSETREF(decode_opaque, decode);
+    Py_XSETREF(type_codecs, Py_NewRef(codecs));
+    Py_XSETREF(tag_decoders, Py_NewRef(decoders));
+    Py_XSETREF(record_decoders, Py_NewRef(records));
+    if (ArrayType == NULL) {
+        PyObject *module = PyImport_ImportModule("array");
+        if (module == NULL)
+            return NULL;
+        ArrayType = PyObject_GetAttrString(module, "array");
+        Py_DECREF(module);
+        if (ArrayType == NULL)
+            return NULL;
+    }
+    if (empty_args == NULL) {
+        empty_args = PyTuple_New(0);
+        if (empty_args == NULL)
+            return NULL;
+    }
+    if (tail_name == NULL) {
+        tail_name = PyUnicode_InternFromString("tail");
+        if (tail_name == NULL)
+            return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef erlterms_methods[] = {
+    {"setup", erlterms_setup, METH_VARARGS, setup_doc},
+    {"decode_term", erlterms_decode_term, METH_O, decode_term_doc},
+    {"decode_term_at", erlterms_decode_term_at, METH_VARARGS,
+        decode_term_at_doc},
+    {"decode_columns_at", erlterms_decode_columns_at, METH_VARARGS,
+        decode_columns_at_doc},
+    {"skip_term_at", erlterms_skip_term_at, METH_VARARGS,
+        skip_term_at_doc},
+    {"encode_term", erlterms_encode_term, METH_O, encode_term_doc},
+    {"encode_term_into", erlterms_encode_term_into, METH_VARARGS,
+        encode_term_into_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef erlterms_module = {
+    PyModuleDef_HEAD_INIT,
+    "erlport._erlterms",
+    "Accelerated Erlang external term format codec.",
+    -1,
+    erlterms_methods
+};
+
+PyMODINIT_FUNC
+PyInit__erlterms(void)
+{
+    return PyModule_Create(&erlterms_module);
+}
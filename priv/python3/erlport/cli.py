@@ -42,6 +42,11 @@ def get_option_parser():
             raise OptionValueError("Valid values for --compressed are 0..9")
         setattr(parser.values, option.dest, value)
 
+    def non_negative(option, opt_str, value, parser):
+        if value < 0:
+            raise OptionValueError("%s value should not be negative" % opt_str)
+        setattr(parser.values, option.dest, value)
+
     def buffer_size(option, opt_str, value, parser):
         if not value > 0:
             raise OptionValueError("Buffer size value should be greater than 0")
@@ -59,9 +64,39 @@ def get_option_parser():
         help="Use file descriptors 0 and 1 for communication with Erlang")
     parser.add_option("--compressed", action="callback", type="int", default=0,
         help="Compression level", metavar="LEVEL", callback=compress_level)
+    parser.add_option("--compress_threshold", action="callback", type="int",
+        default=0, help="Don't compress messages smaller than SIZE bytes",
+        metavar="SIZE", callback=non_negative)
+    parser.add_option("--compress_sample", action="callback", type="int",
+        default=0, help="Compress only every Nth message of the message "
+        "types which don't compress", metavar="N", callback=non_negative)
+    parser.add_option("--coalesce_latency", action="callback", type="int",
+        default=0, help="Coalesce outgoing messages and write them at most "
+        "USEC microseconds later", metavar="USEC", callback=non_negative)
+    parser.add_option("--coalesce_size", action="callback", type="int",
+        default=65536, help="Write the coalesced outgoing messages as soon "
+        "as SIZE bytes are pending", metavar="SIZE", callback=non_negative)
+    parser.add_option("--async_write", action="store_true", default=False,
+        help="Write outgoing messages from a background thread")
+    parser.add_option("--high_watermark", action="callback", type="int",
+        default=4194304, help="Outgoing queue is full once SIZE bytes are "
+        "queued", metavar="SIZE", callback=non_negative)
+    parser.add_option("--low_watermark", action="callback", type="int",
+        default=1048576, help="Full outgoing queue accepts messages again "
+        "once drained to SIZE bytes", metavar="SIZE", callback=non_negative)
+    parser.add_option("--overflow", type="choice", choices=["block", "raise"],
+        default="block", help="What writes do when the outgoing queue is "
+        "full. Valid values are block or raise", metavar="POLICY")
+    parser.add_option("--drain_timeout", action="callback", type="int",
+        default=5000, help="Drop the outgoing queue if it isn't written in "
+        "MSEC milliseconds on exit", metavar="MSEC", callback=non_negative)
     parser.add_option("--buffer_size", action="callback", type="int",
         default=65536, help="Receive buffer size", metavar="SIZE",
         callback=buffer_size)
+    parser.add_option("--strings", type="choice",
+        choices=["charlist", "binary", "auto"], default="charlist",
+        help="String policy. Valid values are charlist, binary, or auto",
+        metavar="POLICY")
     return parser
 
 
@@ -69,7 +104,16 @@ def main(argv=None):
     parser = get_option_parser()
     options, args = parser.parse_args(argv)
     port = Port(use_stdio=options.stdio, packet=options.packet,
-        compressed=options.compressed, buffer_size=options.buffer_size)
+        compressed=options.compressed, buffer_size=options.buffer_size,
+        strings=options.strings,
+        compress_threshold=options.compress_threshold,
+        compress_sample=options.compress_sample,
+        coalesce_latency=options.coalesce_latency,
+        coalesce_size=options.coalesce_size,
+        async_write=options.async_write,
+        high_watermark=options.high_watermark,
+        low_watermark=options.low_watermark, overflow=options.overflow,
+        drain_timeout=options.drain_timeout)
     erlang.setup(port)
 
 
@@ -25,14 +25,18 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+from functools import wraps
 from inspect import getfullargspec
 import sys
 from sys import exc_info
 from traceback import extract_tb, format_list
 from threading import Lock
+from collections import deque
 import uuid
 
 from erlport import Atom
+from erlport.erlterms import LazyTerm, RawTerm, decode, encode_into
+from erlport.erlterms import encode_term
 
 
 class Error(Exception):
@@ -101,6 +105,10 @@ class MessageHandler(object):
         self.set_default_message_handler()
         self._self = None
         self.responses = Responses()
+        # Messages received in a burst by port.read_many() and not handled
+        # yet
+        self._received = deque()
+        self._receive_lock = Lock()
 
     def new_message_id(self):
         return uuid.uuid4().int
@@ -119,6 +127,40 @@ class MessageHandler(object):
         self._check_handler(decoder)
         self.decoder = decoder
 
+    def set_decode_options(self, **options):
+        """Change decoding of incoming messages.
+
+        Accepts the keyword arguments of erlport.erlterms.decode(). With
+        lazy=True only the arguments of incoming calls are left lazy. With
+        plain=True incoming lists and maps are passed as plain list and
+        dict objects which are faster to build. With arrays=True lists of
+        floats and integers are passed as array.array objects. Ports with
+        incremental decoding don't support binary_view and lazy.
+        """
+        allowed = getfullargspec(decode).args[1:]
+        for name in options:
+            if name not in allowed:
+                raise ValueError("unknown decode option: %r" % (name,))
+        if (getattr(self.port, "incremental", False)
+                and (options.get("binary_view") or options.get("lazy"))):
+            raise ValueError("incremental decoding doesn't support binary"
+                " views and lazy terms")
+        self.port.decode_options.update(options)
+
+    def set_encode_options(self, **options):
+        """Change encoding of outgoing messages.
+
+        Accepts the keyword arguments of erlport.erlterms.encode_into()
+        except compressed and compress_threshold, which are set for the
+        whole port.
+        """
+        allowed = getfullargspec(encode_into).args[3:]
+        allowed.remove("compress_threshold")
+        for name in options:
+            if name not in allowed:
+                raise ValueError("unknown encode option: %r" % (name,))
+        self.port.encode_options.update(options)
+
     def set_default_message_handler(self):
         self.handler = lambda o: None
 
@@ -144,15 +186,32 @@ class MessageHandler(object):
 
     def _receive(self, expect_id=None, expect_message=False):
         marker = object()
+        received = self._received
+        responses = self.responses
         while True:
-            expected = self.responses.get(expect_id, marker)
-            if expected is not marker:
-                return expected
-            message = self.port.read()
-            try:
-                mtype = message[0]
-            except (IndexError, TypeError):
-                raise InvalidMessage(message)
+            # Responses are looked up, read and stored under one lock, so a
+            # caller never blocks on reading while its response is received
+            with self._receive_lock:
+                expected = responses.get(expect_id, marker)
+                if expected is not marker:
+                    return expected
+                if not received:
+                    # Nothing is left to handle, so don't keep the coalesced
+                    # responses waiting
+                    self.port.flush()
+                    received.extend(self.port.read_many())
+                message = received.popleft()
+                if type(message) is LazyTerm:
+                    message = self._unlazy(message)
+                try:
+                    mtype = message[0]
+                except (IndexError, TypeError):
+                    raise InvalidMessage(message)
+                if mtype == b"r" or mtype == b"e":
+                    expected = responses.put(expect_id, message, marker)
+                    if expected is not marker:
+                        return expected
+                    continue
 
             if mtype == b"C":
                 try:
@@ -169,13 +228,16 @@ class MessageHandler(object):
                 except ValueError:
                     raise InvalidMessage(message)
                 self._call_with_error_handler(None, self.handler, payload)
-            elif mtype == b"r" or mtype == b"e":
-                expected = self.responses.put(expect_id, message, marker)
-                if expected is not marker:
-                    return expected
             else:
                 raise UnknownMessage(message)
 
+    def _unlazy(self, message):
+        # Keep only the arguments of incoming calls lazy
+        if (message.type is tuple and len(message) == 5
+                and message[0] == b"C"):
+            return tuple(message)
+        return message.decode()
+
     def cast(self, pid, message):
         # It's safe to call it from multiple threads because port.write will be
         # locked
@@ -225,8 +287,20 @@ class MessageHandler(object):
             f = __import__(mod, {}, {}, [objects[0]])
         for o in objects:
             f = getattr(f, o)
-        result = Atom(b"r"), mid, self.encoder(f(*map(self.decoder, args)))
-        self.port.write(result)
+        raw = getattr(f, "raw_args", None)
+        if raw and type(args) is LazyTerm:
+            # Leave the arguments requested by rawargs() undecoded
+            positions = range(len(args))
+            raw = {positions[i] for i in raw if -len(args) <= i < len(args)}
+            args = [args.raw(i) if i in raw else self.decoder(args[i])
+                for i in positions]
+        else:
+            args = map(self.decoder, args)
+        result = Atom(b"r"), mid, self.encoder(f(*args))
+        if getattr(f, "stream_result", False):
+            self.port.write_stream(result)
+        else:
+            self.port.write(result)
 
     def _call_with_error_handler(self, mid, function, *args):
         try:
@@ -243,11 +317,68 @@ class MessageHandler(object):
                 result = Atom(b"e"), error
             self.port.write(result)
 
+def iterargs(*positions):
+    """Decorator passing the given list arguments as iterators.
+
+    With lazy decoding of incoming calls enabled (see set_decode_options)
+    list elements are decoded one by one while the function iterates over
+    them, so a huge list is never held in memory decoded as a whole.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args):
+            args = list(args)
+            for i in positions:
+                arg = args[i]
+                if type(arg) is LazyTerm:
+                    args[i] = arg.iterdecode()
+                else:
+                    args[i] = iter(arg)
+            return function(*args)
+        return wrapper
+    return decorator
+
+def rawargs(*positions):
+    """Decorator passing the given arguments as erlport.erlterms.RawTerm.
+
+    With lazy decoding of incoming calls enabled (see set_decode_options)
+    the arguments are sliced out of the received data without decoding,
+    and passing them to cast() or returning them sends the same bytes
+    back to Erlang. Otherwise they are encoded again.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args):
+            args = list(args)
+            for i in positions:
+                if type(args[i]) is not RawTerm:
+                    args[i] = RawTerm(encode_term(args[i]))
+            return function(*args)
+        wrapper.raw_args = positions
+        return wrapper
+    return decorator
+
+def streamed(function):
+    """Decorator sending the result with erlport.erlproto.Port.write_stream.
+
+    The result is written in chunks as it's encoded instead of being built
+    whole in memory first. erlport.erlterms.StreamedList items and mmap
+    objects in the result are never held in memory all at once. An error
+    raised while the result is being written can't be reported to Erlang
+    and closes the port.
+    """
+    @wraps(function)
+    def wrapper(*args):
+        return function(*args)
+    wrapper.stream_result = True
+    return wrapper
+
 def setup_api_functions(handler):
     global call, cast, self, make_ref
     global set_default_encoder, set_default_decoder
     global set_default_message_handler
     global set_encoder, set_decoder, set_message_handler
+    global set_decode_options, set_encode_options
     call = handler.call
     cast = handler.cast
     self = handler.self
@@ -255,6 +386,8 @@ def setup_api_functions(handler):
     set_encoder = handler.set_encoder
     set_decoder = handler.set_decoder
     set_message_handler = handler.set_message_handler
+    set_decode_options = handler.set_decode_options
+    set_encode_options = handler.set_encode_options
     set_default_encoder = handler.set_default_encoder
     set_default_decoder = handler.set_default_decoder
     set_default_message_handler = handler.set_default_message_handler
@@ -31,10 +31,84 @@ __author__ = "Dmitry Vasiliev <dima@hlabs.org>"
 
 import os
 import errno
+from collections import deque
+from queue import Full
 from struct import Struct
-from threading import Lock
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep
 
-from erlport.erlterms import encode, decode
+from erlport.erlterms import Atom, encode_into, encode_stream, decode
+from erlport.erlterms import IncrementalDecoder
+
+
+def _message_class(message, tuple=tuple, Atom=Atom, type=type, len=len):
+    # Key of the compression stats of the message: the message type and for
+    # call results and casts the type of the payload and its tag if it's a
+    # tagged tuple, or the called function for calls
+    if type(message) is not tuple or not message:
+        return None
+    mtype = message[0]
+    if type(mtype) is not Atom:
+        return None
+    if len(message) == 3 and (mtype == b"r" or mtype == b"M"):
+        payload = message[2]
+        ptype = type(payload)
+        if ptype is tuple and payload and type(payload[0]) is Atom:
+            return mtype, ptype, payload[0]
+        return mtype, ptype
+    if len(message) == 6 and mtype == b"C":
+        return mtype, message[2], message[3]
+    return mtype
+
+
+class _CompressionStats(object):
+    """Compression ratios of outgoing messages by message class.
+
+    A class whose messages shrink by less than a tenth on average is only
+    compressed for every sample-th message, which keeps its ratio up to
+    date in case its data becomes compressible again.
+    """
+
+    def __init__(self, sample, limit=0.9, weight=0.25):
+        self.sample = sample
+        self.limit = limit
+        self.weight = weight
+        self.ratios = {}
+        self.skipped = {}
+
+    def should_compress(self, key):
+        ratio = self.ratios.get(key)
+        if ratio is None or ratio < self.limit:
+            return True
+        skipped = self.skipped.get(key, 0) + 1
+        if skipped >= self.sample:
+            skipped = 0
+        self.skipped[key] = skipped
+        return not skipped
+
+    def update(self, key, ratio):
+        previous = self.ratios.get(key)
+        if previous is not None:
+            ratio = previous + (ratio - previous) * self.weight
+        self.ratios[key] = ratio
+
+
+_size_unpack_from = Struct(b">I").unpack_from
+
+# Not available on Windows
+_has_readv = hasattr(os, "readv")
+_has_writev = hasattr(os, "writev")
+
+
+def _decode_frame(frame, options):
+    if type(frame) is memoryview:
+        # Release the view of the receive buffer right away
+        with frame:
+            term, _tail = decode(frame, **options)
+            del _tail
+        return term
+    term, _tail = decode(frame, **options)
+    return term
 
 
 class Port(object):
@@ -47,16 +121,60 @@ class Port(object):
         }
 
     def __init__(self, packet=4, use_stdio=True, compressed=False,
-            descriptors=None, buffer_size=65536):
+            descriptors=None, buffer_size=65536, binary_view=False,
+            lazy=False, plain=False, strings="charlist", incremental=False,
+            arrays=False, compress_threshold=0, compress_sample=0,
+            coalesce_latency=0, coalesce_size=65536, async_write=False,
+            high_watermark=4194304, low_watermark=1048576, overflow="block",
+            drain_timeout=5000):
         if buffer_size < 1:
             raise ValueError("invalid buffer size value: %s" % (buffer_size,))
+        if compress_threshold < 0:
+            raise ValueError("invalid compress threshold value: %s"
+                % (compress_threshold,))
+        if compress_sample < 0:
+            raise ValueError("invalid compress sample value: %s"
+                % (compress_sample,))
+        if coalesce_latency < 0:
+            raise ValueError("invalid coalesce latency value: %s"
+                % (coalesce_latency,))
+        if coalesce_size < 0:
+            raise ValueError("invalid coalesce size value: %s"
+                % (coalesce_size,))
+        if not 0 <= low_watermark <= high_watermark:
+            raise ValueError("invalid watermark values: %s, %s"
+                % (low_watermark, high_watermark))
+        if overflow not in ("block", "raise"):
+            raise ValueError("invalid overflow value: %r" % (overflow,))
+        if drain_timeout < 0:
+            raise ValueError("invalid drain timeout value: %s"
+                % (drain_timeout,))
         struct = self._formats.get(packet)
         if struct is None:
             raise ValueError("invalid packet size value: %s" % (packet,))
         self.__pack = struct.pack
-        self.__unpack = struct.unpack
+        self.__unpack_from = struct.unpack_from
         self.packet = packet
         self.compressed = compressed
+        # Messages smaller than compress_threshold bytes are never
+        # compressed. If compress_sample is set, compression ratios are
+        # tracked by message class, see _message_class(), and classes which
+        # don't compress are only compressed for every compress_sample-th
+        # message.
+        self.compress_threshold = compress_threshold
+        if compress_sample:
+            self.__compression_stats = _CompressionStats(compress_sample)
+        else:
+            self.__compression_stats = None
+        # Keyword arguments for erlport.erlterms.decode(). Binary views and
+        # lazy terms reference the received frame, so with them every frame
+        # is read into a new buffer which is never modified afterwards and
+        # they stay valid for as long as they are referenced.
+        self.decode_options = {"binary_view": binary_view, "lazy": lazy,
+            "plain": plain, "strings": strings, "arrays": arrays}
+        # Keyword arguments for erlport.erlterms.encode_into() besides
+        # compressed and compress_threshold
+        self.encode_options = {"strings": strings}
 
         if descriptors is not None:
             self.in_d, self.out_d = descriptors
@@ -65,10 +183,55 @@ class Port(object):
         else:
             self.in_d, self.out_d = 3, 4
 
-        self.__buffer = b""
+        # Frames which fit are read into and decoded straight from this
+        # buffer, data[start:end] is received but not yet used
+        self.__buffer = bytearray(max(buffer_size, packet))
+        self.__start = self.__end = 0
+        # Decode terms while their frames are still arriving. Incremental
+        # decoding doesn't support binary views and lazy terms.
+        self.incremental = incremental
+        if incremental:
+            self.__decoder = IncrementalDecoder(packet)
+            self.__decoder.set_options(**self.decode_options)
+            self.__decoder_options = dict(self.decode_options)
+        else:
+            self.__decoder = None
+        self.__terms = deque()
         self.buffer_size = buffer_size
         self.__read_lock = Lock()
         self.__write_lock = Lock()
+        # If coalesce_latency is set, written messages from all threads are
+        # gathered and written together as soon as coalesce_size bytes are
+        # pending or coalesce_latency microseconds after the first of them,
+        # whichever comes first. The delay is paid by a background thread
+        # started with the first coalesced write.
+        self.coalesce_latency = coalesce_latency
+        self.coalesce_size = coalesce_size
+        # In asynchronous mode write() only queues the message and the
+        # background thread writes the queue as fast as the pipe allows.
+        # Once high_watermark bytes are queued the queue is full until it's
+        # drained down to low_watermark bytes, and write() either blocks or
+        # raises queue.Full depending on overflow. close() waits at most
+        # drain_timeout milliseconds for the queue to be written, so a peer
+        # which stopped reading can't block it forever.
+        self.async_write = async_write
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.overflow = overflow
+        self.drain_timeout = drain_timeout
+        self.__pending = bytearray()
+        # Queued bytes including the ones being written
+        self.__queued = 0
+        self.__full = False
+        self.__pending_lock = Lock()
+        self.__pending_ready = Condition(self.__pending_lock)
+        self.__drained = Condition(self.__pending_lock)
+        self.__writer = None
+        self.__writer_done = False
+        # Whether the writer thread closes out_d once it's done
+        self.__writer_closes = False
+        self.__write_error = None
+        self.__output_closed = False
 
     def _read_data(self):
         try:
@@ -81,38 +244,374 @@ class Port(object):
             raise EOFError()
         return buf
 
+    def _read_into(self, view):
+        try:
+            if _has_readv:
+                n = os.readv(self.in_d, [view])
+            else:
+                data = os.read(self.in_d, len(view))
+                n = len(data)
+                view[:n] = data
+        except OSError as why:
+            if why.errno in (errno.EPIPE, errno.EINVAL):
+                raise EOFError()
+            raise
+        if not n:
+            raise EOFError()
+        return n
+
+    def _fill(self, size):
+        # Make sure that at least size bytes are buffered, moving the
+        # buffered data to the start of the buffer if needed
+        buffer = self.__buffer
+        start = self.__start
+        end = self.__end
+        if len(buffer) - start < size:
+            buffer[:end - start] = buffer[start:end]
+            end -= start
+            start = self.__start = 0
+        with memoryview(buffer) as view:
+            while end - start < size:
+                end += self._read_into(view[end:])
+                self.__end = end
+        return start
+
     def read(self):
         """Read incoming message."""
-        packet = self.packet
+        options = self.decode_options
+        with self.__read_lock:
+            if self.__decoder is not None:
+                terms = self.__terms
+                while not terms:
+                    terms.extend(self._feed_decoder(options))
+                return terms.popleft()
+            frame = self._next_frame(options)
+            if type(frame) is memoryview:
+                return _decode_frame(frame, options)
+        return _decode_frame(frame, options)
+
+    def read_many(self):
+        """Read all incoming messages which are already received.
+
+        Block until at least one message arrives and return the list of it
+        and all the messages which followed it in the same reads.
+        """
+        options = self.decode_options
         with self.__read_lock:
+            if self.__decoder is not None:
+                terms = self.__terms
+                while not terms:
+                    terms.extend(self._feed_decoder(options))
+                result = list(terms)
+                terms.clear()
+                return result
+            result = [_decode_frame(self._next_frame(options), options)]
+            # Then decode the frames which are already buffered whole
+            packet = self.packet
             buffer = self.__buffer
-            while len(buffer) < packet:
-                buffer += self._read_data()
-            length = self.__unpack(buffer[:packet])[0] + packet
-            while len(buffer) < length:
-                buffer += self._read_data()
-            term, self.__buffer = decode(buffer[packet:])
-        return term
+            unpack_from = self.__unpack_from
+            own = options.get("binary_view") or options.get("lazy")
+            start = self.__start
+            end = self.__end
+            with memoryview(buffer) as view:
+                while end - start >= packet:
+                    length, = unpack_from(buffer, start)
+                    offset = start + packet
+                    if end - offset < length:
+                        break
+                    frame = view[offset:offset + length]
+                    if own:
+                        frame = bytearray(frame)
+                    try:
+                        term, _tail = decode(frame, **options)
+                    except Exception:
+                        # The frame is left in the buffer, so the error is
+                        # raised by the next read
+                        break
+                    finally:
+                        del frame
+                    del _tail
+                    result.append(term)
+                    start = offset + length
+            self.__start = start
+        return result
+
+    def _feed_decoder(self, options):
+        decoder = self.__decoder
+        if options != self.__decoder_options:
+            # Changed since the last read, see erlang.set_decode_options()
+            decoder.set_options(**options)
+            self.__decoder_options = dict(options)
+        return decoder.feed(self._read_data())
+
+    def _next_frame(self, options):
+        # Return the next frame, either a memoryview of the receive buffer
+        # which must be decoded before the next read or a buffer of its own
+        packet = self.packet
+        start = self.__start
+        if self.__end - start < packet:
+            start = self._fill(packet)
+        buffer = self.__buffer
+        length, = self.__unpack_from(buffer, start)
+        start = self.__start = start + packet
+        if (length <= len(buffer) and not options.get("binary_view")
+                and not options.get("lazy")):
+            # Decoded terms don't reference the frame, so it's decoded
+            # right in the buffer
+            if self.__end - start < length:
+                start = self._fill(length)
+            self.__start = start + length
+            return memoryview(buffer)[start:start + length]
+        return self._read_frame(length)
+
+    def _read_frame(self, length):
+        # Read the frame into a new buffer of its own copying only the part
+        # which is already buffered
+        frame = bytearray(length)
+        start = self.__start
+        n = min(self.__end - start, length)
+        frame[:n] = memoryview(self.__buffer)[start:start + n]
+        self.__start = start + n
+        with memoryview(frame) as view:
+            while n < length:
+                n += self._read_into(view[n:])
+        return frame
 
     def write(self, message):
         """Write outgoing message."""
-        data = encode(message, compressed=self.compressed)
-        length = len(data)
-        data = self.__pack(length) + data
-        with self.__write_lock:
-            while data:
+        packet = self.packet
+        compressed = self.compressed
+        stats = self.__compression_stats
+        if compressed and stats is not None:
+            key = _message_class(message)
+            if not stats.should_compress(key):
+                compressed = 0
+        # Reserve space for the length prefix and encode the message after it
+        data = bytearray(packet)
+        length = encode_into(message, data, compressed=compressed,
+            compress_threshold=self.compress_threshold, **self.encode_options)
+        if compressed and stats is not None:
+            if data[packet + 1] == 80:
+                # Compressed term, its uncompressed size follows the tag
+                size, = _size_unpack_from(data, packet + 2)
+                stats.update(key, (length - 1) / size)
+            elif length > self.compress_threshold:
+                stats.update(key, 1.0)
+        data[:packet] = self.__pack(length)
+        if self.coalesce_latency or self.async_write:
+            self._queue_data(data)
+        else:
+            with self.__write_lock:
+                self._write_data(data)
+        return length + packet
+
+    def _queue_data(self, data):
+        with self.__pending_lock:
+            if self.__full and self.__write_error is None:
+                if self.overflow == "raise":
+                    raise Full("%s bytes queued" % (self.__queued,))
+                while self.__full and self.__write_error is None:
+                    self.__drained.wait()
+            error = self.__write_error
+            if error is not None:
+                raise error
+            pending = self.__pending
+            first = not pending
+            pending += data
+            self.__queued += len(data)
+            if self.async_write:
+                if self.__queued >= self.high_watermark:
+                    self.__full = True
+                full = False
+            else:
+                full = len(pending) >= self.coalesce_size
+            if first and not full:
+                if self.__writer is None:
+                    self.__writer = Thread(target=self._write_queued,
+                        name="erlport-writer")
+                    self.__writer.daemon = True
+                    self.__writer.start()
+                self.__pending_ready.notify()
+        if full:
+            self.flush()
+
+    def _write_queued(self):
+        # Write the queued messages right away in asynchronous mode or
+        # coalesce_latency microseconds after the first of them unless they
+        # were written already. A write error is raised by the next write.
+        latency = 0 if self.async_write else self.coalesce_latency / 1e6
+        ready = self.__pending_ready
+        try:
+            while True:
+                with ready:
+                    while not self.__pending and not self.__output_closed:
+                        ready.wait()
+                    if self.__output_closed:
+                        return
+                if latency:
+                    sleep(latency)
                 try:
-                    n = os.write(self.out_d, data)
-                except OSError as why:
-                    if why.errno in (errno.EPIPE, errno.EINVAL):
-                        raise EOFError()
-                    raise
-                if not n:
-                    raise EOFError()
-                data = data[n:]
+                    with self.__write_lock:
+                        self._write_pending()
+                except Exception as why:
+                    with ready:
+                        if not self.__output_closed:
+                            self.__write_error = why
+                        self.__drained.notify_all()
+                    return
+        finally:
+            with ready:
+                self.__writer_done = True
+                if self.__writer_closes:
+                    os.close(self.out_d)
+
+    def flush(self):
+        """Write the coalesced outgoing messages right away.
+
+        In asynchronous mode the writer thread doesn't wait anyway, so
+        nothing is done.
+        """
+        if self.async_write or not self.__pending:
+            return
+        with self.__write_lock:
+            self._write_pending()
+
+    def _write_pending(self):
+        with self.__pending_lock:
+            data = self.__pending
+            if not data:
+                return
+            self.__pending = bytearray()
+        try:
+            self._write_data(data)
+        finally:
+            with self.__pending_lock:
+                queued = self.__queued = self.__queued - len(data)
+                if not queued or (self.__full
+                        and queued <= self.low_watermark):
+                    self.__full = False
+                    self.__drained.notify_all()
+
+    def _drain(self):
+        # Wait for the writer thread to write the queue. Return False if it
+        # isn't written in drain_timeout milliseconds.
+        deadline = monotonic() + self.drain_timeout / 1e3
+        with self.__pending_lock:
+            while self.__queued and self.__write_error is None:
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    return False
+                self.__drained.wait(timeout)
+        return True
+
+    def write_stream(self, message):
+        """Write outgoing message without building it whole in memory.
+
+        The message is encoded with erlport.erlterms.encode_stream(), so
+        it's walked twice and written in chunks after its length. Large
+        binaries and mmap objects are written straight from their memory.
+        Compressed ports write the message with write().
+
+        If the message fails to be encoded after its first chunk is written,
+        the rest of the frame can't be sent, so the output is closed and
+        every following write raises EOFError.
+        """
+        if self.compressed:
+            return self.write(message)
+        length, chunks = encode_stream(message, **self.encode_options)
+        with self.__write_lock:
+            # Keep the order of the coalesced messages written before
+            self._write_pending()
+            # The length goes out with the first chunk
+            head = self.__pack(length)
+            written = 0
+            try:
+                for chunk in chunks:
+                    written += len(chunk)
+                    if written > length:
+                        break
+                    if head:
+                        self._write_data(head, chunk)
+                        head = None
+                    else:
+                        self._write_data(chunk)
+                if written != length:
+                    raise ValueError("message changed while being written")
+            except BaseException:
+                if head is None:
+                    self._abort_output()
+                raise
         return length + self.packet
 
+    def _abort_output(self):
+        # Close the output after a partially written frame, so Erlang sees
+        # the port closed instead of a corrupted stream
+        if self.__write_error is None:
+            self.__write_error = EOFError("output closed after a partially"
+                " written message")
+        if not self.__output_closed:
+            self.__output_closed = True
+            os.close(self.out_d)
+
+    def _write_data(self, *buffers):
+        # Write the non-empty buffers with a single system call if possible.
+        # After a partial write the rest of the buffer is sliced off with
+        # memoryview, so the data is never copied.
+        while buffers:
+            # The output may be closed by close() while the writer thread
+            # waits for the pipe
+            if self.__output_closed:
+                raise self.__write_error
+            try:
+                if len(buffers) > 1 and _has_writev:
+                    n = os.writev(self.out_d, buffers)
+                else:
+                    n = os.write(self.out_d, buffers[0])
+            except OSError as why:
+                if why.errno in (errno.EPIPE, errno.EINVAL):
+                    raise EOFError()
+                raise
+            if not n:
+                raise EOFError()
+            i = 0
+            for data in buffers:
+                size = len(data)
+                if n < size:
+                    break
+                n -= size
+                i += 1
+            if n:
+                buffers = (memoryview(buffers[i]).cast("B")[n:],) \
+                    + tuple(buffers[i + 1:])
+            else:
+                buffers = buffers[i:]
+
     def close(self):
-        """Close port."""
-        os.close(self.in_d)
-        os.close(self.out_d)
+        """Close port.
+
+        In asynchronous mode the queued messages are written first unless
+        they aren't written in drain_timeout milliseconds, in which case
+        they're dropped.
+        """
+        try:
+            if self.async_write:
+                if not self._drain():
+                    # Stop the writer thread. If it's still writing, it
+                    # closes out_d itself once done, so the descriptor
+                    # can't be reused by another file while in use.
+                    with self.__pending_lock:
+                        if self.__write_error is None:
+                            self.__write_error = EOFError("port closed")
+                        self.__output_closed = True
+                        self.__drained.notify_all()
+                        self.__pending_ready.notify()
+                        if self.__writer is not None and not self.__writer_done:
+                            self.__writer_closes = True
+                    if not self.__writer_closes:
+                        os.close(self.out_d)
+            else:
+                self.flush()
+        finally:
+            os.close(self.in_d)
+            if not self.__output_closed:
+                os.close(self.out_d)
@@ -34,9 +34,15 @@ See Erlang External Term Format for details:
 __author__ = "Dmitry Vasiliev <dima@hlabs.org>"
 
 from struct import Struct
+from itertools import chain
+from functools import partial
+from collections import Counter
 from array import array
 from zlib import decompressobj, compress
 from pickle import loads, dumps
+from keyword import iskeyword
+from sys import byteorder
+from mmap import mmap
 
 
 # It seems protocol version 2 is supported by all Python versions
@@ -237,7 +243,8 @@ class OpaqueObject(object):
     def decode(cls, data, language):
         if language == b"python":
             return loads(data)
-        return cls(data, language)
+        # Data may be a memoryview if binaries are decoded as views
+        return cls(bytes(data), language)
 
     def encode(self):
         if self.language == b"erlang":
@@ -258,18 +265,275 @@ class OpaqueObject(object):
         return "OpaqueObject(%r, %r)" % (self.data, self.language)
 
 
+class RawTerm(object):
+    """Already encoded Erlang term.
+
+    data is a bytes-like object with the encoded term without the version
+    byte. It's copied to the output by the encoder as is, so forwarding a
+    received term doesn't need to decode and encode it again.
+    """
+
+    __slots__ = "data",
+
+    def __init__(self, data):
+        self.data = data
+
+    def decode(self):
+        """Return decoded term."""
+        term, offset = _decode_term_any(self.data, 0)
+        if offset != len(self.data):
+            raise ValueError("unexpected data after term")
+        return term
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.data == other.data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.__class__, bytes(self.data)))
+
+    def __repr__(self):
+        return "RawTerm(%r)" % (bytes(self.data),)
+
+
+class Columns(object):
+    """Columns encoded as Erlang list of rows.
+
+    columns is either a sequence of equally long columns, which is encoded
+    as a list of tuples, or a dict of columns, which is encoded as a list of
+    maps with the dict keys. This is the reverse of decode_columns().
+    """
+
+    __slots__ = "columns",
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.columns == other.columns
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Columns(%r)" % (self.columns,)
+
+
+class StreamedList(object):
+    """Erlang list of the items produced on demand.
+
+    factory is called without arguments and must return an iterable over
+    the same items every time. encode() calls it once. encode_stream()
+    calls it twice, first to compute the encoded size and then to encode
+    the items, so the items never have to be in memory all at once. The
+    list is always encoded as LIST_EXT, even if it's empty.
+    """
+
+    __slots__ = "factory",
+
+    def __init__(self, factory):
+        self.factory = factory
+
+    def __repr__(self):
+        return "StreamedList(%r)" % (self.factory,)
+
+
+def _new_list(items, new=list.__new__, extend=list.extend):
+    # Trusted List constructor for the decoder. The items are decoded by
+    # the decoder itself and are already immutable, so they are neither
+    # copied into a temporary list nor wrapped again.
+    lst = new(List)
+    extend(lst, items)
+    return lst
+
+
+def _new_map(items, new=dict.__new__, update=dict.update):
+    # Trusted Map constructor for the decoder, see _new_list()
+    d = new(Map)
+    update(d, items)
+    return d
+
+
+def _new_improper_list(items, tail, new=list.__new__, extend=list.extend,
+        setattr=object.__setattr__):
+    # Trusted ImproperList constructor for the decoder, see _new_list()
+    lst = new(ImproperList)
+    extend(lst, items)
+    setattr(lst, "tail", tail)
+    return lst
+
+
+def _map_key(term, type=type, list=list, dict=dict, tuple=tuple,
+        array=array):
+    # Convert map key decoded with the plain or arrays option to what the
+    # default decoder returns for it, so it's hashable. Nested lists and
+    # maps are converted as well.
+    t = type(term)
+    if t is list or t is array:
+        return _new_list([_map_key(v) for v in term])
+    elif t is dict:
+        return _new_map({_map_key(k): _map_key(v) for k, v in term.items()})
+    elif t is tuple:
+        return tuple([_map_key(v) for v in term])
+    return term
+
+
 _python = Atom(b"python")
 
 _int4_unpack = Struct(b">I").unpack
-_int2_unpack = Struct(b">H").unpack
-_signed_int4_unpack = Struct(b">i").unpack
-_float_unpack = Struct(b">d").unpack
-_double_bytes_unpack = Struct(b"BB").unpack
-_int4_byte_unpack = Struct(b">IB").unpack
+_int4_unpack_from = Struct(b">I").unpack_from
+_int2_unpack_from = Struct(b">H").unpack_from
+_signed_int4_unpack_from = Struct(b">i").unpack_from
+_float_unpack_from = Struct(b">d").unpack_from
+_double_bytes_unpack_from = Struct(b"BB").unpack_from
+_int4_byte_unpack_from = Struct(b">IB").unpack_from
+
+
+_missing = object()
+
+STRING_POLICIES = "charlist", "binary", "auto"
+
+# Codecs added by register_type(): type -> (encode, tag) and tag -> decode,
+# and by record_codec(): type -> (encode, tag, attribute names, atom keys or
+# None) and tag -> (tuple size, decode). Shared with the compiled codec.
+_type_codecs = {}
+_tag_decoders = {}
+_record_decoders = {}
+# Record tags of the types whose encoders add the tag themselves, like
+# register_ndarray(): type -> tag, removed by unregister_type()
+_record_tags = {}
+
+# With the binary and auto policies Erlang sends the text it can't send as
+# STRING_EXT as {'$erlport.text', UTF8Binary}, decoded to str whatever the
+# policy of the decoder is. Such tuples with other payloads are decoded as
+# usual.
+_text_tag = Atom(b"$erlport.text")
+
+
+def _check_string_policy(strings):
+    if strings not in STRING_POLICIES:
+        raise ValueError("invalid string policy: %r" % (strings,))
+
+
+class _DecodeOptions(object):
+    """Non-default decoding settings passed down the decoder."""
+
+    __slots__ = "binary_view", "lazy", "plain", "strings", "arrays", "native"
+
+    def __init__(self, binary_view=False, lazy=False, plain=False,
+            strings="charlist", arrays=False):
+        _check_string_policy(strings)
+        self.binary_view = binary_view
+        self.lazy = lazy
+        self.plain = plain
+        self.strings = strings
+        self.arrays = arrays
+        # Whether the compiled decoder can be used for eager decoding
+        self.native = not binary_view
+
+
+def decode(string, binary_view=False, lazy=False, plain=False,
+        strings="charlist", arrays=False):
+    """Decode Erlang external term.
+
+    If binary_view is true binaries are returned as read-only memoryview
+    slices of string instead of bytes copies. Such views keep the whole
+    string alive, and string must not be modified while they are in use.
+
+    If lazy is true tuples, lists and maps are returned as LazyTerm objects
+    which decode their elements on first access. The same rules as for
+    binary views apply to string.
+
+    If plain is true lists and maps are returned as plain list and dict
+    objects instead of List and Map. Lists and maps in map keys are still
+    returned as List and Map at any depth to keep the keys hashable.
+
+    strings is the string policy, one of STRING_POLICIES. With "auto"
+    Erlang strings sent as STRING_EXT are decoded to str instead of List.
+    Note that Erlang sends any short list of small integers that way. When
+    the Erlang side uses the binary or auto policy, the text it doesn't
+    send as STRING_EXT arrives tagged and is decoded to str with any
+    policy, so "binary" differs from "charlist" only on the Erlang side.
+
+    If arrays is true lists of floats are returned as array.array("d") and
+    lists of integers which fit into 64 bits as array.array("q"), except in
+    map keys. So are lists sent as STRING_EXT unless strings is "auto".
+    """
+    options = None
+    if binary_view or lazy or plain or strings != "charlist" or arrays:
+        options = _DecodeOptions(binary_view, lazy, plain, strings, arrays)
+        decode_term = _decode_lazy if lazy else _decode_term_any
+    else:
+        decode_term = _decode_term_any
+    return _decode(string, decode_term, options)
+
+
+def decode_columns(string, binary_view=False, plain=False,
+        strings="charlist", arrays=False):
+    """Decode Erlang list of tuples or maps of the same shape into columns.
+
+    Rows are not built, the values go straight into the columns. A list of
+    N-tuples is returned as a tuple of N columns and a list of maps as a
+    dict mapping the keys to columns. Columns of floats are returned as
+    array.array("d"), columns of integers which fit into 64 bits as
+    array.array("q") and other columns as lists. An empty list is returned
+    as an empty tuple. The keyword arguments are the same as for decode()
+    and apply to the values. See Columns for the reverse encoding.
+    """
+    options = None
+    if binary_view or plain or strings != "charlist" or arrays:
+        options = _DecodeOptions(binary_view, False, plain, strings, arrays)
+    return _decode(string, _decode_columns, options)
+
+
+def extract(string, path, binary_view=False, lazy=False, plain=False,
+        strings="charlist", arrays=False):
+    """Decode only the part of Erlang external term found by path.
+
+    path is a sequence of zero-based tuple or list indexes and map keys,
+    so extract(string, (2, b"key")) returns the value for b"key" of the map
+    which is the third element of the term. Negative indexes count from the
+    end. Sibling terms are skipped by their headers without being decoded.
+    IndexError, KeyError or TypeError is raised if the path doesn't match
+    the term. The keyword arguments are the same as for decode() and apply
+    to the returned value.
+    """
+    options = None
+    if binary_view or lazy or plain or strings != "charlist" or arrays:
+        options = _DecodeOptions(binary_view, lazy, plain, strings, arrays)
+    decode_term = _decode_lazy if lazy else _decode_term_any
+    string, offset, _tail = _unpack(string, binary_view)
+    offset, item = _find_path(string, offset, path)
+    if item is not _missing:
+        return item
+    term, _offset = decode_term(string, offset, options)
+    return term
+
+
+def _decode(string, decode_term, options):
+    binary_view = options is not None and options.binary_view
+    term_string, offset, tail = _unpack(string, binary_view)
+    if tail is not None:
+        # tail data returned by decode_term() can be simple ignored
+        term, _offset = decode_term(term_string, offset, options)
+        return term, tail
+    if binary_view:
+        try:
+            term, offset = decode_term(term_string, offset, options)
+        except IncompleteData:
+            raise IncompleteData(string)
+    else:
+        term, offset = decode_term(string, offset, options)
+    return term, string[offset:]
 
 
-def decode(string):
-    """Decode Erlang external term."""
+def _unpack(string, binary_view):
+    # Return the string holding the term, the offset of the term in it and
+    # the data following the term if the term is compressed or None
     if not string:
         raise IncompleteData(string)
     if string[0] != 131:
@@ -285,144 +549,1073 @@ def decode(string):
             raise ValueError(
                 "invalid compressed tag, "
                 "%d bytes but got %d" % (uncompressed_size, len(term_string)))
-        # tail data returned by decode_term() can be simple ignored
-        term, _tail = decode_term(term_string)
-        return term, d.unused_data
-    return decode_term(string[1:])
+        if binary_view:
+            term_string = memoryview(term_string)
+        return term_string, 0, d.unused_data
+    if binary_view:
+        return memoryview(string).toreadonly(), 1, None
+    return string, 1, None
 
 
-def decode_term(string,
+def _find_path(string, offset, path,
         # Hack to turn globals into locals
-        len=len, ord=ord, tuple=tuple, float=float, array=array,
-        int4_unpack=_int4_unpack, int2_unpack=_int2_unpack,
-        signed_int4_unpack=_signed_int4_unpack, float_unpack=_float_unpack,
-        double_bytes_unpack=_double_bytes_unpack,
-        int4_byte_unpack=_int4_byte_unpack, Atom=Atom,
-        opaque=OpaqueObject.marker, decode_opaque=OpaqueObject.decode):
-    if not string:
+        int4_unpack_from=_int4_unpack_from,
+        int2_unpack_from=_int2_unpack_from):
+    # Return the offset of the term found by path in the term which starts
+    # at offset and _missing, or None and the element of a string found by
+    # the last key of the path
+    item = _missing
+    for key in path:
+        if item is not _missing:
+            raise TypeError("not a tuple, list or map: %r" % (key,))
+        if offset >= len(string):
+            raise IncompleteData(string)
+        tag = string[offset]
+        if tag == 116:
+            # MAP_EXT
+            if len(string) < offset + 5:
+                raise IncompleteData(string)
+            count, = int4_unpack_from(string, offset + 1)
+            offset += 5
+            for _ in range(count):
+                k, offset = _decode_term_any(string, offset)
+                if k == key:
+                    break
+                offset = _skip_term_at(string, offset)
+            else:
+                raise KeyError(key)
+            continue
+        if type(key) is not int:
+            raise TypeError("map key %r used for non-map term" % (key,))
+        if tag == 104:
+            # SMALL_TUPLE_EXT
+            if len(string) < offset + 2:
+                raise IncompleteData(string)
+            count = string[offset + 1]
+            offset += 2
+        elif tag == 105 or tag == 108:
+            # LARGE_TUPLE_EXT, LIST_EXT
+            if len(string) < offset + 5:
+                raise IncompleteData(string)
+            count, = int4_unpack_from(string, offset + 1)
+            offset += 5
+        elif tag == 107:
+            # STRING_EXT, its elements aren't terms on their own
+            if len(string) < offset + 3:
+                raise IncompleteData(string)
+            count, = int2_unpack_from(string, offset + 1)
+            index = range(count)[key]
+            if len(string) < offset + 3 + count:
+                raise IncompleteData(string)
+            item = string[offset + 3 + index]
+            offset = None
+            continue
+        else:
+            raise TypeError("not a tuple, list or map: %r" % (key,))
+        index = range(count)[key]
+        for _ in range(index):
+            offset = _skip_term_at(string, offset)
+    return offset, item
+
+
+def decode_term(string):
+    """Decode Erlang external term without the version byte.
+
+    Return the decoded term and the rest of the string.
+    """
+    term, offset = _decode_term_any(string, 0)
+    return term, string[offset:]
+
+
+def iterdecode(string):
+    """Decode Erlang external term which is a list element by element.
+
+    Return an iterator over the decoded list elements. Elements are decoded
+    on demand and only the current one is kept in memory. ValueError is
+    raised if the term isn't a list or after the last element of an
+    improper list.
+    """
+    # The frame is walked from the offset of the term, so only the
+    # decompressed data of compressed terms is a copy
+    string, offset, _tail = _unpack(string, False)
+    if offset >= len(string):
         raise IncompleteData(string)
-    tag = string[0]
+    tag = string[offset]
+    if tag == 106:
+        # NIL_EXT
+        return iter(())
+    elif tag == 107:
+        # STRING_EXT
+        if len(string) < offset + 3:
+            raise IncompleteData(string)
+        length, = _int2_unpack_from(string, offset + 1)
+        offset += 3
+        if len(string) < offset + length:
+            raise IncompleteData(string)
+        return iter(string[offset:offset + length])
+    elif tag == 108:
+        # LIST_EXT
+        if len(string) < offset + 5:
+            raise IncompleteData(string)
+        length, = _int4_unpack_from(string, offset + 1)
+        return _iter_elements(string, offset + 5, length, None, True)
+    raise ValueError("not a list: %r" % (string[offset:],))
+
+
+def _iter_elements(string, offset, count, options, proper=False):
+    # Yield decoded elements one by one. Proper lists are checked for the
+    # NIL tail after the last element.
+    for _ in range(count):
+        term, offset = _decode_term_any(string, offset, options)
+        yield term
+    if proper:
+        if offset >= len(string):
+            raise IncompleteData(string)
+        if string[offset] != 106:
+            raise ValueError("improper list")
+
+
+def _decode_columns(string, offset, options=None):
+    if options is None or options.native:
+        columns, offset = _decode_columns_at(string, offset, options)
+    else:
+        columns, offset = _py_decode_columns_at(string, offset, options)
+    if type(columns) is dict:
+        count = None
+        for key, column in columns.items():
+            if count is None:
+                count = len(column)
+            elif len(column) != count:
+                raise ValueError("duplicate map key: %r" % (key,))
+            columns[key] = _typed_column(column)
+        return columns, offset
+    return tuple(map(_typed_column, columns)), offset
+
+
+def _py_decode_columns_at(string, offset, options=None,
+        # Hack to turn globals into locals
+        len=len, range=range, int4_unpack_from=_int4_unpack_from):
+    # Walk the list and its rows the same way _py_decode_term() does but
+    # append the row elements to the columns. Return list of the columns or
+    # dict mapping the map keys to the columns.
+    decode_term = _py_decode_term
+    ln = len(string)
+    if offset >= ln:
+        raise IncompleteData(string)
+    tag = string[offset]
+    if tag == 106:
+        return [], offset + 1
+    elif tag != 108:
+        raise ValueError("list expected at offset %d" % offset)
+    if ln < offset + 5:
+        raise IncompleteData(string)
+    count, = int4_unpack_from(string, offset + 1)
+    offset += 5
+    columns = None
+    for _ in range(count):
+        if offset >= ln:
+            raise IncompleteData(string)
+        tag = string[offset]
+        if tag == 104:
+            if ln < offset + 2:
+                raise IncompleteData(string)
+            size = string[offset + 1]
+            offset += 2
+        elif tag == 105 or tag == 116:
+            if ln < offset + 5:
+                raise IncompleteData(string)
+            size, = int4_unpack_from(string, offset + 1)
+            offset += 5
+        else:
+            raise ValueError("tuple or map expected at offset %d" % offset)
+        is_map = tag == 116
+        if columns is None:
+            # The first row defines the shape
+            width = size
+            if is_map:
+                columns = {}
+                for _ in range(size):
+                    key, offset = decode_term(string, offset, options)
+                    value, offset = decode_term(string, offset, options)
+                    columns[key] = [value]
+                if len(columns) != size:
+                    raise ValueError("duplicate map key")
+                continue
+            columns = [[] for _ in range(size)]
+        elif is_map != (type(columns) is dict) or size != width:
+            raise ValueError("row of different shape at offset %d" % offset)
+        if is_map:
+            for _ in range(size):
+                key, offset = decode_term(string, offset, options)
+                column = columns.get(key)
+                if column is None:
+                    raise ValueError("unexpected map key: %r" % (key,))
+                value, offset = decode_term(string, offset, options)
+                column.append(value)
+        else:
+            for column in columns:
+                value, offset = decode_term(string, offset, options)
+                column.append(value)
+    if offset >= ln:
+        raise IncompleteData(string)
+    if string[offset] != 106:
+        raise ValueError("improper list at offset %d" % offset)
+    if columns is None:
+        columns = []
+    return columns, offset + 1
+
+_decode_columns_at = _py_decode_columns_at
+
+
+def _typed_column(values, array=array, set=set, map=map, type=type):
+    types = set(map(type, values))
+    if types == {float}:
+        return array("d", values)
+    elif types == {int}:
+        try:
+            return array("q", values)
+        except OverflowError:
+            pass
+    return values
+
+
+def _decode_term_any(string, offset, options=None):
+    try:
+        if options is None or options.native:
+            return _decode_term(string, offset, options)
+        return _py_decode_term(string, offset, options)
+    except RecursionError:
+        # Too deeply nested for the recursive decoder. The term is decoded
+        # again from the start, so registered decoders of its subterms may
+        # be called twice.
+        return _decode_term_iterative(string, offset, options)
+
+
+def _decode_array(string, offset, length,
+        # Hack to turn globals into locals
+        len=len, range=range, array=array, bytearray=bytearray,
+        signed_int4_unpack_from=_signed_int4_unpack_from,
+        from_bytes=int.from_bytes, swap=byteorder == "little"):
+    # Decode length elements of the proper list which start at offset as
+    # array.array if all of them are floats or integers. Return (array,
+    # offset just past the list) or None. Uniform lists are converted with
+    # a few slice operations instead of decoding element by element.
+    ln = len(string)
+    # The data is checked to hold the whole list before the patterns are
+    # built, so truncated frames can't make them big
+    end = offset + 9 * length
+    if (end < ln and string[end] == 106
+            and string[offset:end:9] == b"F" * length):
+        # NEW_FLOAT_EXT: gather the big-endian doubles
+        data = bytearray(8 * length)
+        for i in range(8):
+            data[i::8] = string[offset + 1 + i:end:9]
+        result = array("d", data)
+        if swap:
+            result.byteswap()
+        return result, end + 1
+    end = offset + 2 * length
+    if (end < ln and string[end] == 106
+            and string[offset:end:2] == b"a" * length):
+        # SMALL_INTEGER_EXT
+        return array("q", array("B", string[offset + 1:end:2])), end + 1
+    # Mix of SMALL_INTEGER_EXT, INTEGER_EXT and SMALL_BIG_EXT
+    result = array("q")
+    append = result.append
+    for _ in range(length):
+        if offset + 2 > ln:
+            return None
+        tag = string[offset]
+        if tag == 97:
+            append(string[offset + 1])
+            offset += 2
+        elif tag == 98 and offset + 5 <= ln:
+            append(signed_int4_unpack_from(string, offset + 1)[0])
+            offset += 5
+        elif tag == 110 and string[offset + 1] <= 8:
+            n = string[offset + 1]
+            if offset + 3 + n > ln:
+                return None
+            value = from_bytes(string[offset + 3:offset + 3 + n], "little")
+            if string[offset + 2]:
+                value = -value
+            if not -0x8000000000000000 <= value <= 0x7fffffffffffffff:
+                return None
+            append(value)
+            offset += 3 + n
+        else:
+            return None
+    if string[offset:offset + 1] != b"j":
+        return None
+    return result, offset + 1
+
+
+def _py_decode_term(string, offset, options=None,
+        # Hack to turn globals into locals
+        len=len, tuple=tuple, int_from_bytes=int.from_bytes,
+        int4_unpack_from=_int4_unpack_from,
+        int2_unpack_from=_int2_unpack_from,
+        signed_int4_unpack_from=_signed_int4_unpack_from,
+        float_unpack_from=_float_unpack_from,
+        double_bytes_unpack_from=_double_bytes_unpack_from,
+        int4_byte_unpack_from=_int4_byte_unpack_from, Atom=Atom,
+        opaque=OpaqueObject.marker, decode_opaque=OpaqueObject.decode,
+        text=_text_tag, binary_types={bytes, memoryview},
+        tag_decoders=_tag_decoders,
+        record_decoders=_record_decoders, new_list=_new_list, new_map=_new_map,
+        new_improper_list=_new_improper_list, map_key=_map_key,
+        decode_array=_decode_array):
+    # Walk the single input buffer with an integer offset so only leaf values
+    # get copied out of it. Return the term and the offset just past it.
+    ln = len(string)
+    if offset >= ln:
+        raise IncompleteData(string)
+    tag = string[offset]
     if tag == 100:
         # ATOM_EXT
-        ln = len(string)
-        if ln < 3:
+        if ln < offset + 3:
             raise IncompleteData(string)
-        length = int2_unpack(string[1:3])[0] + 3
-        if ln < length:
+        start = offset + 3
+        end = start + int2_unpack_from(string, offset + 1)[0]
+        if ln < end:
             raise IncompleteData(string)
-        name = string[3:length]
+        name = bytes(string[start:end])
         if name == b"true":
-            return True, string[length:]
+            return True, end
         elif name == b"false":
-            return False, string[length:]
+            return False, end
         elif name == b"undefined":
-            return None, string[length:]
-        return Atom(name), string[length:]
+            return None, end
+        return Atom(name), end
     elif tag == 106:
         # NIL_EXT
-        return List(), string[1:]
+        if options is not None and options.plain:
+            return [], offset + 1
+        return new_list(()), offset + 1
     elif tag == 107:
         # STRING_EXT
-        ln = len(string)
-        if ln < 3:
+        if ln < offset + 3:
             raise IncompleteData(string)
-        length = int2_unpack(string[1:3])[0] + 3
-        if ln < length:
+        start = offset + 3
+        end = start + int2_unpack_from(string, offset + 1)[0]
+        if ln < end:
             raise IncompleteData(string)
-        return List(string[3:length]), string[length:]
-    elif tag in b"lhi":
+        if options is not None:
+            if options.strings == "auto":
+                return str(string[start:end], "latin-1"), end
+            elif options.arrays and end > start:
+                # Erlang sends short lists of small integers this way
+                return array("q", array("B", string[start:end])), end
+            elif options.plain:
+                return list(string[start:end]), end
+        lst = list(string[start:end])
+        return new_list(lst), end
+    elif tag == 108 or tag == 104 or tag == 105:
         # LIST_EXT, SMALL_TUPLE_EXT, LARGE_TUPLE_EXT
         if tag == 104:
-            if len(string) < 2:
+            if ln < offset + 2:
                 raise IncompleteData(string)
-            length = string[1]
-            tail = string[2:]
+            length = string[offset + 1]
+            offset += 2
         else:
-            if len(string) < 5:
+            if ln < offset + 5:
                 raise IncompleteData(string)
-            length, = int4_unpack(string[1:5])
-            tail = string[5:]
+            length, = int4_unpack_from(string, offset + 1)
+            offset += 5
+            if tag == 108 and options is not None and options.arrays:
+                result = decode_array(string, offset, length)
+                if result is not None:
+                    return result
+        # Every element takes at least one byte
+        if ln < offset + length:
+            raise IncompleteData(string)
         lst = []
         append = lst.append
-        _decode_term = decode_term
+        decode_term = _py_decode_term
         while length > 0:
-            term, tail = _decode_term(tail)
+            term, offset = decode_term(string, offset, options)
             append(term)
             length -= 1
-        lst = List(lst)
         if tag == 108:
-            if not tail:
+            if offset >= ln:
                 raise IncompleteData(string)
-            if tail[0] != 106:
-                improper_tail, tail = _decode_term(tail)
-                return ImproperList(lst, improper_tail), tail
-            return lst, tail[1:]
+            if string[offset] != 106:
+                improper_tail, offset = decode_term(string, offset, options)
+                return new_improper_list(lst, improper_tail), offset
+            if options is not None and options.plain:
+                return lst, offset + 1
+            return new_list(lst), offset + 1
         if len(lst) == 3 and lst[0] == opaque:
-            return decode_opaque(lst[2], lst[1]), tail
-        return tuple(lst), tail
+            return decode_opaque(lst[2], lst[1]), offset
+        elif (len(lst) == 2 and type(lst[0]) is Atom and lst[0] == text
+                and type(lst[1]) in binary_types):
+            return str(lst[1], "utf-8"), offset
+        elif tag_decoders and len(lst) == 2 and type(lst[0]) is Atom:
+            # Tagged tuple of a registered type
+            decode = tag_decoders.get(lst[0])
+            if decode is not None:
+                return decode(lst[1]), offset
+        if record_decoders and lst and type(lst[0]) is Atom:
+            # Record of a type registered with record_codec()
+            record = record_decoders.get(lst[0])
+            if record is not None and record[0] == len(lst):
+                return record[1](*lst[1:]), offset
+        return tuple(lst), offset
     elif tag == 116:
         # MAP_EXT
-        _decode_term = decode_term
-        if len(string) < 5:
+        if ln < offset + 5:
             raise IncompleteData(string)
-        length, = int4_unpack(string[1:5])
-        tail = string[5:]
+        length, = int4_unpack_from(string, offset + 1)
+        offset += 5
+        decode_term = _py_decode_term
         d = {}
         while length > 0:
-            k, tail = _decode_term(tail)
-            v, tail = _decode_term(tail)
-            d[k] = v
+            k, offset = decode_term(string, offset, options)
+            v, offset = decode_term(string, offset, options)
+            try:
+                d[k] = v
+            except TypeError:
+                # Plain lists and maps and arrays can't be keys
+                d[map_key(k)] = v
             length -= 1
-        return Map(d), tail
+        if options is not None and options.plain:
+            return d, offset
+        return new_map(d), offset
     elif tag == 97:
         # SMALL_INTEGER_EXT
-        if len(string) < 2:
+        if ln < offset + 2:
             raise IncompleteData(string)
-        return string[1], string[2:]
+        return string[offset + 1], offset + 2
     elif tag == 98:
         # INTEGER_EXT
-        if len(string) < 5:
+        if ln < offset + 5:
             raise IncompleteData(string)
-        i, = signed_int4_unpack(string[1:5])
-        return i, string[5:]
+        return signed_int4_unpack_from(string, offset + 1)[0], offset + 5
     elif tag == 109:
         # BINARY_EXT
-        ln = len(string)
-        if ln < 5:
+        if ln < offset + 5:
             raise IncompleteData(string)
-        length = int4_unpack(string[1:5])[0] + 5
-        if ln < length:
+        start = offset + 5
+        end = start + int4_unpack_from(string, offset + 1)[0]
+        if ln < end:
             raise IncompleteData(string)
-        return string[5:length], string[length:]
+        if options is not None and options.binary_view:
+            return string[start:end], end
+        return bytes(string[start:end]), end
     elif tag == 70:
         # NEW_FLOAT_EXT
-        if len(string) < 9:
+        if ln < offset + 9:
             raise IncompleteData(string)
-        f, = float_unpack(string[1:9])
-        return f, string[9:]
-    elif tag in b"no":
+        return float_unpack_from(string, offset + 1)[0], offset + 9
+    elif tag == 110 or tag == 111:
         # SMALL_BIG_EXT, LARGE_BIG_EXT
         if tag == 110:
-            if len(string) < 3:
+            if ln < offset + 3:
                 raise IncompleteData(string)
-            length, sign = double_bytes_unpack(string[1:3])
-            tail = string[3:]
+            length, sign = double_bytes_unpack_from(string, offset + 1)
+            start = offset + 3
         else:
-            if len(string) < 6:
+            if ln < offset + 6:
                 raise IncompleteData(string)
-            length, sign = int4_byte_unpack(string[1:6])
-            tail = string[6:]
-        if len(tail) < length:
+            length, sign = int4_byte_unpack_from(string, offset + 1)
+            start = offset + 6
+        end = start + length
+        if ln < end:
             raise IncompleteData(string)
-        n = 0
-        if length:
-            for i in reversed(tail[:length]):
-                n = (n << 8) | i
-            if sign:
-                n = -n
-        return n, tail[length:]
+        n = int_from_bytes(string[start:end], "little")
+        if sign:
+            n = -n
+        return n, end
+
+    raise ValueError("unsupported data: %r" % (string[offset:],))
+
+_decode_term = _py_decode_term
+
+
+def _decode_term_iterative(string, offset, options=None):
+    # Same as _decode_term() but keeps the unfinished containers on an
+    # explicit stack so nesting depth is not limited by the recursion limit
+    done, term, offset = _decode_term_resumable(string, offset, [], options)
+    if not done:
+        raise IncompleteData(string)
+    return term, offset
+
+
+def _decode_term_resumable(string, offset, stack, options=None,
+        # Hack to turn globals into locals
+        len=len, tuple=tuple, zip=zip, map=map,
+        int4_unpack_from=_int4_unpack_from, opaque=OpaqueObject.marker,
+        decode_opaque=OpaqueObject.decode, text=_text_tag,
+        binary_types={bytes, memoryview},
+        tag_decoders=_tag_decoders,
+        record_decoders=_record_decoders, Atom=Atom, new_list=_new_list,
+        new_map=_new_map, new_improper_list=_new_improper_list,
+        map_key=_map_key, decode_array=_decode_array,
+        typed_column=_typed_column, array=array, type=type):
+    # Decode the term which starts at offset keeping the unfinished
+    # containers on the stack. Each stack frame is [tag, items, number of
+    # items still expected]; tag 0 marks a list which waits for its improper
+    # tail. Return (True, term, offset) when the term is complete or
+    # (False, None, offset) when more data is needed. In the latter case the
+    # decoding can be resumed later from the returned offset with the same
+    # stack once more data is appended to string.
+    ln = len(string)
+    plain = options is not None and options.plain
+    arrays = options is not None and options.arrays
+    nothing = _missing
+    value = nothing
+    while True:
+        while stack:
+            frame = stack[-1]
+            if value is not nothing:
+                frame[1].append(value)
+                frame[2] -= 1
+                value = nothing
+            if frame[2] > 0:
+                break
+            tag, items, _ = frame
+            if tag == 108:
+                if offset >= ln:
+                    return False, None, offset
+                stack.pop()
+                if string[offset] != 106:
+                    stack.append([0, items, 1])
+                    break
+                offset += 1
+                if arrays:
+                    # The list may have been received in parts, so
+                    # decode_array() couldn't convert it
+                    value = typed_column(items)
+                    if type(value) is array:
+                        continue
+                value = items if plain else new_list(items)
+            else:
+                stack.pop()
+                if tag == 0:
+                    tail = items.pop()
+                    value = new_improper_list(items, tail)
+                elif tag == 116:
+                    keys = items[::2]
+                    try:
+                        value = dict(zip(keys, items[1::2]))
+                    except TypeError:
+                        # Plain lists and maps and arrays can't be keys
+                        value = dict(zip(map(map_key, keys), items[1::2]))
+                    if not plain:
+                        value = new_map(value)
+                elif len(items) == 3 and items[0] == opaque:
+                    value = decode_opaque(items[2], items[1])
+                elif (len(items) == 2 and type(items[0]) is Atom
+                        and items[0] == text
+                        and type(items[1]) in binary_types):
+                    value = str(items[1], "utf-8")
+                elif (tag_decoders and len(items) == 2
+                        and type(items[0]) is Atom
+                        and items[0] in tag_decoders):
+                    value = tag_decoders[items[0]](items[1])
+                elif (record_decoders and items and type(items[0]) is Atom
+                        and items[0] in record_decoders
+                        and record_decoders[items[0]][0] == len(items)):
+                    value = record_decoders[items[0]][1](*items[1:])
+                else:
+                    value = tuple(items)
+        else:
+            if value is not nothing:
+                return True, value, offset
+
+        if offset >= ln:
+            return False, None, offset
+        tag = string[offset]
+        if tag == 104 or tag == 105 or tag == 108 or tag == 116:
+            start = offset
+            if tag == 104:
+                if ln < offset + 2:
+                    return False, None, offset
+                length = string[offset + 1]
+                offset += 2
+            else:
+                if ln < offset + 5:
+                    return False, None, offset
+                length, = int4_unpack_from(string, offset + 1)
+                offset += 5
+                if tag == 116:
+                    length *= 2
+                elif tag == 108 and arrays:
+                    value = decode_array(string, offset, length)
+                    if value is not None:
+                        value, offset = value
+                        continue
+                    value = nothing
+            # Every tuple or list element takes at least one byte
+            if tag != 116 and ln < offset + length:
+                return False, None, start
+            stack.append([tag, [], length])
+        else:
+            # Leaf terms don't recurse
+            try:
+                value, offset = _py_decode_term(string, offset, options)
+            except IncompleteData:
+                return False, None, offset
+
+
+def _skip_term(string, offset,
+        # Hack to turn globals into locals
+        len=len, int4_unpack_from=_int4_unpack_from,
+        int2_unpack_from=_int2_unpack_from):
+    # Return the offset just past the term which starts at offset without
+    # decoding it
+    ln = len(string)
+    remaining = 1
+    while remaining:
+        if offset >= ln:
+            raise IncompleteData(string)
+        tag = string[offset]
+        remaining -= 1
+        if tag == 97:
+            # SMALL_INTEGER_EXT
+            offset += 2
+        elif tag == 98:
+            # INTEGER_EXT
+            offset += 5
+        elif tag == 70:
+            # NEW_FLOAT_EXT
+            offset += 9
+        elif tag == 106:
+            # NIL_EXT
+            offset += 1
+        elif tag == 100 or tag == 107:
+            # ATOM_EXT, STRING_EXT
+            if ln < offset + 3:
+                raise IncompleteData(string)
+            offset += int2_unpack_from(string, offset + 1)[0] + 3
+        elif tag == 104:
+            # SMALL_TUPLE_EXT
+            if ln < offset + 2:
+                raise IncompleteData(string)
+            remaining += string[offset + 1]
+            offset += 2
+        elif tag == 110:
+            # SMALL_BIG_EXT
+            if ln < offset + 2:
+                raise IncompleteData(string)
+            offset += string[offset + 1] + 3
+        else:
+            if ln < offset + 5:
+                raise IncompleteData(string)
+            length, = int4_unpack_from(string, offset + 1)
+            if tag == 109:
+                # BINARY_EXT
+                offset += length + 5
+            elif tag == 105:
+                # LARGE_TUPLE_EXT
+                remaining += length
+                offset += 5
+            elif tag == 108:
+                # LIST_EXT, elements and tail
+                remaining += length + 1
+                offset += 5
+            elif tag == 116:
+                # MAP_EXT
+                remaining += length * 2
+                offset += 5
+            elif tag == 111:
+                # LARGE_BIG_EXT
+                offset += length + 6
+            else:
+                raise ValueError("unsupported data: %r" % (string[offset:],))
+    if offset > ln:
+        raise IncompleteData(string)
+    return offset
+
+
+_skip_term_at = _skip_term
+
+
+def _decode_lazy(string, offset, options,
+        # Hack to turn globals into locals
+        len=len, range=range, int4_unpack_from=_int4_unpack_from,
+        skip_term=_skip_term, opaque=OpaqueObject.marker):
+    # Return LazyTerm for the tuple, list or map which starts at offset and
+    # the offset just past it. Other terms are decoded right away.
+    ln = len(string)
+    if offset >= ln:
+        raise IncompleteData(string)
+    tag = string[offset]
+    if tag == 104:
+        if ln < offset + 2:
+            raise IncompleteData(string)
+        count = string[offset + 1]
+        pos = offset + 2
+    elif tag == 105 or tag == 108 or tag == 116:
+        if ln < offset + 5:
+            raise IncompleteData(string)
+        count, = int4_unpack_from(string, offset + 1)
+        pos = offset + 5
+        if tag == 116:
+            count *= 2
+    else:
+        return _decode_term_any(string, offset, options)
+    if not count:
+        return _decode_term_any(string, offset, options)
+
+    if tag == 108:
+        if options.arrays:
+            result = _decode_array(string, pos, count)
+            if result is not None:
+                return result
+        # Lists may be huge and are often only iterated over, so element
+        # offsets are collected on first indexed access
+        for _ in range(count):
+            pos = skip_term(string, pos)
+        if pos >= ln:
+            raise IncompleteData(string)
+        if string[pos] != 106:
+            # Improper lists are decoded right away
+            return _decode_term_any(string, offset, options)
+        return LazyTerm(string, offset, count, List, options), pos + 1
+
+    offsets = []
+    append = offsets.append
+    for _ in range(count):
+        append(pos)
+        pos = skip_term(string, pos)
+    if tag == 116:
+        return LazyTerm(string, offset, count, Map, options, offsets), pos
+    elif count == 3 and string[offsets[0]] == 100:
+        if _decode_term_any(string, offsets[0], options)[0] == opaque:
+            return _decode_term_any(string, offset, options)
+    elif count == 2 and string[offsets[0]] == 100 and (_tag_decoders
+            or offsets[1] - offsets[0] == 3 + len(_text_tag)):
+        # Text and tagged tuples of the registered types are decoded right
+        # away
+        tag = _decode_term_any(string, offsets[0], options)[0]
+        if ((tag == _text_tag and string[offsets[1]] == 109)
+                or tag in _tag_decoders):
+            return _decode_term_any(string, offset, options)
+    if count and _record_decoders and string[offsets[0]] == 100:
+        # And so are the records registered with record_codec()
+        record = _record_decoders.get(
+            _decode_term_any(string, offsets[0], options)[0])
+        if record is not None and record[0] == count:
+            return _decode_term_any(string, offset, options)
+    return LazyTerm(string, offset, count, tuple, options, offsets), pos
+
+
+class LazyTerm(object):
+    """Lazily decoded Erlang tuple, list or map.
+
+    Element boundaries are found with a single scan over the encoded term
+    (for lists on first indexed access) and every element is decoded on
+    first access. Nested tuples, lists and maps are returned as LazyTerm
+    objects as well. Map keys are decoded eagerly on first key lookup.
+    """
+
+    __slots__ = "type", "_string", "_start", "_count", "_offsets", \
+        "_items", "_options", "_keys"
+
+    def __init__(self, string, start, count, type, options, offsets=None):
+        self.type = type
+        self._string = string
+        self._start = start
+        self._count = count
+        self._offsets = offsets
+        self._items = None
+        self._options = options
+        self._keys = None
+
+    def _elements_offset(self):
+        if self._string[self._start] == 104:
+            return self._start + 2
+        return self._start + 5
+
+    def _index(self):
+        offsets = self._offsets
+        if offsets is None:
+            offsets = []
+            append = offsets.append
+            string = self._string
+            pos = self._elements_offset()
+            for _ in range(self._count):
+                append(pos)
+                pos = _skip_term_at(string, pos)
+            self._offsets = offsets
+        self._items = items = [_missing] * self._count
+        return items
+
+    def _item(self, index):
+        items = self._items
+        if items is None:
+            items = self._index()
+        item = items[index]
+        if item is _missing:
+            item, _offset = _decode_lazy(self._string, self._offsets[index],
+                self._options)
+            items[index] = item
+        return item
+
+    def _key_index(self):
+        keys = self._keys
+        if keys is None:
+            if self.type is not Map:
+                raise TypeError("%s is not a map" % self.type.__name__)
+            keys = {}
+            items = self._items
+            if items is None:
+                items = self._index()
+            for i in range(0, len(items), 2):
+                key, _offset = _decode_term_any(self._string, self._offsets[i],
+                    self._options)
+                items[i] = key
+                try:
+                    keys[key] = i + 1
+                except TypeError:
+                    # Plain lists and maps and arrays can't be keys
+                    keys[_map_key(key)] = i + 1
+            self._keys = keys
+        return keys
+
+    def __len__(self):
+        if self.type is Map:
+            return self._count // 2
+        return self._count
+
+    def __getitem__(self, key):
+        if self.type is Map:
+            return self._item(self._key_index()[key])
+        items = range(self._count)
+        if type(key) is slice:
+            return self.type([self._item(i) for i in items[key]])
+        return self._item(items[key])
+
+    def __iter__(self):
+        if self.type is Map:
+            return iter(self._key_index())
+        return map(self._item, range(self._count))
+
+    def iterdecode(self):
+        """Iterate over fully decoded elements of the tuple or list.
+
+        Elements are decoded on demand and aren't cached, so only the current
+        one is kept in memory.
+        """
+        if self.type is Map:
+            raise TypeError("can't iterate over map elements")
+        return _iter_elements(self._string, self._elements_offset(),
+            self._count, self._options)
+
+    def __contains__(self, value):
+        if self.type is Map:
+            return value in self._key_index()
+        return any(value == item for item in self)
+
+    def get(self, key, default=None):
+        index = self._key_index().get(key)
+        if index is None:
+            return default
+        return self._item(index)
+
+    def keys(self):
+        return self._key_index().keys()
+
+    def values(self):
+        return [self._item(i) for i in self._key_index().values()]
+
+    def items(self):
+        return [(k, self._item(i)) for k, i in self._key_index().items()]
+
+    def decode(self):
+        """Return fully decoded term."""
+        term, _offset = _decode_term_any(self._string, self._start,
+            self._options)
+        return term
+
+    def raw(self, index):
+        """Return element of the tuple or list as RawTerm without decoding.
+
+        The RawTerm data is a slice of the encoded term.
+        """
+        if self.type is Map:
+            raise TypeError("can't get raw map elements")
+        index = range(self._count)[index]
+        if self._items is None:
+            self._index()
+        start = self._offsets[index]
+        if index + 1 < self._count:
+            end = self._offsets[index + 1]
+        else:
+            end = _skip_term_at(self._string, start)
+        return RawTerm(self._string[start:end])
+
+    def __eq__(self, other):
+        if type(other) is LazyTerm:
+            other = other.decode()
+        return self.decode() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<LazyTerm %s of length %d>" % (self.type.__name__, len(self))
+
+
+class IncrementalDecoder(object):
+    """Incremental decoder for a stream of Erlang external terms.
+
+    Data can be fed in chunks of any size, and every term is returned as
+    soon as its last byte arrives. Decoding of a partially received term
+    resumes where it stopped, so no data is parsed twice. If packet is 1, 2
+    or 4 every term is expected to be prefixed with its length in the given
+    number of bytes as in the Erlang port protocol. The keyword arguments
+    are the same as for decode(), see set_options().
+    """
+
+    _formats = {
+        1: Struct(b"B"),
+        2: Struct(b">H"),
+        4: Struct(b">I"),
+        }
+
+    def __init__(self, packet=0, plain=False, strings="charlist",
+            arrays=False):
+        self.set_options(plain=plain, strings=strings, arrays=arrays)
+        if packet:
+            struct = self._formats.get(packet)
+            if struct is None:
+                raise ValueError("invalid packet size value: %s" % (packet,))
+            self._unpack_from = struct.unpack_from
+        self.packet = packet
+        self._buffer = bytearray()
+        self._offset = 0
+        # End of the current frame if packet is set
+        self._frame_end = None
+        # Decoding stack of the current term or None between terms
+        self._stack = None
+        # Decompressor of the current term if it's compressed
+        self._decompressor = None
+
+    def set_options(self, binary_view=False, lazy=False, plain=False,
+            strings="charlist", arrays=False):
+        """Set the keyword arguments of decode() for the following terms.
+
+        Binary views and lazy terms aren't supported, the fed data is
+        dropped as soon as it's decoded.
+        """
+        if binary_view or lazy:
+            raise ValueError("incremental decoding doesn't support binary"
+                " views and lazy terms")
+        options = None
+        if plain or strings != "charlist" or arrays:
+            options = _DecodeOptions(False, False, plain, strings, arrays)
+        self._options = options
+
+    def feed(self, data):
+        """Feed data and return list of the terms it completes."""
+        buffer = self._buffer
+        buffer += data
+        terms = []
+        while True:
+            term = self._next()
+            if term is _missing:
+                break
+            terms.append(term)
+        # Drop the consumed data, the decoding stack holds everything needed
+        # to resume
+        consumed = min(self._offset, len(buffer))
+        if consumed:
+            del buffer[:consumed]
+            self._offset -= consumed
+            if self._frame_end is not None:
+                self._frame_end -= consumed
+        return terms
+
+    def _next(self):
+        buffer = self._buffer
+        offset = self._offset
+        if self._stack is None:
+            packet = self.packet
+            if packet and self._frame_end is None:
+                if len(buffer) < offset + packet:
+                    return _missing
+                length, = self._unpack_from(buffer, offset)
+                offset += packet
+                self._frame_end = offset + length
+                self._offset = offset
+            if len(buffer) < offset + 2:
+                return _missing
+            if buffer[offset] != 131:
+                raise ValueError(
+                    "unknown protocol version: %r" % buffer[offset])
+            if buffer[offset + 1] == 80:
+                # compressed term
+                if len(buffer) < offset + 6:
+                    return _missing
+                self._uncompressed_size, = _int4_unpack_from(buffer,
+                    offset + 2)
+                self._decompressor = decompressobj()
+                self._term_buffer = bytearray()
+                self._term_offset = 0
+                self._term_size = 0
+                self._term = _missing
+                offset += 6
+            else:
+                offset += 1
+            self._offset = offset
+            self._stack = []
+        if self._decompressor is not None:
+            return self._next_compressed()
+        done, term, self._offset = _decode_term_resumable(buffer,
+            self._offset, self._stack, self._options)
+        if not done:
+            return _missing
+        return self._finish(term)
+
+    def _next_compressed(self):
+        d = self._decompressor
+        buffer = self._buffer
+        end = len(buffer)
+        if self._frame_end is not None and self._frame_end < end:
+            end = self._frame_end
+        if self._offset < end:
+            with memoryview(buffer)[self._offset:end] as data:
+                data = d.decompress(data)
+            self._offset = end
+            if d.eof:
+                self._offset -= len(d.unused_data)
+            self._term_size += len(data)
+            self._term_buffer += data
+        if self._term is _missing:
+            term_buffer = self._term_buffer
+            done, term, offset = _decode_term_resumable(term_buffer,
+                self._term_offset, self._stack, self._options)
+            del term_buffer[:offset]
+            self._term_offset = 0
+            if done:
+                self._term = term
+        if not d.eof:
+            return _missing
+        if self._term_size != self._uncompressed_size:
+            raise ValueError(
+                "invalid compressed tag, %d bytes but got %d"
+                % (self._uncompressed_size, self._term_size))
+        if self._term is _missing:
+            raise ValueError("incomplete compressed term")
+        term = self._term
+        self._decompressor = self._term_buffer = self._term = None
+        return self._finish(term)
+
+    def _finish(self, term):
+        self._stack = None
+        frame_end = self._frame_end
+        if frame_end is not None:
+            if self._offset > frame_end:
+                raise ValueError("term exceeds its frame")
+            # Skip the rest of the frame
+            self._offset = frame_end
+            self._frame_end = None
+        return term
 
-    raise ValueError("unsupported data: %r" % (string,))
 
 _int4_pack = Struct(b">I").pack
 _char_int4_pack = Struct(b">cI").pack
@@ -432,78 +1625,574 @@ _char_float_pack = Struct(b">cd").pack
 _char_2bytes_pack = Struct(b"cBB").pack
 _char_int4_byte_pack = Struct(b">cIB").pack
 
-def encode(term, compressed=False):
-    """Encode Erlang external term."""
-    encoded_term = encode_term(term)
+_native_types = (tuple, list, List, ImproperList, dict, Map, str, Atom, bytes,
+    bool, int, float, type(None), OpaqueObject, RawTerm)
+
+
+def register_type(cls, encode, tag=None, decode=None):
+    """Register codec for objects of type cls.
+
+    encode(obj) should return the term to send instead of obj. If tag is an
+    Atom the term is sent as {tag, term} tuple, and if decode is given such
+    tuples are decoded as decode(term). The codec is used at every nesting
+    level but only for objects of exactly type cls. Types encoded natively
+    can't be registered. Terms nested too deeply for the recursive codec are
+    processed again from the start, so encode and decode should be free of
+    side effects.
+    """
+    if cls in _native_types:
+        raise ValueError("native type can't be registered: %r" % (cls,))
+    if tag is not None:
+        _check_tag(tag)
+        if tag in _record_decoders:
+            raise ValueError("tag is used by record codec: %r" % tag)
+    elif decode is not None:
+        raise ValueError("decode requires tag")
+    unregister_type(cls)
+    _type_codecs[cls] = encode, tag
+    _other_encoders[cls] = partial(_encode_registered_into, encode, tag)
+    if decode is not None:
+        _tag_decoders[tag] = decode
+
+
+def unregister_type(cls):
+    """Remove codec registered for type cls."""
+    tag = _record_tags.pop(cls, None)
+    if tag is not None:
+        _record_decoders.pop(tag, None)
+    codec = _type_codecs.pop(cls, None)
+    if codec is not None:
+        _other_encoders.pop(cls, None)
+        tag = codec[1]
+        if tag is not None and all(tag != c[1] for c in _type_codecs.values()):
+            _tag_decoders.pop(tag, None)
+            _record_decoders.pop(tag, None)
+
+
+def record_codec(cls, tag=None, fields=None, as_map=False):
+    """Register specialized codec for objects with the fixed set of fields.
+
+    By default objects are sent as Erlang records, {tag, Field1, ...}
+    tuples, and such tuples are decoded as cls(field1=Field1, ...). If
+    as_map is true objects are sent as maps with the field names as atom
+    keys, wrapped into {tag, Map} tuple if tag is given. Maps without tag
+    are only encoded, use the returned decode function to convert them.
+
+    fields is a sequence of the attribute names and defaults to the init
+    fields of dataclass or fields of namedtuple. Return (encode, decode)
+    pair of the generated functions.
+    """
+    positional = _positional_fields(cls)
+    if fields is None:
+        if positional is None:
+            raise TypeError("fields required for %r" % (cls,))
+        fields = positional
+    fields = tuple(fields)
+    for name in fields:
+        if not name.isidentifier() or iskeyword(name):
+            raise ValueError("invalid field name: %r" % (name,))
+    if cls in _native_types:
+        raise ValueError("native type can't be registered: %r" % (cls,))
+    if tag is not None:
+        _check_tag(tag)
+        if ((tag in _tag_decoders or tag in _record_decoders)
+                and _type_codecs.get(cls, (None, None))[1] != tag):
+            raise ValueError("tag is already registered: %r" % tag)
+    elif not as_map:
+        raise ValueError("record requires tag")
+    namespace = {"_cls": cls, "_tag": tag}
+    if as_map:
+        keys = ["_k%d" % i for i in range(len(fields))]
+        namespace.update(zip(keys, (Atom(f.encode()) for f in fields)))
+        source = ("def encode(obj):\n"
+            "    return {%s}\n"
+            "def decode(m):\n"
+            "    return _cls(%s)\n") % (
+            ", ".join("%s: obj.%s" % a for a in zip(keys, fields)),
+            ", ".join("%s=m[%s]" % a for a in zip(fields, keys)))
+    else:
+        args = ["_%d" % i for i in range(len(fields))]
+        source = ("def encode(obj):\n"
+            "    return (_tag, %s)\n"
+            "def decode(%s):\n"
+            "    return _cls(%s)\n") % (
+            "".join("obj.%s, " % f for f in fields),
+            ", ".join(args),
+            ", ".join("%s=%s" % a for a in zip(fields, args)))
+    exec(source, namespace)
+    encode = namespace["encode"]
+    decode = namespace["decode"]
+    if fields == positional and not as_map:
+        # The fields are in order of the constructor arguments
+        decode = cls
+    unregister_type(cls)
+    if as_map:
+        keys = tuple(namespace[k] for k in keys)
+        _other_encoders[cls] = partial(_encode_registered_into, encode, tag)
+        if tag is not None:
+            _tag_decoders[tag] = decode
+    else:
+        keys = None
+        _other_encoders[cls] = partial(_encode_registered_into, encode, None)
+        _record_decoders[tag] = len(fields) + 1, decode
+    # The compiled codec reads the attributes itself
+    _type_codecs[cls] = encode, tag, fields, keys
+    return encode, decode
+
+
+def _positional_fields(cls):
+    # Names of the fields which can be passed to cls() as positional
+    # arguments or None
+    if hasattr(cls, "__dataclass_fields__"):
+        from dataclasses import fields
+        fields = [f for f in fields(cls) if f.init]
+        if any(getattr(f, "kw_only", False) for f in fields):
+            return None
+        return tuple(f.name for f in fields)
+    fields = getattr(cls, "_fields", None)
+    if isinstance(cls, type) and issubclass(cls, tuple) and fields is not None:
+        return tuple(fields)
+    return None
+
+
+def register_ndarray():
+    """Register codec for numpy arrays if numpy can be imported.
+
+    Arrays are sent as {ndarray, Dtype, Shape, Binary} tuples, where Dtype
+    is the dtype string with byte order, like <<"<f8">>, and Binary holds
+    the array data in C order. Such tuples are decoded with
+    numpy.frombuffer() on top of the received binary. With binary_view=True
+    the decoded arrays share memory with the received data. Return False if
+    numpy isn't installed.
+    """
+    try:
+        from numpy import ndarray
+    except ImportError:
+        return False
+    if ((_ndarray_tag in _tag_decoders or _ndarray_tag in _record_decoders)
+            and _record_tags.get(ndarray) != _ndarray_tag):
+        raise ValueError("tag is already registered: %r" % _ndarray_tag)
+    register_type(ndarray, _encode_ndarray)
+    _record_decoders[_ndarray_tag] = 4, _decode_ndarray
+    _record_tags[ndarray] = _ndarray_tag
+    return True
+
+
+_ndarray_tag = Atom(b"ndarray")
+
+
+def _encode_ndarray(term, tag=_ndarray_tag):
+    dtype = term.dtype
+    if dtype.hasobject or dtype.fields is not None:
+        raise ValueError("unsupported array type: %s" % dtype)
+    if not term.flags.c_contiguous:
+        term = term.copy()
+    try:
+        data = memoryview(term)
+    except (TypeError, ValueError):
+        # Types like datetime64 don't support the buffer protocol
+        data = term.tobytes()
+    return tag, dtype.str.encode(), term.shape, data
+
+
+def _decode_ndarray(dtype, shape, data):
+    from numpy import frombuffer
+    return frombuffer(data, str(dtype, "ascii")).reshape(shape)
+
+
+def _check_tag(tag):
+    if type(tag) is not Atom:
+        raise TypeError("tag must be instance of Atom")
+    if tag in (b"true", b"false", b"undefined", OpaqueObject.marker,
+            _text_tag):
+        raise ValueError("reserved atom can't be used as tag: %r" % tag)
+
+
+class _EncodeOptions(object):
+    """Non-default encoding settings passed down the encoder."""
+
+    __slots__ = "strings",
+
+    def __init__(self, strings="charlist"):
+        _check_string_policy(strings)
+        self.strings = strings
+
+
+def encode(term, compressed=False, strings="charlist", compress_threshold=0):
+    """Encode Erlang external term.
+
+    strings is the string policy for str objects, one of STRING_POLICIES:
+    "charlist" encodes them as lists of code points, "binary" as UTF-8
+    binaries and "auto" as lists if they fit in STRING_EXT (Latin-1 text
+    up to 65535 characters) and as UTF-8 binaries otherwise.
+
+    Compression is only tried for terms encoded to at least
+    compress_threshold bytes, so small terms don't waste time on it.
+    """
+    buffer = bytearray()
+    encode_into(term, buffer, compressed, strings, compress_threshold)
+    return bytes(buffer)
+
+
+def encode_into(term, buffer, compressed=False, strings="charlist",
+        compress_threshold=0):
+    """Encode Erlang external term appending it to the bytearray buffer.
+
+    Return the number of bytes appended.
+    """
+    options = None
+    if strings != "charlist":
+        options = _EncodeOptions(strings)
+    start = len(buffer)
+    buffer.append(131)
+    _encode_term_into_any(term, buffer, options)
     # False and 0 do not attempt compression.
     if compressed:
         if compressed is True:
             # default compression level of 6
             compressed = 6
         elif compressed < 0 or compressed > 9:
+            del buffer[start:]
             raise ValueError("invalid compression level: %r" % (compressed,))
-        zlib_term = compress(encoded_term, compressed)
-        ln = len(encoded_term)
+        if len(buffer) - start - 1 < compress_threshold:
+            return len(buffer) - start
+        with memoryview(buffer)[start + 1:] as encoded_term:
+            ln = len(encoded_term)
+            zlib_term = compress(encoded_term, compressed)
         if len(zlib_term) + 5 <= ln:
             # Compressed term should be smaller
-            return b"\x83P" + _int4_pack(ln) + zlib_term
-    return b"\x83" + encoded_term
+            buffer[start + 1:] = b"P" + _int4_pack(ln) + zlib_term
+    return len(buffer) - start
+
+
+def encode_term(term):
+    """Encode Erlang external term without the version byte."""
+    buffer = bytearray()
+    _encode_term_into_any(term, buffer)
+    return bytes(buffer)
+
+
+def encode_stream(term, chunk_size=65536, strings="charlist"):
+    """Encode Erlang external term in chunks instead of building it whole.
+
+    Return the exact size of the encoded term and an iterator over the
+    chunks of the term, starting with the version byte. The term is walked
+    twice, first to compute the size and then to encode it. Binaries and
+    mmap objects of chunk_size bytes or more are returned as memoryview
+    objects of their data. Other terms are collected into chunks of about
+    chunk_size bytes. So memory use doesn't depend on the size of the term.
+    A chunk is only valid until the next one is taken. strings is the same
+    as for encode(). Compression isn't supported.
+    """
+    if chunk_size < 1:
+        raise ValueError("invalid chunk size value: %r" % (chunk_size,))
+    options = None
+    if strings != "charlist":
+        options = _EncodeOptions(strings)
+    counts = []
+    size = 1
+    for chunk in _iter_encoded(term, options, chunk_size, counts, None):
+        size += len(chunk)
+    return size, _iter_encoded(term, options, chunk_size, counts, b"\x83")
+
+
+def _encode_term_into_any(term, buffer, options=None):
+    start = len(buffer)
+    try:
+        _encode_term_into(term, buffer, options)
+    except RecursionError:
+        # Too deeply nested for the recursive encoder. The term is encoded
+        # again from the start, so registered encoders of its subterms may
+        # be called and its pickled objects counted twice.
+        del buffer[start:]
+        _encode_term_into_iterative(term, buffer, options)
 
 
-def encode_term(term,
+def _encode_str_into(term, buffer, options,
         # Hack to turn globals into locals
-        tuple=tuple, len=len, list=list, int=int, type=type, array=array,
-        str=str, Atom=Atom, bytes=bytes, map=map, float=float, dict=dict,
-        true=True, false=False, dumps=dumps, PICKLE_PROTOCOL=PICKLE_PROTOCOL,
-        OpaqueObject=OpaqueObject, List=List, ImproperList=ImproperList,
+        len=len, map=map, ord=ord, char_int4_pack=_char_int4_pack,
+        char_int2_pack=_char_int2_pack,
+        char_signed_int4_pack=_char_signed_int4_pack):
+    strings = "charlist" if options is None else options.strings
+    if strings != "binary":
+        if not term:
+            buffer += b"j"
+            return
+        length = len(term)
+        if length <= 65535:
+            try:
+                data = term.encode("latin-1")
+            except UnicodeEncodeError:
+                pass
+            else:
+                buffer += char_int2_pack(b"k", length)
+                buffer += data
+                return
+    if strings != "charlist":
+        data = term.encode("utf-8")
+        length = len(data)
+        if length > 4294967295:
+            raise ValueError("invalid binary length: %r" % length)
+        buffer += char_int4_pack(b"m", length)
+        buffer += data
+        return
+    if length > 4294967295:
+        raise ValueError("invalid list length: %r" % length)
+    buffer += char_int4_pack(b"l", length)
+    for c in map(ord, term):
+        if c <= 255:
+            buffer += b"a" + bytes((c,))
+        else:
+            buffer += char_signed_int4_pack(b"b", c)
+    buffer += b"j"
+
+
+def _encode_other_into(term, buffer, options):
+    # Secondary dispatch for the types the main dispatch doesn't know about
+    t = type(term)
+    encode_into = _other_encoders.get(t)
+    if encode_into is None:
+        encode_into = _other_encoders[t] = _find_other_encoder(t, term)
+    encode_into(term, buffer, options)
+
+
+# Encoders for the types handled by _encode_other_into() by exact type
+_other_encoders = {}
+
+# Number of objects pickled by the encoder by type. Other types are encoded
+# as opaque Python objects which are of no use to Erlang code. Objects of
+# terms too deeply nested for the recursive encoder may be counted twice.
+pickle_fallbacks = Counter()
+
+
+# Copy subclass instances to their base types straight from their data,
+# as the compiled encoder does, so overridden __str__(), __iter__() and
+# friends are not called
+_base_copies = (
+    (str, str.__str__),
+    (int, int.__int__),
+    (float, float.__float__),
+    (tuple, lambda term: tuple(tuple.__iter__(term))),
+    (list, list.copy),
+    (dict, dict.copy),
+    )
+
+
+def _find_other_encoder(t, term):
+    # Subclasses of the native types are encoded as their base types
+    if issubclass(t, ImproperList):
+        return _encode_pickled_into
+    for base, copy in _base_copies:
+        if issubclass(t, base):
+            return partial(_encode_converted_into, copy)
+    if issubclass(t, array):
+        return _encode_array_into
+    try:
+        memoryview(term).release()
+    except TypeError:
+        return _encode_pickled_into
+    return _encode_buffer_into
+
+
+def _encode_registered_into(encode, tag, term, buffer, options):
+    value = encode(term)
+    if tag is not None:
+        buffer += b"h\2"
+        _encode_term_into(tag, buffer, options)
+    _encode_term_into(value, buffer, options)
+
+
+def _encode_converted_into(convert, term, buffer, options):
+    _encode_term_into(convert(term), buffer, options)
+
+
+def _encode_array_into(term, buffer, options,
+        # Hack to turn globals into locals
+        len=len, min=min, max=max, range=range, array=array,
+        bytearray=bytearray, swap=byteorder == "little",
+        char_signed_int4_pack=_char_signed_int4_pack,
+        small_ints=[bytes((97, i)) for i in range(256)]):
+    # Numeric arrays are encoded as lists. Arrays of floats and of small
+    # integers are converted with a few slice operations instead of encoding
+    # item by item.
+    code = term.typecode
+    if code == "u" or code == "w":
+        _encode_term_into(term.tounicode(), buffer, options)
+        return
+    length = len(term)
+    if not length:
+        buffer += b"j"
+        return
+    if length > 4294967295:
+        raise ValueError("invalid list length: %r" % length)
+    buffer += _char_int4_pack(b"l", length)
+    if code == "d" or code == "f":
+        data = array("d", term)
+        if swap:
+            data.byteswap()
+        data = data.tobytes()
+        out = bytearray(9 * length)
+        out[::9] = b"F" * length
+        for i in range(8):
+            out[i + 1::9] = data[i::8]
+        buffer += out
+    elif 0 <= min(term) and max(term) <= 255:
+        out = bytearray(2 * length)
+        out[::2] = b"a" * length
+        out[1::2] = array("B", term)
+        buffer += out
+    else:
+        for i in term:
+            if 0 <= i <= 255:
+                buffer += small_ints[i]
+            elif -2147483648 <= i <= 2147483647:
+                buffer += char_signed_int4_pack(b"b", i)
+            else:
+                _encode_term_into(i, buffer, options)
+    buffer += b"j"
+
+
+def _encode_columns_into(term, buffer, options,
+        # Hack to turn globals into locals
+        len=len, zip=zip, dict=dict):
+    # Rows are built one at a time and encoded by a single call each
+    columns = term.columns
+    keys = None
+    if isinstance(columns, dict):
+        keys = list(columns)
+        columns = list(columns.values())
+    length = len(columns[0]) if columns else 0
+    for column in columns:
+        if len(column) != length:
+            raise ValueError("columns of different length")
+    if not length:
+        buffer += b"j"
+        return
+    if length > 4294967295:
+        raise ValueError("invalid list length: %r" % length)
+    buffer += _char_int4_pack(b"l", length)
+    encode_term_into = _encode_term_into
+    if keys is None:
+        for row in zip(*columns):
+            encode_term_into(row, buffer, options)
+    else:
+        for row in zip(*columns):
+            encode_term_into(dict(zip(keys, row)), buffer, options)
+    buffer += b"j"
+
+
+_other_encoders[Columns] = _encode_columns_into
+
+
+def _encode_streamed_into(term, buffer, options):
+    # The length is filled in once the items are encoded
+    start = len(buffer)
+    buffer += b"l\0\0\0\0"
+    length = 0
+    encode_term_into = _encode_term_into
+    for item in term.factory():
+        encode_term_into(item, buffer, options)
+        length += 1
+    if length > 4294967295:
+        raise ValueError("invalid list length: %r" % length)
+    buffer[start + 1:start + 5] = _int4_pack(length)
+    buffer += b"j"
+
+
+_other_encoders[StreamedList] = _encode_streamed_into
+
+
+def _encode_buffer_into(term, buffer, options):
+    # Bytes-like objects are encoded as binaries copying their data straight
+    # into the buffer
+    with memoryview(term) as view:
+        length = view.nbytes
+        if length > 4294967295:
+            raise ValueError("invalid binary length: %r" % length)
+        buffer += _char_int4_pack(b"m", length)
+        if view.c_contiguous:
+            buffer += view
+        else:
+            buffer += view.tobytes()
+
+
+def _encode_pickled_into(term, buffer, options):
+    try:
+        data = dumps(term, PICKLE_PROTOCOL)
+    except:
+        raise ValueError("unsupported data type: %s" % type(term))
+    pickle_fallbacks[type(term)] += 1
+    buffer += OpaqueObject(data, _python).encode()
+
+
+def _encode_term_into(term, buffer, options=None,
+        # Hack to turn globals into locals
+        tuple=tuple, len=len, list=list, int=int, type=type, str=str,
+        Atom=Atom, bytes=bytes, float=float, dict=dict,
+        encode_str_into=_encode_str_into, true=True, false=False,
+        encode_other_into=_encode_other_into,
+        OpaqueObject=OpaqueObject, RawTerm=RawTerm, List=List,
+        ImproperList=ImproperList,
         char_int4_pack=_char_int4_pack, char_int2_pack=_char_int2_pack,
         char_signed_int4_pack=_char_signed_int4_pack,
         char_float_pack=_char_float_pack, char_2bytes_pack=_char_2bytes_pack,
-        char_int4_byte_pack=_char_int4_byte_pack, python=_python):
+        char_int4_byte_pack=_char_int4_byte_pack):
     t = type(term)
     if t is tuple:
         arity = len(term)
         if arity <= 255:
-            header = b"h" + bytes((arity,))
+            buffer += b"h" + bytes((arity,))
         elif arity <= 4294967295:
-            header = char_int4_pack(b'i', arity)
+            buffer += char_int4_pack(b'i', arity)
         else:
             raise ValueError("invalid tuple arity: %r" % arity)
-        return header + b"".join(map(encode_term, term))
+        encode_term_into = _encode_term_into
+        for item in term:
+            encode_term_into(item, buffer, options)
     elif t is list or t is List:
         length = len(term)
         if not term:
-            return b"j"
+            buffer += b"j"
+            return
         elif length <= 65535:
             try:
                 b = bytes(term)
             except (ValueError, TypeError):
                 pass
             else:
-                return char_int2_pack(b'k', length) + b
+                buffer += char_int2_pack(b'k', length)
+                buffer += b
+                return
         elif length > 4294967295:
             raise ValueError("invalid list length: %r" % length)
-        return (char_int4_pack(b'l', length)
-            + b"".join(map(encode_term, term)) + b"j")
+        buffer += char_int4_pack(b'l', length)
+        encode_term_into = _encode_term_into
+        for item in term:
+            encode_term_into(item, buffer, options)
+        buffer += b"j"
     elif t is str:
-        return encode_term(list(map(ord, term)))
+        encode_str_into(term, buffer, options)
     elif t is Atom:
-        return char_int2_pack(b"d", len(term)) + term
+        buffer += char_int2_pack(b"d", len(term))
+        buffer += term
     elif t is bytes:
         length = len(term)
         if length > 4294967295:
             raise ValueError("invalid binary length: %r" % length)
-        return char_int4_pack(b"m", length) + term
+        buffer += char_int4_pack(b"m", length)
+        buffer += term
     # Must be before int type
     elif term is true:
-        return b"d\0\4true"
+        buffer += b"d\0\4true"
     elif term is false:
-        return b"d\0\5false"
+        buffer += b"d\0\5false"
     elif t is int:
         if 0 <= term <= 255:
-            return b"a" + bytes((term,))
+            buffer += b"a" + bytes((term,))
+            return
         elif -2147483648 <= term <= 2147483647:
-            return char_signed_int4_pack(b'b', term)
+            buffer += char_signed_int4_pack(b'b', term)
+            return
 
         if term >= 0:
             sign = 0
@@ -511,41 +2200,313 @@ def encode_term(term,
             sign = 1
             term = -term
 
-        b = bytearray()
-        append = b.append
-        while term:
-            append(term & 0xff)
-            term >>= 8
-
-        length = len(b)
+        length = (term.bit_length() + 7) // 8
         if length <= 255:
-            return char_2bytes_pack(b"n", length, sign) + b
+            buffer += char_2bytes_pack(b"n", length, sign)
         elif length <= 4294967295:
-            return char_int4_byte_pack(b"o", length, sign) + b
-        raise ValueError("invalid integer value with length: %r" % length)
+            buffer += char_int4_byte_pack(b"o", length, sign)
+        else:
+            raise ValueError(
+                "invalid integer value with length: %r" % length)
+        buffer += term.to_bytes(length, "little")
     elif t is float:
-        return char_float_pack(b"F", term)
+        buffer += char_float_pack(b"F", term)
     elif term is None:
-        return b"d\0\11undefined"
+        buffer += b"d\0\11undefined"
     elif t is OpaqueObject:
-        return term.encode()
+        buffer += term.encode()
+    elif t is RawTerm:
+        buffer += term.data
     elif t is Map or t is dict:
         length = len(term)
         if length > 4294967295:
             raise ValueError("invalid Map size: %r" % length)
-        header = char_int4_pack(b't', length)
-        return header + b"".join([
-            encode_term(k) + encode_term(v) for k, v in term.items()])
+        buffer += char_int4_pack(b't', length)
+        encode_term_into = _encode_term_into
+        for k, v in term.items():
+            encode_term_into(k, buffer, options)
+            encode_term_into(v, buffer, options)
     elif t is ImproperList:
         length = len(term)
         if length > 4294967295:
             raise ValueError("invalid improper list length: %r" % length)
-        header = char_int4_pack(b"l", length)
-        return (header + b"".join(map(encode_term, term))
-            + encode_term(term.tail))
+        buffer += char_int4_pack(b"l", length)
+        encode_term_into = _encode_term_into
+        for item in term:
+            encode_term_into(item, buffer, options)
+        encode_term_into(term.tail, buffer, options)
+    else:
+        encode_other_into(term, buffer, options)
 
-    try:
-        data = dumps(term, PICKLE_PROTOCOL)
-    except:
-        raise ValueError("unsupported data type: %s" % type(term))
-    return OpaqueObject(data, python).encode()
+
+def _encode_term_into_iterative(term, buffer, options=None,
+        # Hack to turn globals into locals
+        tuple=tuple, len=len, list=list, type=type, bytes=bytes, iter=iter,
+        dict=dict, chain=chain, List=List, Map=Map, ImproperList=ImproperList,
+        char_int4_pack=_char_int4_pack, char_int2_pack=_char_int2_pack):
+    # Same as _encode_term_into() but keeps the iterators over unfinished
+    # containers on an explicit stack together with the bytes to write after
+    # their last item.
+    stack = []
+    items = iter((term,))
+    trailer = b""
+    while True:
+        for term in items:
+            t = type(term)
+            if t is tuple:
+                arity = len(term)
+                if arity <= 255:
+                    buffer += b"h" + bytes((arity,))
+                elif arity <= 4294967295:
+                    buffer += char_int4_pack(b'i', arity)
+                else:
+                    raise ValueError("invalid tuple arity: %r" % arity)
+                stack.append((items, trailer))
+                items = iter(term)
+                trailer = b""
+                break
+            elif t is list or t is List:
+                length = len(term)
+                if not term:
+                    buffer += b"j"
+                    continue
+                elif length <= 65535:
+                    try:
+                        b = bytes(term)
+                    except (ValueError, TypeError):
+                        pass
+                    else:
+                        buffer += char_int2_pack(b'k', length)
+                        buffer += b
+                        continue
+                elif length > 4294967295:
+                    raise ValueError("invalid list length: %r" % length)
+                buffer += char_int4_pack(b'l', length)
+                stack.append((items, trailer))
+                items = iter(term)
+                trailer = b"j"
+                break
+            elif t is Map or t is dict:
+                length = len(term)
+                if length > 4294967295:
+                    raise ValueError("invalid Map size: %r" % length)
+                buffer += char_int4_pack(b't', length)
+                stack.append((items, trailer))
+                items = chain.from_iterable(term.items())
+                trailer = b""
+                break
+            elif t is ImproperList:
+                length = len(term)
+                if length > 4294967295:
+                    raise ValueError(
+                        "invalid improper list length: %r" % length)
+                buffer += char_int4_pack(b"l", length)
+                stack.append((items, trailer))
+                items = chain(term, (term.tail,))
+                trailer = b""
+                break
+            else:
+                # Leaf terms don't recurse
+                _encode_term_into(term, buffer, options)
+        else:
+            buffer += trailer
+            if not stack:
+                return
+            items, trailer = stack.pop()
+
+
+def _iter_encoded(term, options, chunk_size, counts, head,
+        # Hack to turn globals into locals
+        tuple=tuple, len=len, list=list, type=type, bytes=bytes, iter=iter,
+        dict=dict, chain=chain, memoryview=memoryview, List=List, Map=Map,
+        ImproperList=ImproperList, RawTerm=RawTerm,
+        StreamedList=StreamedList, buffer_types={bytes, bytearray,
+            memoryview, mmap},
+        container_types={tuple, list, List, dict, Map},
+        scalar_types={int, float, bool, type(None), Atom},
+        text_types={bytes, str},
+        char_int4_pack=_char_int4_pack, char_int2_pack=_char_int2_pack):
+    # Yield the encoded term in chunks for encode_stream(). Containers are
+    # walked with an explicit stack as in _encode_term_into_iterative() and
+    # other terms are encoded by the regular encoder into a bytearray which
+    # is yielded and reused when full. If head is None this is the sizing
+    # pass, which appends the lengths of StreamedList objects to counts.
+    # Otherwise the buffer starts with head and the lengths are taken from
+    # counts.
+    sizing = head is None
+    buffer = bytearray(head or b"")
+    next_count = iter(counts).__next__
+    encode_term_into = _encode_term_into_any
+    stack = []
+    items = iter((term,))
+    trailer = b""
+    while True:
+        for term in items:
+            if len(buffer) >= chunk_size:
+                yield buffer
+                del buffer[:]
+            t = type(term)
+            if t in container_types and len(term) <= 255:
+                # Small containers of small scalars are encoded in one go
+                if t is dict or t is Map:
+                    values = chain.from_iterable(term.items())
+                else:
+                    values = term
+                for item in values:
+                    s = type(item)
+                    if s not in scalar_types and (s not in text_types
+                            or len(item) > 255):
+                        break
+                else:
+                    encode_term_into(term, buffer, options)
+                    continue
+            if t is tuple:
+                arity = len(term)
+                if arity <= 255:
+                    buffer += b"h" + bytes((arity,))
+                elif arity <= 4294967295:
+                    buffer += char_int4_pack(b'i', arity)
+                else:
+                    raise ValueError("invalid tuple arity: %r" % arity)
+                stack.append((items, trailer))
+                items = iter(term)
+                trailer = b""
+                break
+            elif t is list or t is List:
+                length = len(term)
+                if not term:
+                    buffer += b"j"
+                    continue
+                elif length <= 65535:
+                    try:
+                        b = bytes(term)
+                    except (ValueError, TypeError):
+                        pass
+                    else:
+                        buffer += char_int2_pack(b'k', length)
+                        buffer += b
+                        continue
+                elif length > 4294967295:
+                    raise ValueError("invalid list length: %r" % length)
+                buffer += char_int4_pack(b'l', length)
+                stack.append((items, trailer))
+                items = iter(term)
+                trailer = b"j"
+                break
+            elif t is Map or t is dict:
+                length = len(term)
+                if length > 4294967295:
+                    raise ValueError("invalid Map size: %r" % length)
+                buffer += char_int4_pack(b't', length)
+                stack.append((items, trailer))
+                items = chain.from_iterable(term.items())
+                trailer = b""
+                break
+            elif t is StreamedList:
+                stack.append((items, trailer))
+                if sizing:
+                    buffer += b"l\0\0\0\0"
+                    items = _counted_items(term.factory(), counts)
+                else:
+                    length = next_count()
+                    buffer += char_int4_pack(b"l", length)
+                    items = _checked_items(term.factory(), length)
+                trailer = b"j"
+                break
+            elif t in buffer_types or t is RawTerm:
+                # Large binaries are yielded without copying their data
+                with memoryview(term.data if t is RawTerm else term) as view:
+                    length = view.nbytes
+                    if length >= chunk_size and view.c_contiguous:
+                        if t is not RawTerm:
+                            if length > 4294967295:
+                                raise ValueError(
+                                    "invalid binary length: %r" % length)
+                            buffer += char_int4_pack(b"m", length)
+                        if buffer:
+                            yield buffer
+                            del buffer[:]
+                        with view.cast("B") as data:
+                            yield data
+                        continue
+                encode_term_into(term, buffer, options)
+            else:
+                encode_term_into(term, buffer, options)
+        else:
+            buffer += trailer
+            if not stack:
+                break
+            items, trailer = stack.pop()
+    if buffer:
+        yield buffer
+
+
+def _counted_items(items, counts):
+    # Yield the items and store their number in counts
+    index = len(counts)
+    counts.append(0)
+    length = 0
+    for item in items:
+        length += 1
+        yield item
+    if length > 4294967295:
+        raise ValueError("invalid list length: %r" % length)
+    counts[index] = length
+
+
+def _checked_items(items, length):
+    # Yield the items checking that there are exactly length of them
+    for item in items:
+        if not length:
+            raise ValueError("streamed list changed between passes")
+        length -= 1
+        yield item
+    if length:
+        raise ValueError("streamed list changed between passes")
+
+
+_py_encode_term = encode_term
+_py_encode_term_into = _encode_term_into
+
+
+def _py_encode_fallback(term, options=None):
+    # Called by the compiled encoder for terms it has no native encoding for
+    buffer = bytearray()
+    _py_encode_term_into(term, buffer, options)
+    return bytes(buffer)
+
+
+def _use_extension(enabled):
+    """Switch between the compiled and the pure Python codec.
+
+    Return the previous setting.
+    """
+    global _decode_term, _decode_columns_at, _skip_term_at, encode_term
+    global _encode_term_into
+    previous = _decode_term is not _py_decode_term
+    if enabled:
+        if _erlterms is None:
+            raise ImportError("erlport._erlterms extension is not built")
+        _decode_term = _erlterms.decode_term_at
+        _decode_columns_at = _erlterms.decode_columns_at
+        _skip_term_at = _erlterms.skip_term_at
+        encode_term = _erlterms.encode_term
+        _encode_term_into = _erlterms.encode_term_into
+    else:
+        _decode_term = _py_decode_term
+        _decode_columns_at = _py_decode_columns_at
+        _skip_term_at = _skip_term
+        encode_term = _py_encode_term
+        _encode_term_into = _py_encode_term_into
+    return previous
+
+
+try:
+    from erlport import _erlterms
+except ImportError:
+    _erlterms = None
+else:
+    _erlterms.setup(Atom, List, Map, ImproperList, OpaqueObject,
+        IncompleteData, _py_encode_fallback, _type_codecs, _tag_decoders,
+        _record_decoders, RawTerm)
+    _use_extension(True)
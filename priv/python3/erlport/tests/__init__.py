@@ -36,6 +36,7 @@ except ImportError:
 
 from . import erlterms_tests
 from . import erlproto_tests
+from . import erlang_tests
 from . import stdio_tests
 
 
@@ -43,6 +44,7 @@ def test_suite():
     suite = unittest.TestSuite()
     suite.addTests(erlterms_tests.get_suite())
     suite.addTests(erlproto_tests.get_suite())
+    suite.addTests(erlang_tests.get_suite())
     suite.addTests(stdio_tests.get_suite())
     return suite
 
@@ -0,0 +1,94 @@
+# Copyright (c) 2009-2015, Dmitry Vasiliev <dima@hlabs.org>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#  * Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#  * Neither the name of the copyright holders nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+import unittest
+from threading import Condition, Thread
+
+from erlport import Atom
+from erlport.erlang import MessageHandler
+from erlport.erlproto import Port
+
+
+class TestBurstPort(object):
+
+    def __init__(self, burst):
+        self.burst = burst
+        self.calls = []
+        self.condition = Condition()
+
+    def write(self, message):
+        with self.condition:
+            self.calls.append(message)
+            self.condition.notify()
+
+    def flush(self):
+        pass
+
+    def read_many(self):
+        # Answer up to burst pending calls at once in reverse order
+        with self.condition:
+            while not self.calls:
+                self.condition.wait()
+            calls = self.calls[:self.burst]
+            del self.calls[:self.burst]
+        return [(Atom(b"r"), mid, args)
+            for _c, mid, _m, _f, args, _context in reversed(calls)]
+
+class MessageHandlerTestCase(unittest.TestCase):
+
+    def test_concurrent_calls(self):
+        handler = MessageHandler(TestBurstPort(4))
+        results = {}
+        def call(n):
+            results[n] = [handler.call(Atom(b"m"), Atom(b"f"), [n, i])
+                for i in range(200)]
+        threads = [Thread(target=call, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+            self.assertFalse(thread.is_alive())
+        for n in range(8):
+            self.assertEqual([[n, i] for i in range(200)], results[n])
+        self.assertFalse(handler._received)
+
+    def test_set_decode_options(self):
+        handler = MessageHandler(Port(incremental=True))
+        handler.set_decode_options(plain=True, arrays=True)
+        self.assertTrue(handler.port.decode_options["plain"])
+        self.assertRaises(ValueError, handler.set_decode_options, lazy=True)
+        self.assertRaises(ValueError, handler.set_decode_options,
+            binary_view=True)
+        self.assertRaises(ValueError, handler.set_decode_options, unknown=1)
+
+
+def get_suite():
+    load = unittest.TestLoader().loadTestsFromTestCase
+    suite = unittest.TestSuite()
+    suite.addTests(load(MessageHandlerTestCase))
+    return suite
@@ -28,9 +28,13 @@
 import os
 import errno
 import unittest
+import threading
+
+from array import array
+from queue import Full
 
 from erlport.erlproto import Port
-from erlport.erlterms import Atom
+from erlport.erlterms import Atom, List, LazyTerm, StreamedList
 
 
 class TestPortClient(object):
@@ -109,6 +113,27 @@ class PortTestCase(unittest.TestCase):
         self.assertTrue(isinstance(atom, Atom))
         self.assertEqual(Atom(b"test"), atom)
 
+    def test_read_many(self):
+        client = TestPortClient()
+        atom_data = b"\0\0\0\10\x83d\0\4test"
+        self.assertEqual(29, client.write(atom_data * 2 + b"\0\0\0\3\x83"))
+        self.assertEqual([Atom(b"test")] * 2, client.port.read_many())
+        self.assertEqual(14, client.write(b"a\1" + atom_data))
+        self.assertEqual([1, Atom(b"test")], client.port.read_many())
+        client = TestPortClient(packet=1, incremental=True)
+        self.assertEqual(7, client.write(b"\3\x83a\1\3\x83a"))
+        self.assertEqual([1], client.port.read_many())
+        self.assertEqual(1, client.write(b"\2"))
+        self.assertEqual([2], client.port.read_many())
+
+    def test_read_many_error(self):
+        client = TestPortClient(packet=1, lazy=True)
+        self.assertEqual(11, client.write(b"\3\x83a\1\3\x84a\2\3\x83a"))
+        self.assertEqual([1], client.port.read_many())
+        self.assertRaises(ValueError, client.port.read_many)
+        self.assertEqual(1, client.write(b"\3"))
+        self.assertEqual([3], client.port.read_many())
+
     def test_small_buffer_read(self):
         client = TestPortClient(buffer_size=1)
         self.assertEqual(12, client.write(b"\0\0\0\10\x83d\0\4test"))
@@ -116,6 +141,90 @@ class PortTestCase(unittest.TestCase):
         self.assertTrue(isinstance(atom, Atom))
         self.assertEqual(Atom(b"test"), atom)
 
+    def test_large_frame_read(self):
+        client = TestPortClient(buffer_size=16)
+        data = b"\x83m\0\0\4\0" + bytes(range(256)) * 4
+        small = b"\0\0\0\3\x83a\1"
+        self.assertEqual(31, client.write(
+            small + b"\0\0\4\6" + data[:20]))
+        self.assertEqual(1017, client.write(data[20:] + small))
+        self.assertEqual(1, client.port.read())
+        self.assertEqual(bytes(range(256)) * 4, client.port.read())
+        self.assertEqual(1, client.port.read())
+
+    def test_incremental_read(self):
+        client = TestPortClient(buffer_size=1, incremental=True)
+        atom_data = b"\0\0\0\10\x83d\0\4test"
+        self.assertEqual(24, client.write(atom_data + atom_data))
+        self.assertEqual(Atom(b"test"), client.port.read())
+        self.assertEqual(Atom(b"test"), client.port.read())
+        client = TestPortClient(packet=1, incremental=True)
+        self.assertEqual(12, client.write(b"\3\x83a\1\3\x83a\2\3\x83a\3"))
+        self.assertEqual(1, client.port.read())
+        self.assertEqual(2, client.port.read())
+        self.assertEqual(3, client.port.read())
+        client.close()
+        self.assertRaises(EOFError, client.port.read)
+
+    def test_incremental_read_options(self):
+        data = b"\0\0\0\14\x83l\0\0\0\1k\0\2abj"
+        for options, term in (({}, List([List([97, 98])])),
+                ({"plain": True}, [[97, 98]]),
+                ({"strings": "auto"}, List(["ab"])),
+                ({"arrays": True}, List([array("q", [97, 98])]))):
+            for incremental in (False, True):
+                client = TestPortClient(incremental=incremental, **options)
+                self.assertEqual(16, client.write(data))
+                result = client.port.read()
+                self.assertEqual(term, result)
+                self.assertEqual(type(term), type(result))
+                self.assertEqual(type(term[0]), type(result[0]))
+        # Options changed after the port is created
+        client = TestPortClient(incremental=True)
+        client.port.decode_options["plain"] = True
+        self.assertEqual(16, client.write(data))
+        self.assertEqual(list, type(client.port.read()))
+        self.assertRaises(ValueError, Port, incremental=True, lazy=True)
+        self.assertRaises(ValueError, Port, incremental=True,
+            binary_view=True)
+
+    def test_plain_read(self):
+        client = TestPortClient(plain=True)
+        self.assertEqual(13, client.write(b"\0\0\0\11\x83l\0\0\0\1a\1j"))
+        term = client.port.read()
+        self.assertEqual(list, type(term))
+        self.assertEqual([1], term)
+
+    def test_arrays_read(self):
+        client = TestPortClient(arrays=True)
+        self.assertEqual(15, client.write(b"\0\0\0\13\x83l\0\0\0\2a\1a\2j"))
+        self.assertEqual(array("q", [1, 2]), client.port.read())
+
+    def test_strings_port(self):
+        client = TestPortClient(strings="auto")
+        self.assertEqual(12, client.write(b"\0\0\0\10\x83k\0\4test"))
+        self.assertEqual("test", client.port.read())
+        self.assertEqual(14, client.port.write("\u0442\u0435"))
+        self.assertEqual(b"\0\0\0\12\x83m\0\0\0\4\xd1\x82\xd0\xb5",
+            client.read())
+
+    def test_binary_view_read(self):
+        client = TestPortClient(binary_view=True)
+        data = b"\0\0\0\12\x83m\0\0\0\4data"
+        self.assertEqual(28, client.write(data + data))
+        binary = client.port.read()
+        self.assertEqual(memoryview, type(binary))
+        self.assertEqual(b"data", binary)
+        self.assertEqual(b"data", client.port.read())
+        self.assertEqual(b"data", binary)
+
+    def test_lazy_read(self):
+        client = TestPortClient(lazy=True)
+        self.assertEqual(13, client.write(b"\0\0\0\11\x83h\2a\1d\0\1x"))
+        term = client.port.read()
+        self.assertEqual(LazyTerm, type(term))
+        self.assertEqual((1, Atom(b"x")), term.decode())
+
     def test_invalid_buffer_size(self):
         self.assertRaises(ValueError, Port, buffer_size=0)
 
@@ -168,56 +277,314 @@ class PortTestCase(unittest.TestCase):
             b"\x60\x60\x60\xcd\x66\x60\xd4\x43\xc7\x59\0\x30\x48\3\xde",
             client.read())
 
+    def test_write_stream(self):
+        client = TestPortClient()
+        self.assertEqual(21, client.port.write_stream((b"data", [1, 2])))
+        self.assertEqual(b"\0\0\0\21\x83h\2m\0\0\0\4datak\0\2\1\2",
+            client.read())
+        client = TestPortClient(packet=1, compressed=True)
+        self.assertEqual(26,
+            client.port.write_stream([[46], [46], [46], [46], [46]]))
+        self.assertEqual(b"\x19\x83P", client.read()[:3])
+
+    def test_write_stream_changed(self):
+        client = TestPortClient()
+        items = [[b"data"], []]
+        self.assertRaises(ValueError, client.port.write_stream,
+            StreamedList(items.pop))
+
+    def test_write_stream_error(self):
+        client = TestPortClient()
+        calls = []
+        def items():
+            calls.append(None)
+            yield b"x" * 100000
+            if len(calls) > 1:
+                raise RuntimeError("failed")
+            yield b"y"
+        received = []
+        def read():
+            while True:
+                chunk = client.read()
+                if not chunk:
+                    break
+                received.append(chunk)
+        thread = threading.Thread(target=read)
+        thread.start()
+        self.assertRaises(RuntimeError, client.port.write_stream,
+            StreamedList(items))
+        # Only a part of the frame is written before the output is closed
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        data = b"".join(received)
+        self.assertEqual(b"\0\1\x86\xb2\x83l\0\0\0\2m\0\1\x86\xa0",
+            data[:15])
+        self.assertTrue(len(data) < 100028)
+        self.assertRaises(EOFError, client.port.write, Atom(b"test"))
+        self.assertRaises(EOFError, client.port.write_stream, [])
+        client.port.close()
+        # Failed before the first chunk, nothing is written
+        client = TestPortClient()
+        def fail():
+            raise RuntimeError("failed")
+        self.assertRaises(RuntimeError, client.port.write_stream,
+            StreamedList(fail))
+        self.assertEqual(12, client.port.write(Atom(b"test")))
+        self.assertEqual(b"\0\0\0\10\x83d\0\4test", client.read())
+
+    def test_compress_threshold_port_write(self):
+        client = TestPortClient(packet=1, compressed=True,
+            compress_threshold=100)
+        self.assertEqual(28, client.port.write([[46], [46], [46], [46], [46]]))
+        self.assertEqual(b"\x1b\x83l\0\0\0\5", client.read()[:7])
+        self.assertRaises(ValueError, Port, compress_threshold=-1)
+
+    def test_compress_sample_port_write(self):
+        client = TestPortClient(compressed=True, compress_sample=3)
+        noise = bytes(range(256))
+        tags = []
+        skipped = []
+        stats = client.port._Port__compression_stats
+        for _ in range(4):
+            client.port.write((Atom(b"r"), noise))
+            tags.append(client.read()[5:6])
+            skipped.append(stats.skipped.get(Atom(b"r")))
+            client.port.write((Atom(b"M"), b"x" * 256))
+            tags.append(client.read()[5:6])
+        self.assertEqual([b"h", b"P"] * 4, tags)
+        # Noise is only compressed for every third message after the first
+        self.assertEqual([None, 1, 2, 0], skipped)
+        self.assertEqual(1.0, stats.ratios[Atom(b"r")])
+        self.assertTrue(stats.ratios[Atom(b"M")] < 0.2)
+        self.assertRaises(ValueError, Port, compress_sample=-1)
+
+    def test_compress_sample_message_classes(self):
+        client = TestPortClient(compressed=True, compress_sample=3)
+        noise = bytes(range(256))
+        stats = client.port._Port__compression_stats
+        r = Atom(b"r")
+        tags = []
+        # Results of the same call with different payloads
+        for _ in range(3):
+            client.port.write((r, 1, noise))
+            tags.append(client.read()[5:6])
+            client.port.write((r, 1, "x" * 256))
+            tags.append(client.read()[5:6])
+            client.port.write((r, 1, (Atom(b"ok"), noise * 2)))
+            tags.append(client.read()[5:6])
+        self.assertEqual([b"h", b"P", b"P", b"h", b"P", b"P", b"h", b"P",
+            b"P"], tags)
+        self.assertEqual(1.0, stats.ratios[(r, bytes)])
+        self.assertTrue(stats.ratios[(r, str)] < 0.2)
+        self.assertTrue(stats.ratios[(r, tuple, Atom(b"ok"))] < 0.6)
+        client.port.write((Atom(b"C"), 1, Atom(b"m"), Atom(b"f"), [], []))
+        client.read()
+        self.assertTrue((Atom(b"C"), Atom(b"m"), Atom(b"f")) in stats.ratios)
+
+    def test_coalesced_write(self):
+        client = TestPortClient(coalesce_latency=10000000, coalesce_size=30)
+        self.assertEqual(12, client.port.write(Atom(b"test")))
+        self.assertEqual(12, client.port.write(Atom(b"next")))
+        self.assertEqual(24, len(client.port._Port__pending))
+        # The third message fills the queue
+        self.assertEqual(12, client.port.write(Atom(b"last")))
+        self.assertEqual(b"\0\0\0\10\x83d\0\4test\0\0\0\10\x83d\0\4next"
+            b"\0\0\0\10\x83d\0\4last", client.read())
+        client.port.write(Atom(b"test"))
+        client.port.flush()
+        self.assertEqual(b"\0\0\0\10\x83d\0\4test", client.read())
+        client.port.write(Atom(b"test"))
+        self.assertEqual(21, client.port.write_stream((b"data", [1, 2])))
+        self.assertEqual(b"\0\0\0\10\x83d\0\4test"
+            b"\0\0\0\21\x83h\2m\0\0\0\4datak\0\2\1\2", client.read())
+        self.assertRaises(ValueError, Port, coalesce_latency=-1)
+        self.assertRaises(ValueError, Port, coalesce_size=-1)
+
+    def test_coalesced_write_latency(self):
+        client = TestPortClient(coalesce_latency=1000)
+        client.port.write(Atom(b"test"))
+        # Written by the background thread
+        self.assertEqual(b"\0\0\0\10\x83d\0\4test", client.read())
+        os.close(client.in_d)
+        client.port.write(Atom(b"test"))
+        client.port._Port__writer.join(10)
+        self.assertRaises(EOFError, client.port.write, Atom(b"test"))
+
+    def test_async_write(self):
+        client = TestPortClient(async_write=True)
+        for _ in range(3):
+            self.assertEqual(12, client.port.write(Atom(b"test")))
+        data = b""
+        while len(data) < 36:
+            data += client.read()
+        self.assertEqual(b"\0\0\0\10\x83d\0\4test" * 3, data)
+        self.assertRaises(ValueError, Port, low_watermark=2, high_watermark=1)
+        self.assertRaises(ValueError, Port, overflow="drop")
+
+    def test_async_write_overflow(self):
+        client = TestPortClient(async_write=True, high_watermark=1000,
+            low_watermark=100, overflow="raise")
+        # Nothing is read, so the message can't be written whole
+        client.port.write(b"x" * 100000)
+        self.assertRaises(Full, client.port.write, Atom(b"test"))
+        client.port.overflow = "block"
+        written = threading.Event()
+        def write():
+            client.port.write(Atom(b"test"))
+            written.set()
+        thread = threading.Thread(target=write)
+        thread.start()
+        self.assertFalse(written.wait(0.1))
+        data = b""
+        while len(data) < 100022:
+            data += client.read()
+        self.assertTrue(written.wait(10))
+        thread.join()
+        self.assertEqual(b"\0\0\0\10\x83d\0\4test", data[100010:])
+
+    def test_async_write_close(self):
+        client = TestPortClient(async_write=True)
+        self.assertEqual(12, client.port.write(Atom(b"test")))
+        client.port.close()
+        self.assertEqual(b"\0\0\0\10\x83d\0\4test", client.read())
+        self.assertEqual(b"", client.read())
+        # Nothing is read, so the queue is dropped after the timeout
+        client = TestPortClient(async_write=True, drain_timeout=100)
+        client.port.write(b"x" * 100000)
+        closed = threading.Event()
+        thread = threading.Thread(target=lambda: (client.port.close(),
+            closed.set()))
+        thread.start()
+        self.assertTrue(closed.wait(10))
+        thread.join()
+        self.assertRaises(EOFError, client.port.write, Atom(b"test"))
+        # The writer thread gets EPIPE once the reader is gone
+        os.close(client.in_d)
+        client.port._Port__writer.join(10)
+        self.assertFalse(client.port._Port__writer.is_alive())
+        self.assertRaises(ValueError, Port, drain_timeout=-1)
+
+    def test_async_write_close_slow(self):
+        client = TestPortClient(async_write=True, drain_timeout=10)
+        out_d = client.port.out_d
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def slow_write(d, data):
+            calls.append(d)
+            started.set()
+            release.wait(10)
+            return write(d, data)
+        write = os.write
+        os.write = slow_write
+        try:
+            client.port.write(Atom(b"test"))
+            self.assertTrue(started.wait(10))
+            client.port.close()
+            # The writer thread is still writing, so out_d is left open
+            os.fstat(out_d)
+            release.set()
+            client.port._Port__writer.join(10)
+            self.assertFalse(client.port._Port__writer.is_alive())
+        finally:
+            release.set()
+            os.write = write
+        # And closed by the writer thread, which didn't write any further
+        self.assertRaises(OSError, os.fstat, out_d)
+        self.assertEqual([out_d], calls)
+        self.assertEqual(b"\0\0\0\10\x83d\0\4test", client.read())
+        os.close(client.in_d)
+
+    def test_partial_write(self):
+        written = []
+        def test_write(d, data):
+            data = bytes(data[:3])
+            written.append(data)
+            return len(data)
+        def test_writev(d, buffers):
+            return test_write(d, buffers[0])
+        write = os.write
+        writev = os.writev
+        os.write = test_write
+        os.writev = test_writev
+        try:
+            port = Port()
+            self.assertEqual(12, port.write(Atom(b"test")))
+            self.assertEqual(b"\0\0\0\10\x83d\0\4test", b"".join(written))
+            del written[:]
+            self.assertEqual(1040, port.write_stream([b"x" * 1024]))
+            self.assertEqual(
+                b"\0\0\4\x0c\x83l\0\0\0\1m\0\0\4\0" + b"x" * 1024 + b"j",
+                b"".join(written))
+        finally:
+            os.write = write
+            os.writev = writev
+
     def test_slow_write(self):
         write = os.write
+        writev = os.writev
         os.write = lambda d, data: 1
+        os.writev = lambda d, buffers: 1
         try:
             port = Port(packet=1)
             self.assertEqual(9, port.write(Atom(b"test")))
         finally:
             os.write = write
+            os.writev = writev
 
     def test_no_data_written(self):
         write = os.write
+        writev = os.writev
         os.write = lambda d, data: 0
+        os.writev = lambda d, buffers: 0
         try:
             port = Port()
             self.assertRaises(EOFError, port.write, b"test")
         finally:
             os.write = write
+            os.writev = writev
 
     def test_error_on_write(self):
         def test_write(d, data):
             raise OSError()
         write = os.write
+        writev = os.writev
         os.write = test_write
+        os.writev = test_write
         try:
             port = Port()
             self.assertRaises(OSError, port.write, b"test")
         finally:
             os.write = write
+            os.writev = writev
 
     def test_error_on_read(self):
         def test_read(d, buffer_size):
             raise OSError()
         read = os.read
+        readv = os.readv
         os.read = test_read
+        os.readv = test_read
         try:
             port = Port()
             self.assertRaises(OSError, port.read)
         finally:
             os.read = read
+            os.readv = readv
 
     def test_close_on_read(self):
         def test_read(d, buffer_size):
             raise OSError(errno.EPIPE, "Pipe closed")
         read = os.read
+        readv = os.readv
         os.read = test_read
+        os.readv = test_read
         try:
             port = Port()
             self.assertRaises(EOFError, port.read)
         finally:
             os.read = read
+            os.readv = readv
 
 
 def get_suite():
@@ -27,17 +27,78 @@
 
 import unittest
 
+from array import array
+from collections import namedtuple, OrderedDict
+from dataclasses import dataclass
+from decimal import Decimal
+from enum import Enum, IntEnum
 from pickle import dumps
+import tracemalloc
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from erlport import erlterms
 from erlport.erlterms import Atom, List, ImproperList, OpaqueObject, Map, MutationError
-from erlport.erlterms import encode, decode, IncompleteData
+from erlport.erlterms import encode, decode, IncompleteData, LazyTerm
+from erlport.erlterms import STRING_POLICIES
+from erlport.erlterms import IncrementalDecoder, iterdecode
+from erlport.erlterms import Columns, decode_columns, RawTerm, extract
+from erlport.erlterms import StreamedList, encode_stream
 
 
 class _TestObj(object):
     def __init__(self, v):
         self.v = v
 
+class _Color(IntEnum):
+    red = 1
+    blue = 300
+
+_Point = namedtuple("_Point", "x y")
+
+@dataclass
+class _User(object):
+    id: int
+    name: str = ""
+
+class _Str(str):
+    pass
+
+class _List(list):
+    pass
+
+class _Mode(str, Enum):
+    read = "r"
+
+class _Overridden(object):
+    # Overrides which the encoders don't call
+    def __int__(self):
+        return 0
+    def __float__(self):
+        return 0.0
+    def __iter__(self):
+        return iter(())
+    def items(self):
+        return ()
+
+class _OverriddenInt(_Overridden, int):
+    pass
+
+class _OverriddenFloat(_Overridden, float):
+    pass
+
+class _OverriddenTuple(_Overridden, tuple):
+    pass
+
+class _OverriddenList(_Overridden, list):
+    pass
+
+class _OverriddenDict(_Overridden, dict):
+    pass
+
 class AtomTestCase(unittest.TestCase):
 
     def test_atom(self):
@@ -241,6 +302,12 @@ class DecodeTestCase(unittest.TestCase):
         self.assertEqual(([[], []], b""), decode(b"\x83l\0\0\0\2jjj"))
         self.assertTrue(isinstance(decode(b"\x83l\0\0\0\2jjj")[0], List))
         self.assertEqual(([[], []], b"tail"), decode(b"\x83l\0\0\0\2jjjtail"))
+        # Lists and tuples longer than the data are incomplete before any of
+        # their elements is decoded
+        self.assertRaises(IncompleteData, decode, b"\x83lhh\x02t\x02lkjh")
+        self.assertRaises(IncompleteData, decode, b"\x83h\3a\1")
+        self.assertRaises(IncompleteData, erlterms._decode_term_iterative,
+            b"lhh\x02t\x02lkjh", 0)
 
     def test_decode_improper_list(self):
         self.assertRaises(IncompleteData, decode, b"\x83l\0\0\0\0k")
@@ -387,6 +454,317 @@ class DecodeTestCase(unittest.TestCase):
         self.assertEqual(([100] * 20, b"tail"), decode(b"\x83P\0\0\0\x17"
             b"\x78\xda\xcb\x66\x10\x49\xc1\2\0\x5d\x60\x08\x50tail"))
 
+    def test_decode_long_list(self):
+        data = b"\x83l\0\1\x86\xa0" + b"a\1" * 100000 + b"jtail"
+        self.assertEqual(([1] * 100000, b"tail"), decode(data))
+        self.assertRaises(IncompleteData, decode, data[:-6])
+
+    def test_decode_term(self):
+        self.assertRaises(IncompleteData, erlterms.decode_term, b"")
+        self.assertEqual(((1, Atom(b"a")), b"tail"),
+            erlterms.decode_term(b"h\2a\1d\0\1atail"))
+        self.assertEqual((Map({1: b"x"}), b""),
+            erlterms.decode_term(b"t\0\0\0\1a\1m\0\0\0\1x"))
+
+    def test_decode_binary_view(self):
+        data = b"\x83l\0\0\0\2m\0\0\0\4datat\0\0\0\1m\0\0\0\1ka\1jtail"
+        (binary, m), tail = decode(data, binary_view=True)
+        self.assertEqual(memoryview, type(binary))
+        self.assertTrue(binary.readonly)
+        self.assertTrue(binary.obj is data)
+        self.assertEqual(b"data", binary)
+        self.assertEqual(1, m[b"k"])
+        self.assertEqual(b"tail", tail)
+        data = bytearray(b"\x83m\0\0\0\4data")
+        binary, tail = decode(data, binary_view=True)
+        self.assertTrue(binary.readonly)
+        self.assertEqual(b"data", binary)
+        self.assertRaises(IncompleteData, decode, b"\x83m\0\0\0\4dat",
+            binary_view=True)
+        binary, tail = decode(b"\x83P\0\0\0\x17"
+            b"\x78\xda\xcb\x66\x10\x49\xc1\2\0\x5d\x60\x08\x50",
+            binary_view=True)
+        self.assertEqual([100] * 20, binary)
+        opaque, tail = decode(b"\x83h\3d\0\x0f$erlport.opaqued\0\10language"
+            b"m\0\0\0\4data", binary_view=True)
+        self.assertEqual(OpaqueObject(b"data", Atom(b"language")), opaque)
+
+    def test_decode_lazy(self):
+        term = (Atom(b"test"), [1, (2, b"data")], {b"key": [[]], 1: 2.5},
+            "string", 2 ** 100)
+        data = encode(term) + b"tail"
+        lazy, tail = decode(data, lazy=True)
+        self.assertEqual(b"tail", tail)
+        self.assertEqual(LazyTerm, type(lazy))
+        self.assertEqual(tuple, lazy.type)
+        self.assertEqual(5, len(lazy))
+        self.assertEqual(Atom(b"test"), lazy[0])
+        self.assertEqual(2 ** 100, lazy[-1])
+        self.assertRaises(IndexError, lambda: lazy[5])
+        lst = lazy[1]
+        self.assertEqual(LazyTerm, type(lst))
+        self.assertEqual(List, lst.type)
+        self.assertEqual(1, lst[0])
+        self.assertEqual((2, b"data"), lst[1].decode())
+        self.assertEqual(List([1, (2, b"data")]), lst.decode())
+        m = lazy[2]
+        self.assertEqual(Map, m.type)
+        self.assertEqual(2, len(m))
+        self.assertEqual(2.5, m[1])
+        self.assertEqual(List([List()]), m[b"key"].decode())
+        self.assertTrue(b"key" in m)
+        self.assertEqual(None, m.get(b"unknown"))
+        self.assertRaises(KeyError, lambda: m[b"unknown"])
+        self.assertEqual(set([b"key", 1]), set(m.keys()))
+        self.assertRaises(TypeError, lst.get, 1)
+        self.assertEqual(List([115, 116, 114, 105, 110, 103]), lazy[3])
+        self.assertEqual((Atom(b"test"), List([1, (2, b"data")])), lazy[:2])
+        self.assertEqual(decode(data)[0], lazy)
+        self.assertEqual(decode(data), (lazy.decode(), b"tail"))
+
+    def test_decode_plain(self):
+        term, tail = decode(b"\x83l\0\0\0\3jk\0\2abt\0\0\0\1a\1"
+            b"l\0\0\0\1h\0jjtail", plain=True)
+        self.assertEqual(b"tail", tail)
+        self.assertEqual([[], [97, 98], {1: [()]}], term)
+        self.assertEqual(list, type(term))
+        self.assertEqual(list, type(term[0]))
+        self.assertEqual(list, type(term[1]))
+        self.assertEqual(dict, type(term[2]))
+        self.assertEqual(list, type(term[2][1]))
+        improper, tail = decode(b"\x83l\0\0\0\1jd\0\4tail", plain=True)
+        self.assertEqual(ImproperList([[]], Atom(b"tail")), improper)
+        self.assertEqual(list, type(improper[0]))
+        # Lists and maps are kept immutable if used as keys
+        term, tail = decode(b"\x83t\0\0\0\1l\0\0\0\1t\0\0\0\0ja\1",
+            plain=True)
+        key, = term
+        self.assertEqual(List, type(key))
+        self.assertEqual(Map, type(key[0]))
+        self.assertEqual({List([Map()]): 1}, term)
+        # At any depth, #{{user, "bob"} => [1]}
+        data = b"t\0\0\0\1h\2d\0\4userk\0\3bobl\0\0\0\1a\1j"
+        key = (Atom(b"user"), List([98, 111, 98]))
+        term, tail = decode(b"\x83" + data, plain=True)
+        self.assertEqual({key: [1]}, term)
+        self.assertEqual(List, type(list(term)[0][1]))
+        self.assertEqual(list, type(term[key]))
+        term, tail = decode(b"\x83" + data, plain=True, arrays=True)
+        self.assertEqual({key: array("q", [1])}, term)
+        self.assertEqual([1], decode(b"\x83" + data, plain=True,
+            lazy=True)[0][key])
+        # Decoded iteratively
+        term, tail = decode(b"\x83" + b"l\0\0\0\1" * 100000 + data
+            + b"j" * 100000, plain=True)
+        for _ in range(100000):
+            term, = term
+        self.assertEqual({key: [1]}, term)
+        # Lists of numbers are kept lists
+        term, tail = decode(b"\x83t\0\0\0\1l\0\0\0\2a\1a\2ja\1",
+            arrays=True)
+        self.assertEqual({List([1, 2]): 1}, term)
+        term, tail = decode(b"\x83" + b"l\0\0\0\1" * 100000
+            + b"j" * 100001, plain=True)
+        self.assertEqual(list, type(term))
+        self.assertEqual(list, type(term[0][0]))
+
+    def test_decode_trusted_containers(self):
+        term, tail = decode(b"\x83l\0\0\0\2t\0\0\0\1jk\0\1a"
+            b"l\0\0\0\1a\1a\2j")
+        self.assertEqual(List, type(term))
+        lst, improper = term
+        self.assertEqual(Map, type(lst))
+        key, = lst
+        self.assertEqual(List, type(key))
+        self.assertEqual(List([97]), lst[key])
+        self.assertEqual(List, type(lst[key]))
+        self.assertEqual(ImproperList, type(improper))
+        self.assertEqual(ImproperList([1], 2), improper)
+        self.assertRaises(MutationError, improper.append, 3)
+        self.assertRaises(MutationError, setattr, improper, "tail", 3)
+        self.assertEqual(List, type(decode(b"\x83j")[0]))
+
+    def test_decode_strings(self):
+        self.assertEqual(("test", b""),
+            decode(b"\x83k\0\4test", strings="auto"))
+        self.assertEqual(("\0\xff", b""),
+            decode(b"\x83k\0\2\0\xff", strings="auto"))
+        self.assertEqual(([Map({"k": "v"})], b""),
+            decode(b"\x83l\0\0\0\1t\0\0\0\1k\0\1kk\0\1vj",
+                strings="auto"))
+        self.assertEqual((List([116, 101, 115, 116]), b""),
+            decode(b"\x83k\0\4test", strings="binary"))
+        self.assertEqual((b"test", b""),
+            decode(b"\x83m\0\0\0\4test", strings="auto"))
+        self.assertEqual(((["x"],), b""),
+            decode(b"\x83h\1l\0\0\0\1k\0\1xj", plain=True,
+                strings="auto"))
+        self.assertRaises(ValueError, decode, b"\x83k\0\4test",
+            strings="invalid")
+        # Text which Erlang can't send as STRING_EXT is tagged
+        text = b"\x83h\2d\0\r$erlport.textm\0\0\0\4\xc4\x80\xc4\x81"
+        for strings in STRING_POLICIES:
+            self.assertEqual(("\u0100\u0101", b""),
+                decode(text, strings=strings))
+        self.assertEqual(("\u0100\u0101", b""), decode(text, binary_view=True))
+        self.assertEqual(("\u0100\u0101", 27),
+            erlterms._decode_term_iterative(text[1:], 0))
+        self.assertRaises(ValueError, erlterms.register_type, _TestObj,
+            lambda o: o, Atom(b"$erlport.text"))
+        # Only binaries are text
+        tag = Atom(b"$erlport.text")
+        for data, term in ((b"d\0\4test", (tag, Atom(b"test"))),
+                (b"a\1", (tag, 1)),
+                (b"k\0\1x", (tag, List([120])))):
+            data = b"\x83h\2d\0\r$erlport.text" + data
+            self.assertEqual((term, b""), decode(data))
+            self.assertEqual(term, erlterms._decode_term_iterative(data[1:],
+                0)[0])
+            lazy, tail = decode(data, lazy=True)
+            self.assertEqual(term, tuple(lazy))
+
+    def test_decode_lazy_eager(self):
+        self.assertEqual((1, b""), decode(b"\x83a\1", lazy=True))
+        self.assertEqual(((), b""), decode(b"\x83h\0", lazy=True))
+        improper, tail = decode(b"\x83l\0\0\0\1jd\0\4tail", lazy=True)
+        self.assertEqual(ImproperList, type(improper))
+        opaque, tail = decode(b"\x83h\3d\0\x0f$erlport.opaqued\0\10language"
+            b"m\0\0\0\4data", lazy=True)
+        self.assertEqual(OpaqueObject, type(opaque))
+        self.assertRaises(IncompleteData, decode, b"\x83h\2a\1", lazy=True)
+        self.assertRaises(IncompleteData, decode, b"\x83l\0\0\0\1a\1",
+            lazy=True)
+        self.assertRaises(ValueError, decode, b"\x83h\2a\1z", lazy=True)
+
+    def test_iterdecode(self):
+        items = iterdecode(b"\x83l\0\0\0\3a\1h\1d\0\1xm\0\0\0\1yj")
+        self.assertEqual(1, next(items))
+        self.assertEqual((Atom(b"x"),), next(items))
+        self.assertEqual([b"y"], list(items))
+        self.assertEqual([], list(iterdecode(b"\x83j")))
+        self.assertEqual([97, 98], list(iterdecode(b"\x83k\0\2ab")))
+        term = List(range(300))
+        self.assertEqual(term, list(iterdecode(encode(term, compressed=True))))
+        self.assertRaises(ValueError, iterdecode, b"\x83a\1")
+        self.assertRaises(ValueError, iterdecode, b"\0j")
+        self.assertRaises(IncompleteData, iterdecode, b"\x83l\0\0")
+        items = iterdecode(b"\x83l\0\0\0\1a\1a\2")
+        self.assertEqual(1, next(items))
+        self.assertRaises(ValueError, next, items)
+        items = iterdecode(b"\x83l\0\0\0\2a\1")
+        self.assertEqual(1, next(items))
+        self.assertRaises(IncompleteData, next, items)
+
+    def test_iterdecode_memory(self):
+        frame = encode([b"x" * 1000] * 1000)
+        tracemalloc.start()
+        try:
+            for item in iterdecode(frame):
+                pass
+            _current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        # The frame isn't copied
+        self.assertTrue(peak < len(frame) // 10, peak)
+
+    def test_lazy_iterdecode(self):
+        term, tail = decode(b"\x83h\2l\0\0\0\2a\1h\1a\2j"
+            b"t\0\0\0\1a\1a\2", lazy=True)
+        items = term[0].iterdecode()
+        self.assertEqual(1, next(items))
+        self.assertEqual((2,), next(items))
+        self.assertRaises(StopIteration, next, items)
+        self.assertEqual([List([1, (2,)]), Map({1: 2})],
+            list(term.iterdecode()))
+        self.assertEqual((2,), term[0][1].decode())
+        self.assertRaises(TypeError, term[1].iterdecode)
+
+    def test_incremental_decoder(self):
+        term = (Atom(b"test"), [1, 2.5, b"data"], {b"k": List(b"ab")},
+            -1 << 70)
+        data = encode(term) + encode(1) + encode(term, compressed=True)
+        decoder = IncrementalDecoder()
+        terms = []
+        for i in range(len(data)):
+            terms.extend(decoder.feed(data[i:i + 1]))
+            if i == len(encode(term)) - 1:
+                self.assertEqual([term], terms)
+        self.assertEqual([term, 1, term], terms)
+        self.assertEqual([term, 1, term], IncrementalDecoder().feed(data))
+        self.assertEqual([], decoder.feed(b"\x83l\0\0\0\2a\1"))
+        self.assertEqual([List([1, 2])], decoder.feed(b"a\2j"))
+
+    def test_incremental_decoder_options(self):
+        data = encode([[1, 2], "ab", {1: [1.5]}])
+        data += encode([[1, 2]], compressed=9)
+        for options in ({"plain": True}, {"strings": "auto"},
+                {"arrays": True}, {"plain": True, "arrays": True}):
+            expected = [decode(data[:data.index(b"\x83", 1)], **options)[0],
+                decode(data[data.index(b"\x83", 1):], **options)[0]]
+            terms = []
+            decoder = IncrementalDecoder(**options)
+            for i in range(len(data)):
+                terms.extend(decoder.feed(data[i:i + 1]))
+            self.assertEqual(expected, terms)
+            self.assertEqual([type(t) for t in expected],
+                [type(t) for t in terms])
+            self.assertEqual([type(t) for t in expected[0]],
+                [type(t) for t in terms[0]])
+        decoder = IncrementalDecoder()
+        decoder.set_options(strings="auto")
+        self.assertEqual(["ab"], decoder.feed(b"\x83k\0\2ab"))
+        self.assertRaises(ValueError, decoder.set_options, lazy=True)
+        self.assertRaises(ValueError, decoder.set_options, binary_view=True)
+        self.assertRaises(ValueError, IncrementalDecoder, strings="invalid")
+
+    def test_incremental_decoder_packet(self):
+        self.assertRaises(ValueError, IncrementalDecoder, 3)
+        decoder = IncrementalDecoder(2)
+        self.assertEqual([], decoder.feed(b"\0"))
+        self.assertEqual([], decoder.feed(b"\4\x83a"))
+        # The term is returned before the rest of the frame arrives
+        self.assertEqual([1], decoder.feed(b"\1"))
+        self.assertEqual([2], decoder.feed(b"z\0\3\x83a\2"))
+        decoder = IncrementalDecoder(1)
+        self.assertRaises(ValueError, decoder.feed, b"\2\x83a\1")
+        decoder = IncrementalDecoder(1)
+        self.assertEqual([], decoder.feed(b"\x11\x83P\0\0\0\2x"))
+        self.assertEqual([1], decoder.feed(b"\x9cKd\4\0\0\xc5\0c"))
+
+    def test_incremental_decoder_invalid(self):
+        self.assertRaises(ValueError, IncrementalDecoder().feed, b"\0a\1")
+        self.assertRaises(ValueError, IncrementalDecoder().feed,
+            b"\x83z\1")
+        self.assertRaises(ValueError, IncrementalDecoder().feed,
+            b"\x83P\0\0\0\3x\x9cKd\4\0\0\xc5\0c")
+
+    def test_decode_deeply_nested(self):
+        depth = 100000
+        term, tail = decode(b"\x83" + b"l\0\0\0\1" * depth
+            + b"j" * (depth + 1) + b"tail")
+        self.assertEqual(b"tail", tail)
+        for _ in range(depth):
+            self.assertEqual(List, type(term))
+            self.assertEqual(1, len(term))
+            term = term[0]
+        self.assertEqual(List(), term)
+        term, tail = decode(b"\x83" + b"h\1" * depth + b"a\1")
+        self.assertEqual(b"", tail)
+        for _ in range(depth):
+            term, = term
+        self.assertEqual(1, term)
+        self.assertRaises(IncompleteData, decode,
+            b"\x83" + b"l\0\0\0\1" * depth + b"j" * depth)
+
+    def test_decode_iterative(self):
+        data = (b"l\0\0\0\3t\0\0\0\2a\1h\0h\2jk\0\1xl\0\0\0\1a\1a\2"
+            b"l\0\0\0\1jd\0\4tailh\3d\0\x0f$erlport.opaqued\0\10language"
+            b"m\0\0\0\4datajtail")
+        self.assertEqual(erlterms._decode_term(data, 0),
+            erlterms._decode_term_iterative(data, 0))
+        self.assertRaises(IncompleteData, erlterms._decode_term_iterative,
+            data[:-6], 0)
+
 class EncodeTestCase(unittest.TestCase):
 
     def test_encode_tuple(self):
@@ -445,6 +823,28 @@ class EncodeTestCase(unittest.TestCase):
         self.assertEqual(b"\x83l\0\1\0\0" + b"b\0\0\4\x10" * 65536 + b"j",
             encode("\u0410" * 65536))
 
+    def test_encode_unicode_binary(self):
+        self.assertEqual(b"\x83m\0\0\0\0", encode("", strings="binary"))
+        self.assertEqual(b"\x83m\0\0\0\4test",
+            encode("test", strings="binary"))
+        self.assertEqual(b"\x83m\0\0\0\4\xd0\xb0\xc3\xbf",
+            encode("\u0430\xff", strings="binary"))
+        self.assertEqual(b"\x83l\0\0\0\1m\0\0\0\1xj",
+            encode(["x"], strings="binary"))
+        self.assertEqual(b"\x83h\1t\0\0\0\1m\0\0\0\1km\0\0\0\1v",
+            encode(({"k": "v"},), strings="binary"))
+
+    def test_encode_unicode_auto(self):
+        self.assertEqual(b"\x83j", encode("", strings="auto"))
+        self.assertEqual(b"\x83k\0\2\0\xff", encode("\0\xff", strings="auto"))
+        self.assertEqual(b"\x83m\0\0\0\2\xc4\x80",
+            encode("\u0100", strings="auto"))
+        self.assertEqual(b"\x83m\0\1\0\0" + b"X" * 65536,
+            encode("X" * 65536, strings="auto"))
+        self.assertEqual(b"\x83l\0\0\0\2k\0\1xm\0\0\0\2\xc4\x80j",
+            encode(["x", "\u0100"], strings="auto"))
+        self.assertRaises(ValueError, encode, "x", strings="invalid")
+
     def test_encode_atom(self):
         self.assertEqual(b"\x83d\0\0", encode(Atom(b"")))
         self.assertEqual(b"\x83d\0\4test", encode(Atom(b"test")))
@@ -502,6 +902,120 @@ class EncodeTestCase(unittest.TestCase):
         self.assertRaises(ValueError, encode,
             compile(b"0", b"<string>", "eval"))
 
+    def test_encode_bytes_like(self):
+        self.assertEqual(b"\x83m\0\0\0\4data", encode(bytearray(b"data")))
+        self.assertEqual(b"\x83m\0\0\0\2at",
+            encode(memoryview(b"data")[1:3]))
+        self.assertEqual(b"\x83m\0\0\0\2dt",
+            encode(memoryview(b"data")[::2]))
+        numbers = array("H", [1, 2])
+        self.assertEqual(b"\x83m\0\0\0\4" + numbers.tobytes(),
+            encode(memoryview(numbers)))
+        self.assertEqual(b"\x83l\0\0\0\1m\0\0\0\0j",
+            encode([bytearray()]))
+
+    def test_encode_array(self):
+        self.assertEqual(b"\x83j", encode(array("d")))
+        self.assertEqual(b"\x83l\0\0\0\2F?\xf8\0\0\0\0\0\0"
+            b"F\xc0\0\0\0\0\0\0\0j", encode(array("d", [1.5, -2])))
+        self.assertEqual(b"\x83l\0\0\0\1F?\xf8\0\0\0\0\0\0j",
+            encode(array("f", [1.5])))
+        self.assertEqual(b"\x83l\0\0\0\2a\1a\xffj",
+            encode(array("B", [1, 255])))
+        self.assertEqual(b"\x83l\0\0\0\2a\1b\xff\xff\xff\xffj",
+            encode(array("h", [1, -1])))
+        self.assertEqual(b"\x83l\0\0\0\2a\1n\4\0\0\0\0\x80j",
+            encode(array("q", [1, 2 ** 31])))
+        self.assertEqual(b"\x83l\0\0\0\1n\x08\0\xff\xff\xff\xff"
+            b"\xff\xff\xff\xffj", encode(array("Q", [2 ** 64 - 1])))
+        self.assertEqual(b"\x83k\0\2ab", encode(array("u", "ab")))
+        self.assertEqual(b"\x83h\1l\0\0\0\1a\1j",
+            encode((array("i", [1]),)))
+
+    def test_decode_arrays(self):
+        data = encode([1.5, -2.0])
+        self.assertEqual((array("d", [1.5, -2]), b""),
+            decode(data, arrays=True))
+        self.assertEqual((array("q", [1, 300, -1]), b""),
+            decode(encode([1, 300, -1]), arrays=True))
+        self.assertEqual((array("q", [1, 255]), b""),
+            decode(b"\x83l\0\0\0\2a\1a\xffj", arrays=True))
+        self.assertEqual((array("q", [1, -1]), b""),
+            decode(b"\x83l\0\0\0\2b\0\0\0\1b\xff\xff\xff\xffj",
+                arrays=True))
+        # Integers which fit into 64 bits as in decode_columns()
+        self.assertEqual((array("q", [2 ** 40, 2 ** 63 - 1, -2 ** 63]), b""),
+            decode(encode([2 ** 40, 2 ** 63 - 1, -2 ** 63]), arrays=True))
+        # Mixed, improper and other lists are left alone
+        self.assertEqual(([1, 1.5], b""), decode(encode([1, 1.5]),
+            arrays=True))
+        self.assertEqual((ImproperList([1.5], 2), b""),
+            decode(b"\x83l\0\0\0\1F?\xf8\0\0\0\0\0\0a\2", arrays=True))
+        self.assertEqual(([2 ** 63], b""), decode(encode([2 ** 63]),
+            arrays=True))
+        self.assertEqual(([1, -2 ** 63 - 1], b""),
+            decode(encode([1, -2 ** 63 - 1]), arrays=True))
+        # Short lists of small integers sent as STRING_EXT
+        self.assertEqual((array("q", [97, 255]), b""),
+            decode(b"\x83k\0\2a\xff", arrays=True))
+        self.assertEqual(((array("q", [1, 2]),), b""),
+            decode(encode(([1, 2],)), arrays=True, plain=True))
+        self.assertEqual((List([array("q", [1])]), 10),
+            erlterms._decode_term_iterative(b"l\0\0\0\1k\0\1\1j", 0,
+                erlterms._DecodeOptions(arrays=True)))
+        self.assertEqual(("ab", b""), decode(b"\x83k\0\2ab", arrays=True,
+            strings="auto"))
+        self.assertEqual((List(), b""), decode(b"\x83j", arrays=True))
+        self.assertEqual(((array("d", [1.5]),), b""),
+            decode(encode((array("d", [1.5]),)), arrays=True))
+        self.assertEqual((array("d", [1.5]), b""),
+            decode(encode(array("d", [1.5])), arrays=True, lazy=True))
+        self.assertEqual((array("q", [1]), b""),
+            decode(encode(array("q", [1])), arrays=True, binary_view=True))
+        self.assertRaises(IncompleteData, decode, data[:-1], arrays=True)
+        self.assertRaises(IncompleteData, decode, data[:-2], arrays=True)
+        # Truncated frames don't allocate by the list length
+        tracemalloc.start()
+        try:
+            self.assertRaises(IncompleteData, decode,
+                b"\x83l\x10\0\0\0F", arrays=True)
+            self.assertRaises(IncompleteData, decode,
+                b"\x83l\xff\xff\xff\xffa\1", arrays=True)
+            _current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertTrue(peak < 1000000, peak)
+        options = erlterms._DecodeOptions(arrays=True)
+        self.assertEqual(array("d", [1.5, -2]),
+            erlterms._decode_term_iterative(data[1:], 0, options)[0])
+
+    def test_encode_subclasses(self):
+        self.assertEqual(b"\x83a\1", encode(_Color.red))
+        self.assertEqual(b"\x83b\0\0\1\x2c", encode(_Color.blue))
+        self.assertEqual(b"\x83h\2a\1a\2", encode(_Point(1, 2)))
+        self.assertEqual(b"\x83k\0\4test", encode(_Str("test")))
+        self.assertEqual(b"\x83m\0\0\0\4test",
+            encode(_Str("test"), strings="binary"))
+        self.assertEqual(b"\x83k\0\2\1\2", encode(_List([1, 2])))
+        self.assertEqual(b"\x83t\0\0\0\1a\1h\1a\2",
+            encode(OrderedDict([(1, _Point(2, 3)[:1])])))
+        self.assertEqual(b"\x83t\0\0\0\1a\1h\2a\2a\3",
+            encode(OrderedDict([(1, _Point(2, 3))])))
+        # The data is copied as is, overridden methods aren't called
+        self.assertEqual(b"\x83k\0\1r", encode(_Mode.read))
+        self.assertEqual(b"\x83a\1", encode(_OverriddenInt(1)))
+        self.assertEqual(encode(1.5), encode(_OverriddenFloat(1.5)))
+        self.assertEqual(b"\x83h\1a\1", encode(_OverriddenTuple((1,))))
+        self.assertEqual(b"\x83k\0\1\1", encode(_OverriddenList([1])))
+        self.assertEqual(b"\x83t\0\0\0\1a\1a\2",
+            encode(_OverriddenDict({1: 2})))
+
+    def test_pickle_fallbacks(self):
+        erlterms.pickle_fallbacks.clear()
+        encode([_TestObj(1), _TestObj(2), _Point(1, 2)])
+        self.assertEqual({_TestObj: 2}, erlterms.pickle_fallbacks)
+        erlterms.pickle_fallbacks.clear()
+
     def test_encode_compressed_term(self):
         self.assertEqual(b"\x83l\x00\x00\x00\x05jjjjjj", encode([[]] * 5, True))
         self.assertEqual(b"\x83P\x00\x00\x00\x15"
@@ -519,6 +1033,370 @@ class EncodeTestCase(unittest.TestCase):
             b"x\x01\xcba``\xe0\xcfB\x03\x00B@\x07\x1c",
             encode([[]] * 15, 1))
 
+    def test_encode_compress_threshold(self):
+        self.assertEqual(b"\x83l\0\0\0\x0f" + b"j" * 15 + b"j",
+            encode([[]] * 15, True, compress_threshold=22))
+        self.assertEqual(encode([[]] * 15, True),
+            encode([[]] * 15, True, compress_threshold=21))
+        self.assertRaises(ValueError, encode, [], 10, compress_threshold=100)
+
+    def test_encode_into(self):
+        buffer = bytearray(b"head")
+        self.assertEqual(7, erlterms.encode_into(Atom(b"abc"), buffer))
+        self.assertEqual(b"head\x83d\0\3abc", buffer)
+        buffer = bytearray(b"head")
+        self.assertEqual(21, erlterms.encode_into([[]] * 15, buffer, True))
+        self.assertEqual(b"head" + encode([[]] * 15, True), buffer)
+        self.assertRaises(ValueError, erlterms.encode_into, [], buffer, 10)
+        self.assertEqual(b"head" + encode([[]] * 15, True), buffer)
+
+    def test_encode_deeply_nested(self):
+        depth = 100000
+        term = []
+        for _ in range(depth):
+            term = [term]
+        self.assertEqual(b"\x83" + b"l\0\0\0\1" * depth + b"j" * (depth + 1),
+            encode(term))
+        term = 1
+        for _ in range(depth):
+            term = (term,)
+        self.assertEqual(b"\x83" + b"h\1" * depth + b"a\1", encode(term))
+        # The output of the failed recursive pass is dropped
+        term = [_Point(1, 2)]
+        for _ in range(depth):
+            term = [term]
+        erlterms.register_type(_Point, tuple)
+        try:
+            buffer = bytearray(b"head")
+            erlterms.encode_into(term, buffer)
+        finally:
+            erlterms.unregister_type(_Point)
+        self.assertEqual(b"head\x83" + b"l\0\0\0\1" * (depth + 1)
+            + b"h\2a\1a\2" + b"j" * (depth + 1), buffer)
+
+    def test_encode_iterative(self):
+        term = [{1: (), (): [[]]}, ImproperList([1, (2,)], Atom(b"tail")),
+            "test", "\u0100", [256], 2 ** 100, 1.5, None, True, b"data",
+            OpaqueObject(b"data", Atom(b"language")), _TestObj(1)]
+        buffer = bytearray(b"head")
+        erlterms._encode_term_into_iterative(term, buffer)
+        self.assertEqual(b"head" + erlterms.encode_term(term), buffer)
+
+
+class RegisterTypeTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        erlterms.unregister_type(Decimal)
+        erlterms.unregister_type(_TestObj)
+
+    def test_register_type(self):
+        erlterms.register_type(Decimal, lambda d: str(d).encode(),
+            Atom(b"decimal"), lambda b: Decimal(b.decode()))
+        data = encode([Decimal("1.5"), (Decimal("2"),)])
+        self.assertEqual(b"\x83l\0\0\0\2h\2d\0\7decimalm\0\0\0\0031.5"
+            b"h\1h\2d\0\7decimalm\0\0\0\0012j", data)
+        self.assertEqual(([Decimal("1.5"), (Decimal("2"),)], b""),
+            decode(data))
+        term, tail = decode(data, lazy=True)
+        self.assertEqual(Decimal("1.5"), term[0])
+        self.assertEqual(Decimal("2"), term[1][0])
+        self.assertEqual(((Atom(b"other"), 1), b""),
+            decode(b"\x83h\2d\0\5othera\1"))
+        erlterms.unregister_type(Decimal)
+        self.assertEqual(((Atom(b"decimal"), List(b"2")), b""),
+            decode(b"\x83h\2d\0\7decimalk\0\0012"))
+
+    def test_register_type_without_tag(self):
+        erlterms.register_type(_TestObj, lambda obj: obj.v)
+        self.assertEqual(b"\x83h\2a\1a\2",
+            encode((_TestObj(1), _TestObj(2))))
+        erlterms.pickle_fallbacks.clear()
+        erlterms.unregister_type(_TestObj)
+        encode(_TestObj(1))
+        self.assertEqual({_TestObj: 1}, erlterms.pickle_fallbacks)
+        erlterms.pickle_fallbacks.clear()
+
+    def test_register_invalid_type(self):
+        self.assertRaises(ValueError, erlterms.register_type, tuple, list)
+        self.assertRaises(ValueError, erlterms.register_type, Map, dict)
+        self.assertRaises(TypeError, erlterms.register_type, Decimal, str,
+            b"decimal", Decimal)
+        self.assertRaises(ValueError, erlterms.register_type, Decimal, str,
+            Atom(b"true"), Decimal)
+        self.assertRaises(ValueError, erlterms.register_type, Decimal, str,
+            None, Decimal)
+
+
+class RecordCodecTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        erlterms.unregister_type(_User)
+        erlterms.unregister_type(_Point)
+
+    def test_record(self):
+        encode_user, decode_user = erlterms.record_codec(_User,
+            Atom(b"user"))
+        self.assertEqual((Atom(b"user"), 1, "x"), encode_user(_User(1, "x")))
+        self.assertEqual(_User(1, "x"), decode_user(1, "x"))
+        data = encode([_User(1, "x")])
+        self.assertEqual(b"\x83l\0\0\0\1h\3d\0\4usera\1k\0\1xj", data)
+        self.assertEqual(([_User(1, List(b"x"))], b""), decode(data))
+        self.assertEqual(([_User(1, "x")], b""), decode(data, strings="auto"))
+        term, tail = decode(data, lazy=True)
+        self.assertEqual(_User(1, List(b"x")), term[0])
+        self.assertEqual(_User(1, List(b"x")),
+            erlterms._decode_term_iterative(data[1:], 0)[0][0])
+        # Other sizes and tags are left alone
+        self.assertEqual(((Atom(b"user"), 1), b""),
+            decode(b"\x83h\2d\0\4usera\1"))
+        self.assertEqual(((Atom(b"other"), 1, 2), b""),
+            decode(b"\x83h\3d\0\5othera\1a\2"))
+        erlterms.unregister_type(_User)
+        self.assertEqual(((Atom(b"user"), 1, List(b"x")), b""),
+            decode(b"\x83" + data[6:-1]))
+
+    def test_record_fields(self):
+        erlterms.record_codec(_Point, Atom(b"point"), ["y", "x"])
+        erlterms.record_codec(_Point, Atom(b"point"), ["y", "x"])
+        data = encode(_Point(1, 2))
+        self.assertEqual(b"\x83h\3d\0\5pointa\2a\1", data)
+        self.assertEqual((_Point(1, 2), b""), decode(data))
+
+    def test_map(self):
+        encode_user, decode_user = erlterms.record_codec(_User, as_map=True)
+        data = encode(_User(1, "x"))
+        self.assertEqual(b"\x83t\0\0\0\2d\0\2ida\1d\0\4namek\0\1x",
+            data)
+        term, tail = decode(data)
+        self.assertEqual({Atom(b"id"): 1, Atom(b"name"): List(b"x")}, term)
+        self.assertEqual(_User(1, List(b"x")), decode_user(term))
+        self.assertEqual(_User(1, List(b"x")),
+            decode_user(decode(data, lazy=True)[0]))
+        erlterms.record_codec(_User, Atom(b"user"), as_map=True)
+        data = encode(_User(1, "x"))
+        self.assertEqual((_User(1, List(b"x")), b""), decode(data))
+
+    def test_invalid_record(self):
+        self.assertRaises(ValueError, erlterms.record_codec, _User)
+        self.assertRaises(TypeError, erlterms.record_codec, _User, b"user")
+        self.assertRaises(ValueError, erlterms.record_codec, _User,
+            Atom(b"user"), ["id", "class"])
+        self.assertRaises(TypeError, erlterms.record_codec, _TestObj,
+            Atom(b"test"))
+        erlterms.register_type(_Point, tuple, Atom(b"point"), _Point._make)
+        self.assertRaises(ValueError, erlterms.record_codec, _User,
+            Atom(b"point"))
+        erlterms.unregister_type(_Point)
+        erlterms.record_codec(_User, Atom(b"user"))
+        self.assertRaises(ValueError, erlterms.register_type, _Point, tuple,
+            Atom(b"user"), _Point._make)
+
+
+class RawTermTestCase(unittest.TestCase):
+
+    def test_encode(self):
+        self.assertEqual(b"\x83h\2a\1l\0\0\0\1a\2j",
+            encode((1, RawTerm(b"l\0\0\0\1a\2j"))))
+        self.assertEqual(b"\x83a\1", encode(RawTerm(bytearray(b"a\1"))))
+        self.assertEqual(b"\x83a\1", encode(RawTerm(memoryview(b"xa\1")[1:])))
+        self.assertEqual(b"\x83h\1a\1",
+            encode((RawTerm(b"a\1"),), compressed=True))
+
+    def test_decode(self):
+        self.assertEqual([2], RawTerm(b"l\0\0\0\1a\2j").decode())
+        self.assertRaises(ValueError, RawTerm(b"a\1a\2").decode)
+        self.assertRaises(IncompleteData, RawTerm(b"l\0\0\0\1a\2").decode)
+
+    def test_lazy_raw(self):
+        data = encode([1, (2, b"data"), [3]])
+        term, tail = decode(data, lazy=True)
+        self.assertEqual(RawTerm(b"a\1"), term.raw(0))
+        self.assertEqual(RawTerm(b"h\2a\2m\0\0\0\4data"), term.raw(1))
+        self.assertEqual(RawTerm(b"k\0\1\3"), term.raw(-1))
+        self.assertEqual(RawTerm(b"m\0\0\0\4data"), term[1].raw(1))
+        self.assertRaises(IndexError, term.raw, 3)
+        # Forwarded unchanged
+        self.assertEqual(encode((Atom(b"ok"), [1, (2, b"data"), [3]])),
+            encode((Atom(b"ok"), [term.raw(0), term.raw(1), term.raw(2)])))
+        term, tail = decode(data, lazy=True, binary_view=True)
+        self.assertEqual(memoryview, type(term.raw(1).data))
+        term, tail = decode(encode({1: 2}), lazy=True)
+        self.assertRaises(TypeError, term.raw, 0)
+
+
+class ExtractTestCase(unittest.TestCase):
+
+    def test_extract(self):
+        term = (1, [2, (3, b"data")], {b"key": [4.5], Atom(b"a"): 5})
+        data = encode(term)
+        self.assertEqual(1, extract(data, (0,)))
+        self.assertEqual((3, b"data"), extract(data, (1, 1)))
+        self.assertEqual(b"data", extract(data, (1, -1, 1)))
+        self.assertEqual([4.5], extract(data, (2, b"key")))
+        self.assertEqual(5, extract(data, (-1, b"a")))
+        self.assertEqual(decode(data)[0], extract(data, ()))
+        self.assertEqual(4.5, extract(encode(term, compressed=True),
+            (2, b"key", 0)))
+        self.assertEqual(ord("b"), extract(encode([1, "abc"]), (1, 1)))
+        self.assertEqual(memoryview,
+            type(extract(data, (1, 1, 1), binary_view=True)))
+        self.assertEqual(LazyTerm, type(extract(data, (1,), lazy=True)))
+
+    def test_extract_errors(self):
+        data = encode((1, [2, (3, b"data")], {b"key": [4.5]}))
+        self.assertRaises(IndexError, extract, data, (3,))
+        self.assertRaises(IndexError, extract, data, (1, 2))
+        self.assertRaises(KeyError, extract, data, (2, b"missing"))
+        self.assertRaises(TypeError, extract, data, (0, 0))
+        self.assertRaises(TypeError, extract, data, (b"key",))
+        self.assertRaises(TypeError, extract, encode("abc"), (0, 0))
+        self.assertRaises(IncompleteData, extract, data[:-3], (2, b"key"))
+        self.assertRaises(ValueError, extract, b"\x82a\1", ())
+
+
+class EncodeStreamTestCase(unittest.TestCase):
+
+    def test_encode_stream(self):
+        for term in [1, (1, [2, 3], "abc", {b"key": [b"x" * 100, 1.5]}),
+                list(range(300)), [bytearray(200), RawTerm(b"m\0\0\0\1a")],
+                (b"data" * 100,) * 3, [array("d", [1.5] * 100)]]:
+            size, chunks = encode_stream(term, chunk_size=64)
+            data = b"".join(bytes(chunk) for chunk in chunks)
+            self.assertEqual(encode(term), data)
+            self.assertEqual(len(data), size)
+        size, chunks = encode_stream("abc", strings="binary")
+        self.assertEqual(b"\x83m\0\0\0\3abc", b"".join(chunks))
+        self.assertRaises(ValueError, encode_stream, 1, chunk_size=0)
+
+    def test_large_binary(self):
+        data = bytearray(1000)
+        size, chunks = encode_stream([1, data], chunk_size=100)
+        chunks = [(type(chunk), bytes(chunk)) for chunk in chunks]
+        self.assertEqual(1014, size)
+        self.assertEqual([(bytearray, b"\x83l\0\0\0\2a\1m\0\0\3\xe8"),
+            (memoryview, data), (bytearray, b"j")], chunks)
+
+    def test_streamed_list(self):
+        term = StreamedList(lambda: (b"x" * i for i in range(3)))
+        self.assertEqual(b"\x83l\0\0\0\3m\0\0\0\0m\0\0\0\1x"
+            b"m\0\0\0\2xxj", encode(term))
+        self.assertEqual(b"\x83l\0\0\0\0j", encode(StreamedList(list)))
+        size, chunks = encode_stream((term, StreamedList(list)), chunk_size=8)
+        data = b"".join(bytes(chunk) for chunk in chunks)
+        self.assertEqual(len(data), size)
+        self.assertEqual(((List([b"", b"x", b"xx"]), List()), b""),
+            decode(data))
+        items = [[1], [1, 2]]
+        size, chunks = encode_stream(StreamedList(items.pop))
+        self.assertRaises(ValueError, list, chunks)
+
+
+class ColumnsTestCase(unittest.TestCase):
+
+    def test_decode_tuples(self):
+        data = encode([(1, 1.5, b"a", 2 ** 64), (2, 2.5, b"b", 1)])
+        columns, tail = decode_columns(data + b"tail")
+        self.assertEqual(b"tail", tail)
+        self.assertEqual((array("q", [1, 2]), array("d", [1.5, 2.5]),
+            [b"a", b"b"], [2 ** 64, 1]), columns)
+        columns, tail = decode_columns(data, binary_view=True)
+        self.assertEqual([memoryview, memoryview], [type(v) for v in columns[2]])
+        self.assertEqual(((), b""), decode_columns(b"\x83j"))
+        self.assertEqual(((), b""), decode_columns(encode(Columns(()))))
+        columns, tail = decode_columns(encode([(1, [1.5])]), arrays=True)
+        self.assertEqual((array("q", [1]), [array("d", [1.5])]), columns)
+
+    def test_decode_maps(self):
+        a, b = Atom(b"a"), Atom(b"b")
+        data = encode([{a: 1, b: "x"}, {b: "y", a: 2}])
+        self.assertEqual(({a: array("q", [1, 2]), b: [List(b"x"), List(b"y")]},
+            b""), decode_columns(data))
+        self.assertEqual(({a: array("q", [1, 2]), b: ["x", "y"]}, b""),
+            decode_columns(data, strings="auto"))
+
+    def test_decode_invalid(self):
+        self.assertRaises(ValueError, decode_columns, encode((1, 2)))
+        self.assertRaises(ValueError, decode_columns, encode([(1,), 2]))
+        self.assertRaises(ValueError, decode_columns, encode([(1,), (1, 2)]))
+        self.assertRaises(ValueError, decode_columns, encode([(1,), {1: 2}]))
+        self.assertRaises(ValueError, decode_columns,
+            encode([{1: 2}, {2: 2}]))
+        self.assertRaises(ValueError, decode_columns,
+            encode(ImproperList([(1,)], 2)))
+        data = encode([(1, 2), (3, 4)])
+        for i in range(1, len(data)):
+            self.assertRaises(IncompleteData, decode_columns, data[:i])
+
+    def test_encode(self):
+        self.assertEqual(encode([(1, 1.5), (2, 2.5)]),
+            encode(Columns([array("q", [1, 2]), array("d", [1.5, 2.5])])))
+        self.assertEqual(encode([{Atom(b"a"): 1}, {Atom(b"a"): 2}]),
+            encode(Columns({Atom(b"a"): [1, 2]})))
+        self.assertEqual(b"\x83h\1j", encode((Columns([[], []]),)))
+        self.assertRaises(ValueError, encode, Columns([[1], [1, 2]]))
+        columns = (array("q", [1, 2]), [b"a", b"b"])
+        self.assertEqual((columns, b""),
+            decode_columns(encode(Columns(columns), compressed=True)))
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class NdarrayTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.assertTrue(erlterms.register_ndarray())
+
+    def tearDown(self):
+        erlterms.unregister_type(numpy.ndarray)
+
+    def test_encode(self):
+        self.assertEqual(b"\x83h\4d\0\7ndarraym\0\0\0\3<i2h\2a\2a\1"
+            b"m\0\0\0\4\1\0\2\0",
+            encode(numpy.array([[1], [2]], "<i2")))
+        self.assertEqual(b"\x83h\4d\0\7ndarraym\0\0\0\3>i2h\1a\2"
+            b"m\0\0\0\4\0\1\0\2",
+            encode(numpy.array([[1, 3], [2, 4]], ">i2")[:, 0]))
+        self.assertRaises(ValueError, encode, numpy.array([None]))
+
+    def test_decode(self):
+        data = b"\x83h\4d\0\7ndarraym\0\0\0\3<i2h\2a\2a\1m\0\0\0\4\1\0\2\0"
+        term, tail = decode(data, binary_view=True)
+        self.assertEqual(numpy.dtype("<i2"), term.dtype)
+        self.assertEqual([[1], [2]], term.tolist())
+        # The array data is not copied
+        base = term
+        while isinstance(base, numpy.ndarray):
+            base = base.base
+        self.assertIs(data, base.obj)
+        self.assertEqual([[1], [2]], decode(data)[0].tolist())
+        self.assertEqual([[1], [2]], decode(data, lazy=True)[0].tolist())
+
+    def test_unregister(self):
+        data = b"\x83h\4d\0\7ndarraym\0\0\0\3<i2h\1a\1m\0\0\0\2\1\0"
+        # Registering again keeps the codec
+        self.assertTrue(erlterms.register_ndarray())
+        self.assertEqual([1], decode(data)[0].tolist())
+        erlterms.unregister_type(numpy.ndarray)
+        self.assertEqual((Atom(b"ndarray"), b"<i2", (1,), b"\1\0"),
+            decode(data)[0])
+        self.assertFalse(encode(numpy.array([1])).startswith(
+            b"\x83h\4d\0\7ndarray"))
+        # The tag can be used by other codecs
+        erlterms.register_type(_Point, tuple, Atom(b"ndarray"), _Point._make)
+        try:
+            self.assertRaises(ValueError, erlterms.register_ndarray)
+        finally:
+            erlterms.unregister_type(_Point)
+
+    def test_symmetric(self):
+        for a in (numpy.arange(12.0).reshape(2, 3, 2), numpy.array(5.0),
+                numpy.array([], "u1"), numpy.array([True, False]),
+                numpy.array(["2020-01-01"], "datetime64[D]"),
+                numpy.arange(6).reshape(2, 3).T):
+            term, tail = decode(encode([a]))
+            self.assertEqual(a.dtype, term[0].dtype)
+            self.assertEqual(a.shape, term[0].shape)
+            self.assertEqual(a.tolist(), term[0].tolist())
+
 
 class TestSymmetric(unittest.TestCase):
     def test_empty_list(self):
@@ -601,7 +1479,29 @@ class TestSymmetric(unittest.TestCase):
         self.assertEquals(input.v, input.v)
 
 
+class BackendTestSuite(unittest.TestSuite):
+    """Run tests with the compiled or the pure Python codec."""
+
+    def __init__(self, tests=(), extension=False):
+        super(BackendTestSuite, self).__init__(tests)
+        self.extension = extension
+
+    def run(self, result, debug=False):
+        previous = erlterms._use_extension(self.extension)
+        try:
+            return super(BackendTestSuite, self).run(result, debug)
+        finally:
+            erlterms._use_extension(previous)
+
+
 def get_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(BackendTestSuite(get_backend_suite(), extension=False))
+    if erlterms._erlterms is not None:
+        suite.addTest(BackendTestSuite(get_backend_suite(), extension=True))
+    return suite
+
+def get_backend_suite():
     load = unittest.TestLoader().loadTestsFromTestCase
     suite = unittest.TestSuite()
     suite.addTests(load(AtomTestCase))
@@ -610,4 +1510,11 @@ def get_suite():
     suite.addTests(load(OpaqueObjectTestCase))
     suite.addTests(load(DecodeTestCase))
     suite.addTests(load(EncodeTestCase))
+    suite.addTests(load(RegisterTypeTestCase))
+    suite.addTests(load(RecordCodecTestCase))
+    suite.addTests(load(NdarrayTestCase))
+    suite.addTests(load(ColumnsTestCase))
+    suite.addTests(load(RawTermTestCase))
+    suite.addTests(load(ExtractTestCase))
+    suite.addTests(load(EncodeStreamTestCase))
     return suite
@@ -319,9 +319,10 @@ handle_incoming_message(Request, State) ->
 %% @doc Handle incoming call result
 %%
 handle_call_result(Id, Result, State=#state{port=Port,
-        compressed=Compressed}) ->
-    Data = erlport_utils:encode_term(format_call_result(Id, Result),
-        Compressed),
+        compressed=Compressed, compress_threshold=Threshold,
+        strings=Strings}) ->
+    Data = erlport_utils:encode_term(format_call_result(Id, Result, Strings),
+        Compressed, Threshold),
     case erlport_utils:send_data(Port, Data) of
         ok ->
             {noreply, State};
@@ -332,12 +333,13 @@ handle_call_result(Id, Result, State=#state{port=Port,
 %%
 %% @doc Format incoming call result
 %%
-format_call_result(Id, {ok, Response}) ->
-    {'r', Id, erlport_utils:prepare_term(Response)};
-format_call_result(Id, {error, Error}) ->
-    {'e', Id, erlport_utils:prepare_term(Error)};
-format_call_result(Id, Error) ->
-    {'e', Id, {erlang, undefined, erlport_utils:prepare_term(Error), []}}.
+format_call_result(Id, {ok, Response}, Strings) ->
+    {'r', Id, erlport_utils:prepare_term(Response, Strings)};
+format_call_result(Id, {error, Error}, Strings) ->
+    {'e', Id, erlport_utils:prepare_term(Error, Strings)};
+format_call_result(Id, Error, Strings) ->
+    {'e', Id, {erlang, undefined, erlport_utils:prepare_term(Error, Strings),
+        []}}.
 
 %%
 %% @doc Send or queue outgoing call request
@@ -358,16 +360,18 @@ send_request(Request, From, Options, State=#state{timeout=DefaultTimeout}) ->
     end.
 
 send_request2({call, Module, Function, Args, _Options}, From, Timeout,
-        State=#state{compressed=Compressed})
+        State=#state{compressed=Compressed, compress_threshold=Threshold,
+            strings=Strings})
         when is_atom(Module) andalso is_atom(Function) andalso is_list(Args) ->
     Id = next_message_id(State),
     Data = erlport_utils:encode_term({'C', Id, Module, Function,
-        erlport_utils:prepare_list(Args)}, Compressed),
+        erlport_utils:prepare_list(Args, Strings)}, Compressed, Threshold),
     erlport_utils:send_request(From, Data, Id, State, Timeout);
 send_request2({message, Message}, From, Timeout, State=#state{
-        compressed=Compressed}) ->
+        compressed=Compressed, compress_threshold=Threshold,
+        strings=Strings}) ->
     Data = erlport_utils:encode_term({'M',
-        erlport_utils:prepare_term(Message)}, Compressed),
+        erlport_utils:prepare_term(Message, Strings)}, Compressed, Threshold),
     erlport_utils:send_request(From, Data, undefined, State, Timeout).
 
 %%
@@ -39,8 +39,11 @@
 -export([
     send_data/2,
     encode_term/2,
+    encode_term/3,
     prepare_term/1,
+    prepare_term/2,
     prepare_list/1,
+    prepare_list/2,
     start_timer/2,
     stop_timer/1,
     send_request/5,
@@ -48,6 +51,9 @@
     ]).
 
 -type timer() :: undefined | reference().
+-type string_policy() :: charlist | binary | auto.
+
+-export_type([string_policy/0]).
 
 -define(is_allowed_term(T), (is_atom(T) orelse is_number(T)
     orelse is_binary(T))).
@@ -80,6 +86,56 @@ encode_term(Term, Compressed) when is_integer(Compressed)
         andalso Compressed >= 0 andalso Compressed =< 9 ->
     term_to_binary(Term, [{minor_version, 1}, {compressed, Compressed}]).
 
+%%
+%% @doc Encode Erlang term compressing only terms of at least Threshold bytes
+%%
+%% Small terms are rarely worth compressing, so they skip zlib altogether.
+%%
+
+-spec encode_term(Term::term(), Compressed::0..9,
+        Threshold::non_neg_integer()) -> Data::binary().
+
+encode_term(Term, Compressed, 0) ->
+    encode_term(Term, Compressed);
+encode_term(Term, 0, Threshold) when is_integer(Threshold)
+        andalso Threshold > 0 ->
+    encode_term(Term, 0);
+encode_term(Term, Compressed, Threshold) when is_integer(Compressed)
+        andalso Compressed > 0 andalso Compressed =< 9
+        andalso is_integer(Threshold) andalso Threshold > 0 ->
+    Data = term_to_binary(Term, [{minor_version, 1}]),
+    % The same rules as in erlport.erlterms.encode_into() of Python: terms
+    % of at least Threshold bytes without the version byte are compressed
+    % and kept compressed if that saves at least the 5 bytes of the header
+    case byte_size(Data) - 1 < Threshold of
+        true ->
+            Data;
+        false ->
+            compress_term(Data, Compressed)
+    end.
+
+%%
+%% @doc Compress encoded term the same way as term_to_binary/2 does
+%%
+
+compress_term(<<131, Encoded/binary>>=Data, Level) ->
+    Size = byte_size(Encoded),
+    Z = zlib:open(),
+    try
+        ok = zlib:deflateInit(Z, Level),
+        Compressed = iolist_to_binary(zlib:deflate(Z, Encoded, finish)),
+        ok = zlib:deflateEnd(Z),
+        % Compressed term should be smaller
+        case byte_size(Compressed) + 5 =< Size of
+            true ->
+                <<131, 80, Size:32, Compressed/binary>>;
+            false ->
+                Data
+        end
+    after
+        zlib:close(Z)
+    end.
+
 %%
 %% @doc Prepare Erlang term for encoding
 %%
@@ -87,15 +143,42 @@ encode_term(Term, Compressed) when is_integer(Compressed)
 -spec prepare_term(Term::term()) -> PreparedTerm::term().
 
 prepare_term(Term) ->
+    prepare_term(Term, charlist).
+
+%%
+%% @doc Prepare Erlang term for encoding with the given string policy
+%%
+%% With binary policy printable Unicode strings are sent as
+%% {'$erlport.text', UTF8Binary} tuples which Python decodes to str. With
+%% auto policy only the strings which can't be sent as STRING_EXT (longer
+%% than 65535 characters or not Latin-1) are sent that way, the others are
+%% decoded to str from STRING_EXT, so Python gets all text as str either
+%% way.
+%%
+%% Note that both policies scan every list in the term with
+%% io_lib:printable_unicode_list/1, and auto also with
+%% io_lib:printable_latin1_list/1, which is O(N) in the list length on top
+%% of the encoding itself.
+%%
+
+-spec prepare_term(Term::term(), Strings::string_policy()) ->
+    PreparedTerm::term().
+
+prepare_term(Term, Strings) ->
     if
         ?is_allowed_term(Term) ->
             Term;
         is_list(Term) ->
-            prepare_list(Term);
+            case is_text(Term, Strings) of
+                true ->
+                    {'$erlport.text', unicode:characters_to_binary(Term)};
+                false ->
+                    prepare_list(Term, Strings)
+            end;
         is_map(Term) ->
-            prepare_map(Term);
+            prepare_map(Term, Strings);
         is_tuple(Term) ->
-            list_to_tuple(prepare_list(tuple_to_list(Term)));
+            list_to_tuple(prepare_list(tuple_to_list(Term), Strings));
         true ->
             <<131, Data/binary>> = term_to_binary(Term, [{minor_version, 1}]),
             {'$erlport.opaque', erlang, Data}
@@ -107,27 +190,54 @@ prepare_term(Term) ->
 
 -spec prepare_list(List::list() | term()) -> PreparedList::list().
 
-prepare_list([Item | Tail]) ->
-    [prepare_term(Item) | prepare_list(Tail)];
-prepare_list([]) ->
+prepare_list(List) ->
+    prepare_list(List, charlist).
+
+%%
+%% @doc Prepare Erlang list for encoding with the given string policy
+%%
+
+-spec prepare_list(List::list() | term(), Strings::string_policy()) ->
+    PreparedList::list().
+
+prepare_list([Item | Tail], Strings) ->
+    [prepare_term(Item, Strings) | prepare_list(Tail, Strings)];
+prepare_list([], _Strings) ->
     [];
-prepare_list(ImproperTail) ->
-    prepare_term(ImproperTail).
+prepare_list(ImproperTail, Strings) ->
+    prepare_term(ImproperTail, Strings).
 
 
 %%
 %% @doc Prepare Erlang map for encoding
 %%
 
--spec prepare_map(Map::map() | term()) -> PreparedMap::map().
-prepare_map(Map) ->
+-spec prepare_map(Map::map() | term(), Strings::string_policy()) ->
+    PreparedMap::map().
+prepare_map(Map, Strings) ->
     F = fun(K, V, Acc) ->
-        PrepKey = prepare_term(K),
-        PrepVal = prepare_term(V),
+        PrepKey = prepare_term(K, Strings),
+        PrepVal = prepare_term(V, Strings),
         Acc#{PrepKey => PrepVal}
     end,
     maps:fold(F, #{}, Map).
 
+%%
+%% @doc Check whether the list should be sent as tagged UTF-8 binary
+%%
+
+-spec is_text(List::list(), Strings::string_policy()) -> boolean().
+
+is_text(_List, charlist) ->
+    false;
+is_text([], _Strings) ->
+    false;
+is_text(List, binary) ->
+    io_lib:printable_unicode_list(List);
+is_text(List, auto) ->
+    io_lib:printable_unicode_list(List) andalso not
+        (io_lib:printable_latin1_list(List) andalso length(List) =< 65535).
+
 %%
 %% @doc Start timer if needed
 %%
@@ -180,8 +180,9 @@ start(Function, Name, OptionsList) when is_list(OptionsList) ->
     end.
 
 init_factory(#python_options{python=Python,use_stdio=UseStdio, packet=Packet,
-        compressed=Compressed, port_options=PortOptions,
-        call_timeout=Timeout, buffer_size=BufferSize}) ->
+        compressed=Compressed, compress_threshold=Threshold,
+        port_options=PortOptions, call_timeout=Timeout,
+        buffer_size=BufferSize, strings=Strings}) ->
     fun () ->
         Path = lists:concat([Python,
             % Binary STDIO
@@ -190,10 +191,26 @@ init_factory(#python_options{python=Python,use_stdio=UseStdio, packet=Packet,
             " --packet=", Packet,
             " --", UseStdio,
             " --compressed=", Compressed,
-            " --buffer_size=", BufferSize]),
+            " --buffer_size=", BufferSize,
+            % Only Python 3 supports string policies, python_options
+            % rejects them for Python 2
+            case Strings of
+                charlist ->
+                    "";
+                _ ->
+                    lists:concat([" --strings=", Strings])
+            end,
+            % And compression thresholds
+            case Threshold of
+                0 ->
+                    "";
+                _ ->
+                    lists:concat([" --compress_threshold=", Threshold])
+            end]),
         try open_port({spawn, Path}, PortOptions) of
             Port ->
-                {ok, #state{port=Port, timeout=Timeout, compressed=Compressed}}
+                {ok, #state{port=Port, timeout=Timeout, compressed=Compressed,
+                    compress_threshold=Threshold, strings=Strings}}
         catch
             error:Error ->
                 {stop, {open_port_error, Error}}
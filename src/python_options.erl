@@ -44,6 +44,8 @@
 
 -type option() :: {python, Python :: string()}
     | {python_path, Path :: string() | [Path :: string()]}
+    | {strings, erlport_utils:string_policy()}
+    | {compress_threshold, Bytes :: non_neg_integer()}
     | erlport_options:option().
 -type options() :: [option()].
 
@@ -73,6 +75,21 @@ parse([{python_path, PythonPath}=Value | Tail], Options) ->
         {error, Invalid} ->
             {error, {invalid_option, Value, Invalid}}
     end;
+parse([{strings, Strings}=Value | Tail], Options) ->
+    case lists:member(Strings, [charlist, binary, auto]) of
+        true ->
+            parse(Tail, Options#python_options{strings=Strings});
+        false ->
+            {error, {invalid_option, Value}}
+    end;
+parse([{compress_threshold, Threshold}=Value | Tail], Options) ->
+    case is_integer(Threshold) andalso Threshold >= 0 of
+        true ->
+            parse(Tail, Options#python_options{
+                compress_threshold=Threshold});
+        false ->
+            {error, {invalid_option, Value}}
+    end;
 parse([Option | Tail], Options) ->
     case erlport_options:parse(Option) of
         {ok, Name, Value} ->
@@ -87,12 +104,17 @@ parse([], Options=#python_options{env=Env0, python_path=PythonPath0,
         PortOptions, Path, UseStdio),
     case get_python(Python) of
         {ok, PythonFilename, MajVersion} ->
-            case update_python_path(Env0, PythonPath0, MajVersion) of
-                {ok, PythonPath, Env} ->
-                    {ok, Options#python_options{env=Env,
-                        python_path=PythonPath, python=PythonFilename,
-                        port_options=[{env, Env}, {packet, Packet}
-                            | PortOptions1]}};
+            case check_version_options(MajVersion, Options) of
+                ok ->
+                    case update_python_path(Env0, PythonPath0, MajVersion) of
+                        {ok, PythonPath, Env} ->
+                            {ok, Options#python_options{env=Env,
+                                python_path=PythonPath, python=PythonFilename,
+                                port_options=[{env, Env}, {packet, Packet}
+                                    | PortOptions1]}};
+                        {error, _}=Error ->
+                            Error
+                    end;
                 {error, _}=Error ->
                     Error
             end;
@@ -110,6 +132,18 @@ set_by_name(Name, Value, Options) ->
             setelement(N, Options, Value)
     end.
 
+%% String policies and compression thresholds are only supported by the
+%% Python 3 side, erlport.cli of Python 2 rejects them
+check_version_options(2, #python_options{strings=Strings})
+        when Strings =/= charlist ->
+    {error, {invalid_option, {strings, Strings}, unsupported_by_python2}};
+check_version_options(2, #python_options{compress_threshold=Threshold})
+        when Threshold =/= 0 ->
+    {error, {invalid_option, {compress_threshold, Threshold},
+        unsupported_by_python2}};
+check_version_options(_MajVersion, _Options) ->
+    ok.
+
 update_python_path(Env0, PythonPath0, MajVersion) ->
     case code:priv_dir(erlport) of
         {error, bad_name} ->
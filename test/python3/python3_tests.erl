@@ -295,6 +295,30 @@ compressed_test_() ->
         end
     ).
 
+strings_auto_test_() ->
+    ?SETUP(
+        setup_factory([{strings, auto}]),
+        [?_assertEqual(str, python:call(P, test_utils, type_name, ["text"])),
+            ?_assertEqual(str, python:call(P, test_utils, type_name,
+                [[16#100, 16#101]])),
+            ?_assertEqual(str, python:call(P, test_utils, type_name,
+                [lists:duplicate(70000, $a)])),
+            ?_assertEqual(bytes, python:call(P, test_utils, type_name,
+                [<<"data">>]))]
+    ).
+
+strings_binary_test_() ->
+    ?SETUP(
+        setup_factory([{strings, binary}]),
+        [?_assertEqual(str, python:call(P, test_utils, type_name, ["text"])),
+            ?_assertEqual(str, python:call(P, test_utils, type_name,
+                [[16#100, 16#101]])),
+            ?_assertEqual('List', python:call(P, test_utils, type_name,
+                [[1, 2, 3]])),
+            ?_assertEqual(bytes, python:call(P, test_utils, type_name,
+                [<<"data">>]))]
+    ).
+
 call_pipeline_test_() ->
     ?SETUP(
         {inparallel, [
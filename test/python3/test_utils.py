@@ -34,6 +34,9 @@ def identity(v):
 def length(v):
     return len(v)
 
+def type_name(v):
+    return Atom(type(v).__name__.encode())
+
 def print_string(s):
     print(s.to_string())
 
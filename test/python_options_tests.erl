@@ -57,6 +57,17 @@ buffer_size_test_() -> [
         python_options:parse([{buffer_size, invalid}]))
     ].
 
+compress_threshold_option_test_() -> [
+    ?_assertMatch({ok, #python_options{compress_threshold=0}},
+        python_options:parse([])),
+    ?_assertMatch({ok, #python_options{compress_threshold=1024}},
+        python_options:parse([{compress_threshold, 1024}])),
+    ?_assertEqual({error, {invalid_option, {compress_threshold, -1}}},
+        python_options:parse([{compress_threshold, -1}])),
+    ?_assertEqual({error, {invalid_option, {compress_threshold, invalid}}},
+        python_options:parse([{compress_threshold, invalid}]))
+    ].
+
 use_stdio_option_test_() -> [
     ?_assertMatch({ok, #python_options{use_stdio=use_stdio}},
         python_options:parse([])),
@@ -81,6 +92,17 @@ compressed_option_test_() -> [
         python_options:parse([{compressed, invalid}]))
     ].
 
+strings_option_test_() -> [
+    ?_assertMatch({ok, #python_options{strings=charlist}},
+        python_options:parse([])),
+    ?_assertMatch({ok, #python_options{strings=binary}},
+        python_options:parse([{strings, binary}])),
+    ?_assertMatch({ok, #python_options{strings=auto}},
+        python_options:parse([{strings, auto}])),
+    ?_assertEqual({error, {invalid_option, {strings, invalid}}},
+        python_options:parse([{strings, invalid}]))
+    ].
+
 packet_option_test_() -> [
     ?_assertMatch({ok, #python_options{packet=4}}, python_options:parse([])),
     ?_assertMatch({ok, #python_options{packet=4}},
@@ -208,6 +230,17 @@ python_option_test_() -> {setup,
                     python_options:parse([]))
                 end, "ERLPORT_PYTHON", GoodPython)
         end,
+        ?_assertEqual({error, {invalid_option, {strings, binary},
+                unsupported_by_python2}},
+            python_options:parse([{python, GoodPython}, {strings, binary}])),
+        ?_assertEqual({error, {invalid_option, {compress_threshold, 1024},
+                unsupported_by_python2}},
+            python_options:parse([{python, GoodPython},
+                {compress_threshold, 1024}])),
+        ?_assertMatch({ok, #python_options{strings=auto,
+                compress_threshold=1024}},
+            python_options:parse([{python, GoodPython3}, {strings, auto},
+                {compress_threshold, 1024}])),
         ?_assertEqual({error, {unsupported_python_version, "Python 2.4.6"}},
             python_options:parse([{python, UnsupportedPython}])),
         ?_assertEqual({error, {invalid_python,